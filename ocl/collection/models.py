@@ -11,7 +11,8 @@ from oclapi.settings.common import Common
 from collection.validation_messages import REFERENCE_ALREADY_EXISTS, CONCEPT_FULLY_SPECIFIED_NAME_UNIQUE_PER_COLLECTION_AND_LOCALE, \
     CONCEPT_PREFERRED_NAME_UNIQUE_PER_COLLECTION_AND_LOCALE
 from oclapi.models import ConceptContainerModel, ConceptContainerVersionModel, ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW, CUSTOM_VALIDATION_SCHEMA_OPENMRS
-from oclapi.utils import reverse_resource, S3ConnectionFactory, get_class, compact
+from oclapi.export import get_export_storage, keyset_batches
+from oclapi.utils import reverse_resource, get_class, compact
 from concepts.models import Concept, ConceptVersion
 from mappings.models import Mapping, MappingVersion
 from django.db.models import Max
@@ -371,6 +372,17 @@ class CollectionVersion(ConceptContainerVersionModel):
         if not CollectionConcept.objects.filter(collection_id=self.id, concept_id=concept.id).exists():
             CollectionConcept(collection_id=self.id, concept_id=concept.id).save()
 
+    def get_concept_id_batches(self, batch_size, active_only=False):
+        """ Yields all concept version ids in batches, paginated by id rather than by offset, or only the ids of
+        the active ones given active_only. Prefer it over get_concepts(start, end) for iterating over all concepts of
+        large collections.
+        """
+        batches = keyset_batches(self.__get_concept_ids(), batch_size, key='concept_id')
+        if not active_only:
+            return batches
+        return (sorted(ConceptVersion.objects.filter(id__in=batch, is_active=True).values_list('id', flat=True))
+                for batch in batches)
+
     def get_concepts_count(self):
         """ Returns a count of concepts.
         """
@@ -405,6 +417,17 @@ class CollectionVersion(ConceptContainerVersionModel):
         if not CollectionMapping.objects.filter(collection_id=self.id, mapping_id=mapping.id).exists():
             CollectionMapping(collection_id=self.id, mapping_id=mapping.id).save()
 
+    def get_mapping_id_batches(self, batch_size, active_only=False):
+        """ Yields all mapping version ids in batches, paginated by id rather than by offset, or only the ids of
+        the active ones given active_only. Prefer it over get_mappings(start, end) for iterating over all mappings of
+        large collections.
+        """
+        batches = keyset_batches(self.__get_mapping_ids(), batch_size, key='mapping_id')
+        if not active_only:
+            return batches
+        return (sorted(MappingVersion.objects.filter(id__in=batch, is_active=True).values_list('id', flat=True))
+                for batch in batches)
+
     def get_mappings_count(self):
         """ Returns a count of mappings.
         """
@@ -439,12 +462,17 @@ class CollectionVersion(ConceptContainerVersionModel):
         if seed_references_from:
             self.references = list(seed_references_from.references)
 
-    def get_export_key(self):
-        bucket = S3ConnectionFactory.get_export_bucket()
-        return bucket.get_key(self.export_path)
+    def has_export(self, base_version=None, export_format=None):
+        return get_export_storage().exists(self.get_export_path(base_version, export_format))
+
+    def get_export_url(self, base_version=None, export_format=None, expires_in=60):
+        """ Returns the URL to download the export from, or None if the version has not been exported """
+        storage = get_export_storage()
+        export_path = self.get_export_path(base_version, export_format)
+        return storage.get_url(export_path, expires_in) if storage.exists(export_path) else None
 
-    def has_export(self):
-        return bool(self.get_export_key())
+    def delete_export(self, base_version=None, export_format=None):
+        get_export_storage().delete(self.get_export_path(base_version, export_format))
 
     @property
     def export_path(self):
@@ -452,6 +480,18 @@ class CollectionVersion(ConceptContainerVersionModel):
         collection = self.versioned_object
         return "%s/%s_%s.%s.zip" % (collection.owner_name, collection.mnemonic, self.mnemonic, last_update)
 
+    def get_delta_export_path(self, base_version):
+        """ Path of the export of the changes since base_version """
+        base_last_update = base_version.last_child_update.strftime('%Y%m%d%H%M%S')
+        return "%s.since_%s.%s.zip" % (self.export_path[:-len('.zip')], base_version.mnemonic, base_last_update)
+
+    def get_export_path(self, base_version=None, export_format=None):
+        """ Path of the full or delta export, with the format before the extension unless it is JSON """
+        path = self.get_delta_export_path(base_version) if base_version else self.export_path
+        if export_format and export_format != 'json':
+            path = "%s.%s.zip" % (path[:-len('.zip')], export_format)
+        return path
+
     def __get_last_child_update(self):
         last_concept_update = self.last_concept_update
         last_mapping_update = self.last_mapping_update
@@ -496,6 +536,34 @@ class CollectionVersion(ConceptContainerVersionModel):
         collection_ids = CollectionMapping.objects.filter(mapping_id__in=mapping_ids).values_list('collection_id', flat=True)
         return CollectionVersion.objects.filter(id__in=list(collection_ids))
 
+    @classmethod
+    def get_collection_ids_by_child(cls, membership_model, child_field, child_ids):
+        """
+        Looks up the collection versions and collections of many concept or mapping versions, through membership_model
+        and its child_field, with a query per model. Returns the collection version ids and the collection ids, each
+        by child id, as get_collection_version_ids and get_collection_ids of the children would.
+        """
+        child_ids = list(child_ids)
+        memberships = list(membership_model.objects.filter(
+            **{'%s__in' % child_field: child_ids}).values_list(child_field, 'collection_id'))
+        version_ids = list(set(collection_version_id for _, collection_version_id in memberships))
+        versions = dict(CollectionVersion.objects.filter(id__in=version_ids).values_list(
+            'id', 'versioned_object_id')) if version_ids else {}
+        collection_ids = list(set(versions.values()))
+        existing_ids = set(Collection.objects.filter(id__in=collection_ids).values_list(
+            'id', flat=True)) if collection_ids else set()
+
+        collection_version_ids_by_child = dict((child_id, []) for child_id in child_ids)
+        collection_ids_by_child = dict((child_id, []) for child_id in child_ids)
+        for child_id, collection_version_id in memberships:
+            if collection_version_id not in versions:
+                continue
+            collection_version_ids_by_child[child_id].append(collection_version_id)
+            collection_id = versions[collection_version_id]
+            if collection_id in existing_ids and collection_id not in collection_ids_by_child[child_id]:
+                collection_ids_by_child[child_id].append(collection_id)
+        return collection_version_ids_by_child, collection_ids_by_child
+
     @classmethod
     def persist_new(cls, obj, user=None, **kwargs):
         obj.is_active = True
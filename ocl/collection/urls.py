@@ -1,7 +1,8 @@
 from django.conf.urls import patterns, url, include
 from collection.feeds import CollectionFeed
 from collection.views import CollectionListView, CollectionRetrieveUpdateDestroyView, CollectionVersionListView, CollectionVersionRetrieveUpdateView, CollectionVersionRetrieveUpdateDestroyView, CollectionVersionChildListView, CollectionExtrasView, CollectionExtraRetrieveUpdateDestroyView, \
-    CollectionReferencesView, CollectionVersionReferenceListView, CollectionVersionExportView, CollectionVersionProcessingView
+    CollectionReferencesView, CollectionVersionReferenceListView, CollectionVersionExportView, CollectionVersionProcessingView, \
+    CollectionVersionExportProgressView
 from mappings.views import MappingDetailView
 from oclapi.models import NAMESPACE_PATTERN
 
@@ -21,6 +22,7 @@ urlpatterns = patterns('',
     url(r'^(?P<collection>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/$', CollectionVersionRetrieveUpdateDestroyView.as_view(), name='collectionversion-detail'),
     url(r'^(?P<collection>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/children/$', CollectionVersionChildListView.as_view(), {'list_children': True}, name='collectionversion-child-list'),
     url(r'^(?P<collection>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/export/$', CollectionVersionExportView.as_view(), name='collectionversion-export'),
+    url(r'^(?P<collection>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/export/progress/$', CollectionVersionExportProgressView.as_view(), name='collectionversion-export-progress'),
     url(r'^(?P<collection>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/concepts/', include('concepts.urls')),
     url(r'^(?P<collection>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/mappings/$', include('mappings.urls')),
     url(r'^(?P<collection>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/references/$', CollectionVersionReferenceListView.as_view()),
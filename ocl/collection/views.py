@@ -26,6 +26,7 @@ from oclapi.views import ResourceVersionMixin, ResourceAttributeChildMixin, Conc
     ConceptDictionaryCreateMixin, ConceptDictionaryExtrasView, ConceptDictionaryExtraRetrieveUpdateDestroyView, \
     BaseAPIView
 from oclapi.models import ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW, ACCESS_TYPE_NONE
+from oclapi.export import EXPORT_FORMATS, ExportProgress
 from rest_framework import mixins, status
 from rest_framework.generics import RetrieveAPIView, UpdateAPIView, get_object_or_404, DestroyAPIView
 from rest_framework.response import Response
@@ -583,20 +584,26 @@ class CollectionVersionExportView(ResourceAttributeChildMixin):
 
     def get(self, request, *args, **kwargs):
         version = self.get_object()
-        logger.debug('Export requested for collection version %s - Requesting AWS-S3 key' % version)
+        logger.debug('Export requested for collection version %s - Requesting export URL' % version)
 
         if version.mnemonic == 'HEAD':
             return HttpResponse(status=405)
 
-        key = version.get_export_key()
-        url, status = None, 204
+        base_version = self.get_base_version(version)
+        if base_version and base_version.mnemonic == 'HEAD':
+            return HttpResponse(status=405)
+        export_format = self.get_export_format()
+        if export_format not in EXPORT_FORMATS:
+            return HttpResponse(status=400)
+
+        url = version.get_export_url(base_version, export_format)
+        status = 204
 
-        if key:
-            logger.debug('   Key retreived for collection version %s - Generating URL' % version)
-            url, status = key.generate_url(60), 303
+        if url:
             logger.debug('   URL retreived for collection version %s - Responding to client' % version)
+            status = 303
         else:
-            logger.debug('   Key does not exist for collection version %s' % version)
+            logger.debug('   Export does not exist for collection version %s' % version)
             return HttpResponse(status=204)
 
         response = HttpResponse(status=status)
@@ -638,11 +645,20 @@ class CollectionVersionExportView(ResourceAttributeChildMixin):
             return HttpResponse(status=405)  # export of head version is not allowed
 
         status = 303
-        if not version.has_export():
-            status = self.handle_export_collection_version()
+        base_version = self.get_base_version(version)
+        if base_version and base_version.mnemonic == 'HEAD':
+            return HttpResponse(status=405)
+        export_format = self.get_export_format()
+        if export_format not in EXPORT_FORMATS:
+            return HttpResponse(status=400)
+
+        if not version.has_export(base_version, export_format):
+            status = self.handle_export_collection_version(base_version, export_format)
         else:
             response = HttpResponse(status=status)
             response['URL'] = self.resource_version_path_info + 'export/'
+            if self.request.GET:
+                response['URL'] += '?' + self.request.GET.urlencode()
             return response
 
         return HttpResponse(status=status)
@@ -658,18 +674,68 @@ class CollectionVersionExportView(ResourceAttributeChildMixin):
 
         if not permitted:
             return HttpResponseForbidden()
-        if version.has_export():
-            key = version.get_export_key()
-            if key:
-                key.delete()
-                return HttpResponse(status=200)
+        base_version = self.get_base_version(version)
+        export_format = self.get_export_format()
+        if version.has_export(base_version, export_format):
+            version.delete_export(base_version, export_format)
+            return HttpResponse(status=200)
 
         return HttpResponse(status=204)
 
-    def handle_export_collection_version(self):
+    def get_base_version(self, version):
+        """ The version named by the base parameter, to export only the changes since that version """
+        base = self.request.QUERY_PARAMS.get('base')
+        if not base:
+            return None
+        return get_object_or_404(CollectionVersion, versioned_object_id=version.versioned_object_id, mnemonic=base)
+
+    def get_export_format(self):
+        """ One of EXPORT_FORMATS, named by the export_format parameter """
+        return self.request.QUERY_PARAMS.get('export_format', 'json')
+
+    def handle_export_collection_version(self, base_version=None, export_format='json'):
         version = self.get_object()
+        ExportProgress.clear_cancel(version.get_export_path(base_version, export_format))
         try:
-            export_collection.delay(version.id)
+            export_collection.delay(version.id, base_version.id if base_version else None, export_format)
             return 202
         except AlreadyQueued:
             return 409
+
+
+class CollectionVersionExportProgressView(CollectionVersionExportView):
+    """ Progress of the export of a collection version, which its admins may cancel by posting to it """
+    http_method_names = ['get', 'post', 'head', 'options']
+
+    def get(self, request, *args, **kwargs):
+        version = self.get_object()
+        export_format = self.get_export_format()
+        if export_format not in EXPORT_FORMATS:
+            return HttpResponse(status=400)
+        progress = ExportProgress.load(version.get_export_path(self.get_base_version(version), export_format))
+        if progress is None:
+            return HttpResponse(status=204)
+        return Response(progress)
+
+    def post(self, request, *args, **kwargs):
+        user = request.user
+        userprofile = UserProfile.objects.get(mnemonic=user.username)
+        version = self.get_object()
+
+        permitted = user.is_staff or \
+                    user.is_superuser or \
+                    userprofile.is_admin_for(version.versioned_object)
+
+        if not permitted:
+            return HttpResponseForbidden()
+        export_format = self.get_export_format()
+        if export_format not in EXPORT_FORMATS:
+            return HttpResponse(status=400)
+        export_path = version.get_export_path(self.get_base_version(version), export_format)
+        progress = ExportProgress.load(export_path)
+        if progress is None or progress['phase'] in ExportProgress.ENDED_PHASES:
+            return HttpResponse(status=409)  # no export in progress
+
+        logger.debug('Export cancellation requested for collection version %s' % version)
+        ExportProgress.cancel(export_path)
+        return HttpResponse(status=202)
@@ -14,6 +14,7 @@ class OpenMRSConceptValidator(BaseConceptValidator):
     def __init__(self, **kwargs):
         self.repo = kwargs.pop('repo')
         self.reference_values = kwargs.pop('reference_values')
+        self.name_index = kwargs.pop('name_index', None)
 
     def validate_concept_based(self, concept):
         self.must_have_exactly_one_preferred_name(concept)
@@ -72,6 +73,9 @@ class OpenMRSConceptValidator(BaseConceptValidator):
         if not self.repo:
             return True
 
+        if self.name_index is not None:
+            return not self.name_index.other_concept_has_name(name, self_id)
+
         from concepts.models import Concept
         from django_mongodb_engine.query import A
         conceptsQuery = Concept.objects.filter(parent_id=self.repo.id, is_active=True, retired=False, names=A('name', name.name)).filter(
@@ -0,0 +1,129 @@
+from collections import namedtuple
+
+from django.utils.datastructures import SortedDict
+from django.utils.encoding import smart_text
+
+from concepts.models import Concept, ConceptVersion
+from concepts.serializers import ConceptVersionDetailSerializer
+from oclapi.models import decode_extras
+from oclapi.export import ExportEncoder, find_export_documents
+from sources.models import Source
+
+# The attributes of names and descriptions that Concept.get_display_locale_object_for reads
+ExportedText = namedtuple('ExportedText', ['uuid', 'external_id', 'name', 'type', 'locale', 'locale_preferred'])
+ExportedConcept = namedtuple('ExportedConcept', ['names', 'parent_source'])
+
+
+def get_text(value):
+    """ The value as serializers.CharField renders it """
+    if isinstance(value, basestring) or value is None:
+        return value
+    return smart_text(value)
+
+
+def get_exported_texts(documents):
+    return [ExportedText(document.get('uuid'), document.get('external_id'), document.get('name'),
+                         document.get('type'), document.get('locale'), document.get('locale_preferred', False))
+            for document in documents or []]
+
+
+def encode_localized_texts(texts, name_attr, text_type):
+    """ Names or descriptions as LocalizedTextListField renders them, None if there are none """
+    if not texts:
+        return None
+    return [SortedDict([
+        ('uuid', get_text(text.uuid)),
+        ('external_id', get_text(text.external_id)),
+        (name_attr, get_text(text.name)),
+        ('locale', get_text(text.locale)),
+        ('locale_preferred', text.locale_preferred),
+        ('%s_type' % name_attr, get_text(text.type)),
+        ('type', text_type),
+    ]) for text in texts]
+
+
+class ConceptVersionExportEncoder(ExportEncoder):
+    """
+    Encodes concept versions as ConceptVersionDetailSerializer does, from their raw documents read with a
+    projection of the exported fields. The concepts of a batch are read in one query and each source and its
+    owner once per export, where the serializer looks up the concept, source and owner of every concept version.
+    """
+    version_fields = ['mnemonic', 'versioned_object_id', 'external_id', 'concept_class', 'datatype', 'names',
+                      'descriptions', 'extras', 'retired', 'created_at', 'updated_at', 'version_created_by',
+                      'is_latest_version', 'uri']
+    concept_fields = ['mnemonic', 'parent_id', 'uri']
+
+    def __init__(self):
+        # The fields of the serializer give the order of the attributes and render the plain ones
+        self.fields = ConceptVersionDetailSerializer().fields
+        self.sources = {}
+
+    def encode_batch(self, ids):
+        versions = list(find_export_documents(ConceptVersion, ids, self.version_fields))
+        concept_ids = set(version['versioned_object_id'] for version in versions)
+        concepts = dict((unicode(concept['_id']), concept)
+                        for concept in find_export_documents(Concept, concept_ids, self.concept_fields))
+        return [self.encode(version, concepts[version['versioned_object_id']]) for version in versions]
+
+    def get_source(self, source_id):
+        """ Attributes of the source and owner of concepts, looked up once per source """
+        if source_id not in self.sources:
+            source = Source.objects.get(id=source_id)
+            self.sources[source_id] = {
+                'source': source,
+                'name': source.mnemonic,
+                'url': source.url,
+                'owner': source.owner_name,
+                'owner_type': source.owner_type,
+                'owner_url': source.owner_url,
+            }
+        return self.sources[source_id]
+
+    def encode(self, version, concept):
+        source = self.get_source(concept['parent_id'])
+        names = get_exported_texts(version.get('names'))
+        descriptions = get_exported_texts(version.get('descriptions'))
+        display_name = Concept.get_display_locale_object_for(ExportedConcept(names, source['source']))
+        locale_names = [name for name in names if name.type == 'ISO 639-1']
+        extras = version.get('extras')
+        decode_extras(extras)
+
+        native_values = {
+            'version_url': version.get('uri') or ConceptVersion.objects.get(id=version['_id']).url,
+            'url': concept.get('uri') or Concept.objects.get(id=concept['_id']).url,
+            'names': encode_localized_texts(names, 'name', 'ConceptName'),
+            'descriptions': encode_localized_texts(descriptions, 'description', 'ConceptDescription'),
+            'mappings': None,
+            'locale': locale_names[0].name if locale_names else None,
+        }
+        values = {
+            'type': ConceptVersion.versioned_resource_type(),
+            'uuid': unicode(version['_id']),
+            'id': concept.get('mnemonic'),
+            'external_id': version.get('external_id'),
+            'concept_class': version.get('concept_class'),
+            'datatype': version.get('datatype'),
+            'display_name': display_name.name if display_name else None,
+            'display_locale': display_name.locale if display_name else None,
+            'extras': extras,
+            'retired': version.get('retired'),
+            'source': source['name'],
+            'source_url': source['url'],
+            'owner': source['owner'],
+            'owner_type': source['owner_type'],
+            'owner_url': source['owner_url'],
+            'version': version.get('mnemonic'),
+            'created_on': version.get('created_at'),
+            'updated_on': version.get('updated_at'),
+            'version_created_on': version.get('created_at'),
+            'version_created_by': version.get('version_created_by'),
+            'is_latest_version': version.get('is_latest_version'),
+        }
+
+        data = SortedDict()
+        for field_name, field in self.fields.items():
+            if field_name in native_values:
+                data[field_name] = native_values[field_name]
+            else:
+                data[field_name] = field.to_native(values[field_name])
+        return data
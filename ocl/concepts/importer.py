@@ -1,18 +1,31 @@
 """ Concepts importer module """
+import copy
 import json
 import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import zlib
 
 
+from bson import ObjectId
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.core.management import CommandError
+from django.core.management.base import OutputWrapper
+from django.db.models import F
 
 from concepts.models import Concept, ConceptVersion
 from concepts.serializers import ConceptDetailSerializer, ConceptVersionUpdateSerializer
+from concepts.validators import SourceNameIndex, ValidatorSpecifier
+from mappings.models import MappingVersion
 from oclapi.management.commands import MockRequest, ImportActionHelper
-from sources.models import SourceVersion
+from oclapi.models import stamp_uri
+from oclapi.search_indexing import SearchIndexRecorder
+from oclapi.utils import close_db_connections
+from sources.models import Source, SourceVersion
 
-from haystack.management.commands import update_index
 import haystack
 from datetime import datetime
 
@@ -51,6 +64,21 @@ class ValidationLogger:
         if self.output is None:
             self.output = open(self.output_file_name, 'w+')
 
+    def append_log(self, file_name):
+        """ Appends the errors logged to another file, e.g. by an import worker """
+        if not os.path.exists(file_name):
+            return
+        with open(file_name, 'rb') as log:
+            lines = log.read().split('\n')[1:]
+
+        for line in lines:
+            if self.count is 0:
+                self.init_output()
+                self.output.write(u'MNEMONIC;ERROR;JSON')
+
+            self.count += 1
+            self.output.write('\n' + line)
+
     def close(self):
         if not self.output:
             return
@@ -58,6 +86,96 @@ class ValidationLogger:
         self.output.close()
 
 
+class PendingConcept(object):
+    """ A concept line of a chunk, resolved and validated in memory, waiting for the chunk to be written """
+    def __init__(self, data, concept, version, update_action, previous_version=None):
+        self.data = data
+        self.concept = concept
+        self.version = version
+        self.update_action = update_action
+        self.previous_version = previous_version
+
+
+def prepare_for_bulk_insert(obj):
+    """ Does what BaseModel.save and the pre_save signal would do, as bulk inserts bypass both """
+    obj.encode_extras()
+    stamp_uri(type(obj), obj)
+
+
+def shard_of(line, shards):
+    """ Returns the shard of a JSON line, based on a hash of the concept mnemonic """
+    try:
+        mnemonic = unicode(json.loads(line)['id'])
+    except (ValueError, KeyError, TypeError):
+        # Invalid lines are reported by the worker of the first shard
+        return 0
+    return (zlib.crc32(mnemonic.encode('utf-8')) & 0xffffffff) % shards
+
+
+class InputSharding(object):
+    """
+    Assigns the lines of an input to shards as shard_of does, except that a concept having a name, other than a
+    short name, of a concept of an earlier line goes to the shard of that concept. The worker of the shard sees both
+    lines in the order of the input, so the uniqueness of names is validated as by a single process. A concept keeps
+    the shard of its first line, so a name that a later line of a concept shares with a concept of another shard,
+    or names shared with concepts of several shards, are only validated against the concepts of its own shard.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.concept_shards = dict()
+        self.name_shards = dict()
+
+    def shard_of(self, line):
+        try:
+            data = json.loads(line)
+            mnemonic = unicode(data['id'])
+            keys = [(name.get('locale'), name.get('name')) for name in data.get('names') or []
+                    if name.get('name_type') not in SourceNameIndex.SHORT_NAME_TYPES]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return shard_of(line, self.shards)
+
+        shard = self.concept_shards.get(mnemonic)
+        if shard is None:
+            shard = next((self.name_shards[key] for key in keys if key in self.name_shards), None)
+            if shard is None:
+                shard = shard_of(line, self.shards)
+            self.concept_shards[mnemonic] = shard
+        for key in keys:
+            self.name_shards.setdefault(key, shard)
+        return shard
+
+
+def import_concepts_shard(source_id, source_version_id, shard_file_name, total, error_file_name, test_mode, chunk_size):
+    """ Entry point of an import worker process """
+    source = Source.objects.get(id=source_id)
+    validation_logger = ValidationLogger(output_file_name=error_file_name) if error_file_name else None
+    importer = ConceptsImporter(source, open(shard_file_name, 'rb'), None, OutputWrapper(sys.stdout),
+                                OutputWrapper(sys.stderr), save_validation_errors=bool(error_file_name),
+                                validation_logger=validation_logger)
+    importer.source_version = SourceVersion.objects.get(id=source_version_id)
+    importer.index_recorder.setup()
+    try:
+        return importer.import_shard(total, test_mode, chunk_size)
+    finally:
+        importer.index_recorder.teardown()
+        importer.teardown_validation()
+
+
+def split_on_repeated_mnemonics(chunk):
+    """ Splits a chunk so that a concept occurs at most once in each part """
+    part, mnemonics = [], set()
+    for data in chunk:
+        mnemonic = unicode(data.get('id'))
+        if mnemonic in mnemonics:
+            yield part
+            part, mnemonics = [], set()
+        mnemonics.add(mnemonic)
+        part.append(data)
+    if part:
+        yield part
+
+
 class ConceptsImporter(object):
     def __init__(self, source, concepts_file, user, output_stream, error_stream, save_validation_errors=True, validation_logger=None):
         """ Initialize mapping importer """
@@ -70,6 +188,15 @@ class ConceptsImporter(object):
         self.source_version = SourceVersion.get_head_of(self.source)
         self.validation_logger = validation_logger
         self.save_validation_errors = save_validation_errors
+        self.update_if_exists = True
+        self.test_mode = False
+        self.content_hashes = {}
+        # Names of the concepts of the source, maintained during the import if the source has a custom validation schema
+        self.name_index = None
+        # Records the concept versions saved by the import, so that only those are reindexed
+        self.index_recorder = SearchIndexRecorder()
+        # Optional callable(data, update_action, message) notified of the outcome of every line
+        self.result_handler = None
 
         if self.save_validation_errors and self.validation_logger is None:
             self.validation_logger = ValidationLogger()
@@ -86,39 +213,186 @@ class ConceptsImporter(object):
         if flush:
             self.stderr.flush()
 
-    def import_concepts(self, new_version=False, total=0, test_mode=False, deactivate_old_records=False, **kwargs):
+    def import_concepts(self, new_version=False, total=0, test_mode=False, deactivate_old_records=False, chunk_size=None, workers=None, **kwargs):
         initial_signal_processor = haystack.signal_processor
         try:
             haystack.signal_processor.teardown()
             haystack.signal_processor = haystack.signals.BaseSignalProcessor
+            self.index_recorder.setup()
             import_start_time = datetime.now()
             self.info('Started import at {}'.format(import_start_time.strftime("%Y-%m-%dT%H:%M:%S")))
 
-            self.action_count = {}
-            self.test_mode = test_mode
             self.info('Import concepts to source...')
             self.handle_new_source_version(new_version)
 
-            # Load the JSON file line by line and import each line
-            self.user = User.objects.filter(is_superuser=True)[0]
-            self.concept_version_ids = set(self.source_version.get_concept_ids())
-
-            lines_handled = self.handle_lines_in_input_file(total)
+            if workers and workers > 1:
+                lines_handled = self.import_in_parallel(workers, test_mode, chunk_size)
+            else:
+                lines_handled = self.import_shard(total, test_mode, chunk_size)[0]
             self.output_unhandled_concept_version_ids()
             self.handle_deactivation__of_old_records(deactivate_old_records)  # Display final summary
             self.output_summary(lines_handled, total)
 
-            actions = self.action_count
-            update_index_required = actions.get(ImportActionHelper.IMPORT_ACTION_ADD, 0) > 0
-            update_index_required |= actions.get(ImportActionHelper.IMPORT_ACTION_UPDATE, 0) > 0
-
-            if update_index_required:
-                self.info('Indexing objects updated since {}'.format(import_start_time.strftime("%Y-%m-%dT%H:%M:%S")))
-                update_index.Command().handle(start_date=import_start_time.strftime("%Y-%m-%dT%H:%M:%S"), verbosity=2, workers=4, batchsize=100)
+            self.index_recorder.teardown()
+            self.info('Indexing %s objects saved by the import' % self.index_recorder.count())
+            self.index_recorder.update_index()
         finally:
+            self.index_recorder.teardown()
+            self.teardown_validation()
             haystack.signal_processor = initial_signal_processor
             haystack.signal_processor.setup()
 
+    def import_shard(self, total, test_mode=False, chunk_size=None):
+        """
+        Imports all lines of the input file. Returns the number of lines handled, the action counts,
+        the IDs of the concept versions that have been handled and the IDs of the objects to reindex.
+        """
+        self.prepare_import(test_mode, chunk_size)
+
+        # Load the JSON file line by line and import each line
+        self.user = User.objects.filter(is_superuser=True)[0]
+        concept_version_ids = set(self.concept_version_ids)
+
+        lines_handled = self.handle_lines_in_input_file(total)
+        return lines_handled, self.action_count, concept_version_ids - self.concept_version_ids, self.index_recorder.ids
+
+    def prepare_import(self, test_mode=False, chunk_size=None):
+        """ Resets the state of the importer before lines are imported """
+        self.action_count = {}
+        self.test_mode = test_mode
+        self.chunk_size = chunk_size
+        # New concept versions are associated with the HEAD version, as in Concept.persist_new
+        self.head_version = SourceVersion.get_head_of(self.source)
+        self.concept_version_ids = set(self.source_version.get_concept_ids())
+        self.content_hashes = self.load_content_hashes()
+        self.setup_validation()
+
+    def setup_validation(self):
+        """
+        Builds the custom validator of the source once for the whole import, with the reference values and the names
+        of the concepts of the source held in memory, and registers it so that concepts of the source validate with it.
+        """
+        self.teardown_validation()
+        schema = self.source.custom_validation_schema
+        if not schema:
+            return
+        self.name_index = SourceNameIndex.load(self.source)
+        validator = ValidatorSpecifier()\
+            .with_validation_schema(schema)\
+            .with_repo(self.source)\
+            .with_reference_values(frozen=True)\
+            .with_name_index(self.name_index)\
+            .get()
+        ValidatorSpecifier.register_import_scoped(self.source, validator)
+
+    def teardown_validation(self):
+        ValidatorSpecifier.unregister_import_scoped(self.source)
+        self.name_index = None
+
+    def index_names(self, concept_id, names):
+        """ Records the names of a concept as written, so that later lines are validated against them """
+        if self.name_index is not None:
+            self.name_index.set_names(concept_id, names)
+
+    def unindex_names(self, concept_id):
+        if self.name_index is not None:
+            self.name_index.remove(concept_id)
+
+    def load_content_hashes(self):
+        """ Returns the id and content hash of the latest version of every concept in the source, by mnemonic """
+        mnemonics = dict(Concept.objects.filter(parent_id=self.source.id).values_list('id', 'mnemonic'))
+        versions = ConceptVersion.objects.filter(
+            versioned_object_id__in=mnemonics.keys(), is_latest_version=True).values_list(
+            'versioned_object_id', 'id', 'content_hash')
+        return dict((mnemonics[concept_id], (version_id, content_hash))
+                    for concept_id, version_id, content_hash in versions if content_hash)
+
+    def is_unchanged(self, data):
+        """
+        Whether the line has the content of the latest version of its concept, judged by content hash alone.
+        An unchanged line is counted and marked as handled without being deserialized or diffed. Any other line
+        may change its concept, so the content hash of the concept is forgotten.
+        """
+        if not self.update_if_exists or not isinstance(data, dict):
+            return False
+        latest = self.content_hashes.pop(unicode(data.get('id')), None)
+        if latest is None:
+            return False
+        version_id, content_hash = latest
+        try:
+            if ConceptVersion.get_data_content_hash(data) != content_hash:
+                return False
+        except (AttributeError, TypeError, ValueError):
+            # Malformed names or descriptions are reported by the regular import
+            return False
+        self.content_hashes[unicode(data.get('id'))] = latest
+
+        self.concept_version_ids.discard(version_id)
+        self.count_action(ImportActionHelper.IMPORT_ACTION_NONE)
+        if self.result_handler:
+            self.result_handler(data, ImportActionHelper.IMPORT_ACTION_NONE, None)
+        return True
+
+    def import_in_parallel(self, workers, test_mode=False, chunk_size=None):
+        """
+        Splits the input file by a hash of the concept mnemonic, so that no two workers touch the same concept, and
+        concepts sharing names are validated by the same worker (see InputSharding), imports the shards in a pool of
+        worker processes and merges their results.
+        """
+        self.test_mode = test_mode
+        self.action_count = {}
+        self.concept_version_ids = set(self.source_version.get_concept_ids())
+        shard_file_names, shard_totals = self.split_input_file(workers)
+        error_file_names = [None] * workers
+        if self.save_validation_errors:
+            error_file_names = [file_name + '.errors.csv' for file_name in shard_file_names]
+
+        self.info('Importing %s shards of %s concepts in %d processes...' % (shard_totals, sum(shard_totals), workers))
+        close_db_connections()
+        pool = multiprocessing.Pool(workers, initializer=close_db_connections)
+        try:
+            results = [pool.apply_async(import_concepts_shard, (
+                self.source.id, self.source_version.id, shard_file_names[shard], shard_totals[shard],
+                error_file_names[shard], test_mode, chunk_size)) for shard in range(workers)]
+            pool.close()
+            pool.join()
+
+            lines_handled = 0
+            for result in results:
+                shard_lines_handled, shard_action_count, handled_ids, indexed_ids = result.get()
+                lines_handled += shard_lines_handled
+                ImportActionHelper.merge_action_count(self.action_count, shard_action_count)
+                self.concept_version_ids -= handled_ids
+                self.index_recorder.merge(indexed_ids)
+
+            if self.save_validation_errors:
+                for error_file_name in error_file_names:
+                    self.validation_logger.append_log(error_file_name)
+                self.validation_logger.close()
+        finally:
+            pool.terminate()
+            for file_name in shard_file_names + filter(None, error_file_names):
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+        return lines_handled
+
+    def split_input_file(self, shards):
+        shard_files = [tempfile.NamedTemporaryFile(prefix='concepts_shard_', suffix='.json', delete=False)
+                       for _ in range(shards)]
+        shard_totals = [0] * shards
+        sharding = InputSharding(shards)
+        try:
+            for line in self.concepts_file:
+                shard = sharding.shard_of(line)
+                shard_files[shard].write(line if line.endswith('\n') else line + '\n')
+                shard_totals[shard] += 1
+        finally:
+            for shard_file in shard_files:
+                shard_file.close()
+            self.concepts_file.close()
+        return [shard_file.name for shard_file in shard_files], shard_totals
+
     def output_unhandled_concept_version_ids(self):
         # Log remaining unhandled IDs
         self.info('Remaining %s unhandled concept versions' % len(self.concept_version_ids))
@@ -146,18 +420,34 @@ class ConceptsImporter(object):
 
         self.info('Deactivating old concepts...\n')
 
-        for version_id in self.concept_version_ids:
-            try:
-                self.remove_concept_version(version_id)
-                self.count_action(ImportActionHelper.IMPORT_ACTION_DEACTIVATE)
+        deactivated_ids, missing_ids = self.deactivate_concept_versions(self.concept_version_ids)
+        for version_id in missing_ids:
+            self.error('Failed to inactivate concept version on ID %s! '
+                       'Cannot deactivate concept version because it doesn\'t exist!\n' % version_id)
 
-                # Log the mapping deactivation
-                self.info('Deactivated concept version: %s\n' % version_id)
+        for version_id in deactivated_ids:
+            self.count_action(ImportActionHelper.IMPORT_ACTION_DEACTIVATE)
 
-            except InvalidStateException as exc:
-                self.error('Failed to inactivate concept version on ID %s! %s\n' % (version_id, exc.args[0]))
+            # Log the concept deactivation
+            self.info('Deactivated concept version: %s\n' % version_id)
 
     def handle_lines_in_input_file(self, total):
+        if self.chunk_size:
+            lines_handled = self.handle_chunks_in_input_file(total)
+        else:
+            lines_handled = self.handle_each_line_in_input_file(total)
+
+        # Done with the input file, so close it
+        self.concepts_file.close()
+        if self.validation_logger:
+            self.validation_logger.close()
+        # Import complete - display final progress bar
+        log = ImportActionHelper.get_progress_descriptor(
+            'concepts', lines_handled, total, self.action_count)
+        self.info(log, flush=True)
+        return lines_handled
+
+    def handle_each_line_in_input_file(self, total):
         lines_handled = 0
         for line in self.concepts_file:
             # Load the next JSON line
@@ -167,44 +457,275 @@ class ConceptsImporter(object):
 
             # Simple progress bar
             if (lines_handled % 100) == 0:
-                log = ImportActionHelper.get_progress_descriptor(
-                    'concepts', lines_handled, total, self.action_count)
-                self.stdout.write(log)
-                self.stdout.flush()
-                if (lines_handled % 1000) == 0:
-                    logger.info(log)
+                self.output_progress(lines_handled, total)
+        return lines_handled
 
-        # Done with the input file, so close it
-        self.concepts_file.close()
-        if self.validation_logger:
-            self.validation_logger.close()
-        # Import complete - display final progress bar
+    def handle_chunks_in_input_file(self, total):
+        """ Reads the input file chunk_size lines at a time and imports each chunk with bulk queries """
+        lines_handled = 0
+        chunk = []
+        for line in self.concepts_file:
+            lines_handled += 1
+            data = self.json_to_concept(line)
+            if data:
+                chunk.append(data)
+
+            if (lines_handled % self.chunk_size) == 0:
+                self.import_chunk(chunk)
+                chunk = []
+                self.output_progress(lines_handled, total)
+
+        if chunk:
+            self.import_chunk(chunk)
+        return lines_handled
+
+    def output_progress(self, lines_handled, total):
         log = ImportActionHelper.get_progress_descriptor(
             'concepts', lines_handled, total, self.action_count)
-        self.info(log, flush=True)
-        return lines_handled
+        self.stdout.write(log)
+        self.stdout.flush()
+        if (lines_handled % 1000) == 0:
+            logger.info(log)
+
+    def import_chunk(self, chunk):
+        chunk = [data for data in chunk if not self.is_unchanged(data)]
+        for part in split_on_repeated_mnemonics(chunk):
+            self.import_chunk_part(part)
+
+    def import_chunk_part(self, chunk):
+        """
+        Resolves the existing concepts and their latest versions for the whole chunk with one query each,
+        diffs and validates every line in memory and then writes the chunk with bulk inserts.
+        """
+        concepts, latest_versions = self.prefetch_chunk(chunk)
+        pending = []
+        for data in chunk:
+            self.try_import_concept(
+                data, lambda source, data: self.prepare_concept(source, data, concepts, latest_versions, pending))
+
+        try:
+            self.write_chunk(pending)
+        except Exception as exc:
+            for pending_concept in pending:
+                if pending_concept.update_action == ImportActionHelper.IMPORT_ACTION_ADD:
+                    self.unindex_names(pending_concept.concept.id)
+                elif pending_concept.update_action == ImportActionHelper.IMPORT_ACTION_UPDATE:
+                    self.index_names(pending_concept.concept.id, pending_concept.previous_version.names)
+                exc_message = unicode('%s\nFailed to write chunk: %s. Skipping it...\n' % (exc, pending_concept.data))
+                self.handle_exception(exc_message, pending_concept.data)
+            return
+
+        for pending_concept in pending:
+            self.try_import_concept(
+                pending_concept.data, lambda source, data: self.finish_pending_concept(pending_concept))
+
+    def prefetch_chunk(self, chunk):
+        mnemonics = [unicode(data['id']) for data in chunk if data.get('id')]
+        concepts = dict()
+        for concept in Concept.objects.filter(parent_id=self.source.id, mnemonic__in=mnemonics):
+            concept.parent = self.source
+            concepts[concept.mnemonic] = concept
+
+        latest_versions = dict()
+        if concepts:
+            versions = ConceptVersion.objects.filter(
+                versioned_object_id__in=[concept.id for concept in concepts.values()],
+                is_latest_version=True).order_by('created_at')
+            for version in versions:
+                latest_versions[version.versioned_object_id] = version
+        return concepts, latest_versions
+
+    def prepare_concept(self, source, data, concepts, latest_versions, pending):
+        """ Chunked counterpart of handle_concept. Actions are counted once the chunk has been written. """
+        mnemonic = data['id']
+        if not mnemonic:
+            raise IllegalInputException('Must specify concept id.')
+
+        concept = concepts.get(unicode(mnemonic))
+        if concept is None:
+            pending.append(self.prepare_new_concept(source, data))
+            return None
+        if not self.update_if_exists:
+            raise IllegalInputException('Concept %s already exists.' % mnemonic)
+
+        concept_version = latest_versions.get(concept.id)
+        if concept_version is None:
+            raise InvalidStateException(
+                "Source %s has concept %s, but source version %s does not." %
+                (source.mnemonic, concept.mnemonic, self.source_version.mnemonic))
+
+        pending.append(self.prepare_concept_version_update(concept, concept_version, data))
+
+        # Remove ID from the concept version list so that we know concept has been handled
+        if concept_version.id not in self.concept_version_ids:
+            self.error('Key not found. Could not remove key %s from list of concept version IDs: %s\n' % (concept_version.id, data))
+        else:
+            self.concept_version_ids.remove(concept_version.id)
+        return None
+
+    def prepare_new_concept(self, source, data):
+        """ Builds and validates a new concept and its initial version without saving them """
+        serializer = ConceptDetailSerializer(data=data, context={'request': MockRequest(self.user)})
+        if not serializer.is_valid():
+            raise IllegalInputException('Could not parse new concept %s' % data['id'])
+
+        concept = serializer.object
+        concept.created_by = self.user.username
+        concept.updated_by = self.user.username
+        concept.parent = source
+        concept.public_access = source.public_access
+        # Uniqueness within the source is known from the prefetch, so only fields and custom validation are checked
+        concept.clean_fields()
+        concept.clean()
+        concept.id = unicode(ObjectId())
+        # Later lines of the chunk are validated against the names of this one before the chunk is written
+        self.index_names(concept.id, concept.names)
+
+        version = ConceptVersion.for_concept(concept, '--TEMP--')
+        version.id = unicode(ObjectId())
+        version.mnemonic = version.id
+        version.root_version = version
+        version.released = True
+        version.extras = copy.deepcopy(concept.extras)
+        version.versioned_object = concept
+        version.source_version_ids = {self.head_version.id}
+
+        return PendingConcept(data, concept, version, ImportActionHelper.IMPORT_ACTION_ADD)
+
+    def prepare_concept_version_update(self, concept, concept_version, data):
+        """ Diffs and validates the line against the latest version without saving a new version """
+        concept_version.versioned_object = concept
+        clone = concept_version.clone()
+        serializer = ConceptVersionUpdateSerializer(
+            clone, data=data, context={'request': MockRequest(self.user)})
+        if not serializer.is_valid():
+            raise IllegalInputException(
+                'Could not parse concept to update: %s.' % concept_version.mnemonic)
+        diffs = ConceptVersion.diff(concept_version, clone)
+
+        # No diff, so do nothing
+        if not diffs:
+            self.store_missing_content_hash(concept_version)
+            return PendingConcept(data, concept, concept_version, ImportActionHelper.IMPORT_ACTION_NONE)
+
+        if 'names' in diffs:
+            diffs['names'] = {'is': data.get('names')}
+        if 'descriptions' in diffs:
+            diffs['descriptions'] = {'is': data.get('descriptions')}
+        clone.update_comment = json.dumps(diffs)
+        clone.versioned_object = concept
+        clone.clean()
+        if not concept_version.retired:
+            self.index_names(concept.id, clone.names)
+
+        clone.id = unicode(ObjectId())
+        clone.mnemonic = clone.id
+        clone.version_created_by = self.user.username
+        clone.source_version_ids = {self.head_version.id}
+
+        concept.extras = copy.deepcopy(clone.extras)
+        concept.names = clone.names
+        concept.descriptions = clone.descriptions
+        concept.concept_class = clone.concept_class
+        concept.datatype = clone.datatype
+
+        return PendingConcept(data, concept, clone, ImportActionHelper.IMPORT_ACTION_UPDATE, concept_version)
+
+    def write_chunk(self, pending):
+        """ Persists the new concepts and concept versions of a chunk with bulk inserts """
+        if self.test_mode:
+            return
+
+        new_concepts = [p.concept for p in pending if p.update_action == ImportActionHelper.IMPORT_ACTION_ADD]
+        new_versions = [p.version for p in pending if p.update_action != ImportActionHelper.IMPORT_ACTION_NONE]
+        updated = [p for p in pending if p.update_action == ImportActionHelper.IMPORT_ACTION_UPDATE]
+        if not new_versions:
+            return
+
+        for obj in new_concepts + new_versions:
+            prepare_for_bulk_insert(obj)
+        for version in new_versions:
+            version.update_content_hash()
+        if new_concepts:
+            Concept.objects.bulk_create(new_concepts)
+        ConceptVersion.objects.bulk_create(new_versions)
+        self.index_recorder.record(
+            ConceptVersion, [version.id for version in new_versions] + [p.previous_version.id for p in updated])
+
+        updated_at = datetime.now()
+        if updated:
+            # Replace the previous versions in the source version, as persist_clone would
+            ConceptVersion.objects.raw_update(
+                {'_id': {'$in': [ObjectId(p.previous_version.id) for p in updated]}},
+                {'$set': {'is_latest_version': False, 'updated_at': updated_at},
+                 '$pull': {'source_version_ids': self.head_version.id}})
+            for pending_concept in updated:
+                pending_concept.concept.save()
+            self.refresh_mapping_display_fields(updated)
+
+        SourceVersion.objects.filter(id=self.head_version.id).update(
+            active_concepts=F('active_concepts') + len(new_concepts), last_concept_update=updated_at,
+            last_child_update=updated_at, updated_at=updated_at)
+
+    def refresh_mapping_display_fields(self, updated):
+        """ Does for the renamed concepts of a chunk what persist_clone would, with one refresh for the chunk """
+        display_names = dict(
+            (p.concept.id, Concept.get_display_name_for(p.version)) for p in updated
+            if Concept.get_display_name_for(p.version) != Concept.get_display_name_for(p.previous_version))
+        if display_names:
+            self.index_recorder.record(MappingVersion, MappingVersion.refresh_display_fields(display_names))
+
+    def finish_pending_concept(self, pending_concept):
+        """ Logs a written line and applies its retired status, which is rare enough to be done line by line """
+        data = pending_concept.data
+        mnemonic = data['id']
+        concept_name = data['concept_class']
+        update_action = pending_concept.update_action
+        retire_action = ImportActionHelper.IMPORT_ACTION_NONE
 
-    def try_import_concept(self, data):
+        if update_action == ImportActionHelper.IMPORT_ACTION_ADD:
+            self.info('Created new concept: %s = %s\n' % (mnemonic, concept_name))
+        elif update_action == ImportActionHelper.IMPORT_ACTION_UPDATE:
+            self.info('Updated concept, replacing version ID %s: %s\n' % (pending_concept.previous_version.id, data))
+
+        # The latest version already carries the retired status of the line unless nothing else changed
+        if 'retired' in data and pending_concept.version.retired != data['retired']:
+            retire_action = self.update_concept_retired_status(pending_concept.concept, data['retired'])
+            if retire_action == ImportActionHelper.IMPORT_ACTION_RETIRE:
+                self.info('Retired concept: %s = %s\n' % (mnemonic, concept_name))
+            elif retire_action == ImportActionHelper.IMPORT_ACTION_UNRETIRE:
+                self.info('Un-retired concept: %s = %s\n' % (mnemonic, concept_name))
+
+        return update_action + retire_action
+
+    def try_import_concept(self, data, handler=None):
+        """ Imports a line with handler (handle_concept by default). A handler returning None defers counting. """
         if not data:
             return
+        if handler is None and self.is_unchanged(data):
+            return
+        handler = handler or self.handle_concept
         try:
-            update_action = self.handle_concept(self.source, data)
-            self.count_action(update_action)
+            update_action = handler(self.source, data)
+            if update_action is not None:
+                self.count_action(update_action)
+                if self.result_handler:
+                    self.result_handler(data, update_action, None)
         except IllegalInputException as exc:
             exc_message = unicode('%s\nFailed to parse line: %s. Skipping it...\n' % (exc.args[0], data))
-            self.handle_exception(exc_message)
+            self.handle_exception(exc_message, data)
         except InvalidStateException as exc:
             exc_message = unicode('Source is in an invalid state!\n%s\n%s\n' % (exc.args[0], data))
-            self.handle_exception(exc_message)
+            self.handle_exception(exc_message, data)
         except ValidationError as exc:
             if self.save_validation_errors:
                 self.validation_logger.append_concept(data, exc.messages)
 
             exc_message = unicode('%s\nValidation failed: %s. Skipping it...\n' % (''.join(exc.messages), data))
-            self.handle_exception(exc_message)
+            self.handle_exception(exc_message, data)
         except Exception as exc:
             exc_message = unicode('%s\nSomething unexpected occured: %s. Skipping it...\n' % (exc, data))
-            self.handle_exception(exc_message)
+            self.handle_exception(exc_message, data)
 
     def json_to_concept(self, line):
         data = None
@@ -217,9 +738,11 @@ class ConceptsImporter(object):
 
         return data
 
-    def handle_exception(self, exception_message):
+    def handle_exception(self, exception_message, data=None):
         self.error(exception_message)
         self.count_action(ImportActionHelper.IMPORT_ACTION_SKIP)
+        if self.result_handler and data:
+            self.result_handler(data, ImportActionHelper.IMPORT_ACTION_SKIP, exception_message)
 
     def create_new_source_version(self, new_version):
         new_source_version = SourceVersion.for_base_object(
@@ -243,6 +766,8 @@ class ConceptsImporter(object):
         # If concept exists, update the concept with the new data (ignoring retired status for now)
         try:
             concept = Concept.objects.get(parent_id=source.id, mnemonic=mnemonic)
+            if not self.update_if_exists:
+                raise IllegalInputException('Concept %s already exists.' % mnemonic)
             concept_version = ConceptVersion.objects.get(versioned_object_id=concept.id, is_latest_version=True)
             update_action = self.update_concept_version(concept_version, data)
 
@@ -298,6 +823,7 @@ class ConceptsImporter(object):
 
             if not serializer.is_valid():
                 raise ValidationError(serializer.errors)
+            self.index_names(serializer.object.id, serializer.object.names)
         return ImportActionHelper.IMPORT_ACTION_ADD
 
     def update_concept_version(self, concept_version, data):
@@ -324,11 +850,21 @@ class ConceptsImporter(object):
                 serializer.save()
                 if not serializer.is_valid():
                     raise ValidationError(serializer.errors)
+                if not concept_version.retired:
+                    self.index_names(concept_version.versioned_object_id, new_version.names)
             return ImportActionHelper.IMPORT_ACTION_UPDATE
 
         # No diff, so do nothing
+        self.store_missing_content_hash(concept_version)
         return ImportActionHelper.IMPORT_ACTION_NONE
 
+    def store_missing_content_hash(self, concept_version):
+        """ Hashes versions saved before content hashes were introduced, so that the next import can skip them """
+        if concept_version.content_hash or self.test_mode:
+            return
+        concept_version.update_content_hash()
+        ConceptVersion.objects.filter(id=concept_version.id).update(content_hash=concept_version.content_hash)
+
     def update_concept_retired_status(self, concept, new_retired_state):
         """ Updates and persists a new retired status for a concept """
 
@@ -343,31 +879,33 @@ class ConceptsImporter(object):
                 errors = Concept.retire(concept, self.user)
                 if errors:
                     raise IllegalInputException('Failed to retire concept due to %s' % errors)
+            self.unindex_names(concept.id)
             return ImportActionHelper.IMPORT_ACTION_RETIRE
         else:
             if not self.test_mode:
                 errors = Concept.unretire(concept, self.user)
                 if errors:
                     raise IllegalInputException('Failed to un-retire concept due to %s' % errors)
+            self.index_names(concept.id, concept_version.names)
             return ImportActionHelper.IMPORT_ACTION_UNRETIRE
 
-    def remove_concept_version(self, version_id):
-        """ Deactivates a concept """
-        version_query = ConceptVersion.objects.filter(id=version_id)
-
-        if version_query.count() is 0:
-            raise InvalidStateException(
-                "Cannot deactivate concept version %s because it doesn't exist!" % version_id)
-
-        version = version_query.get()
-        if not version.is_active:
-            return ImportActionHelper.IMPORT_ACTION_NONE
-
-        if not self.test_mode:
-            version.is_active = False
-            version.save()
-
-        return ImportActionHelper.IMPORT_ACTION_DEACTIVATE
+    def deactivate_concept_versions(self, version_ids):
+        """
+        Deactivates the active ones of the concept versions with a single update. Returns the IDs of the versions
+        that have been deactivated and of those that do not exist. The versions are reindexed with the other
+        objects saved by the import.
+        """
+        version_ids = list(version_ids)
+        active = dict(ConceptVersion.objects.filter(id__in=version_ids).values_list('id', 'is_active'))
+        missing_ids = [version_id for version_id in version_ids if version_id not in active]
+
+        deactivated_ids = [version_id for version_id in version_ids if active.get(version_id)]
+        if deactivated_ids and not self.test_mode:
+            ConceptVersion.objects.raw_update(
+                {'_id': {'$in': [ObjectId(version_id) for version_id in deactivated_ids]}},
+                {'$set': {'is_active': False, 'updated_at': datetime.now()}})
+            self.index_recorder.record(ConceptVersion, deactivated_ids)
+        return deactivated_ids, missing_ids
 
     def count_action(self, update_action):
         """ Increments the counter for the specified action """
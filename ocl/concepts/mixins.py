@@ -79,7 +79,7 @@ class ConceptValidationMixin:
 
         schema = self.parent_source.custom_validation_schema
         if schema:
-            custom_validator = ValidatorSpecifier()\
+            custom_validator = ValidatorSpecifier.get_import_scoped(self.parent_source) or ValidatorSpecifier()\
                 .with_validation_schema(schema)\
                 .with_repo(self.parent_source)\
                 .with_reference_values()\
@@ -16,6 +16,8 @@ from oclapi.models import (ConceptBaseModel, ResourceVersionModel,
                            VERSION_TYPE, ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW)
 from sources.models import SourceVersion, Source
 from oclapi.settings.common import Common
+from oclapi.utils import get_content_hash
+from tasks import update_mapping_display_fields
 
 class LocalizedText(models.Model):
     uuid = UUIDField(auto=True)
@@ -49,6 +51,21 @@ class LocalizedText(models.Model):
 
 CONCEPT_TYPE = 'Concept'
 
+TRUE_VALUES = [True, 'True', 'true', 'TRUE']
+
+
+def get_localized_texts_content(texts):
+    """ Content of a list of names or descriptions, as hashed for ConceptVersion.content_hash """
+    return sorted([text.name, text.locale, text.locale_preferred, text.type, text.external_id or None]
+                  for text in texts or [])
+
+
+def get_localized_texts_data_content(texts, name_attr):
+    """ Content of the names or descriptions of an import line, read as LocalizedTextListField does """
+    return sorted([text.get(name_attr), text.get('locale'), text.get('locale_preferred', False) in TRUE_VALUES,
+                   text.get('%s_type' % name_attr), text.get('external_id') or None]
+                  for text in texts or [])
+
 
 class Concept(ConceptValidationMixin, ConceptBaseModel, DictionaryItemMixin):
 
@@ -276,14 +293,56 @@ class ConceptVersion(ConceptValidationMixin, ResourceVersionModel):
     version_created_by = models.TextField()
     update_comment = models.TextField(null=True, blank=True)
     source_version_ids = SetField()
+    content_hash = models.TextField(null=True, blank=True)
 
     class MongoMeta:
         indexes = [[ ('uri', 1) ],
                    [('versioned_object_id', 1), ('is_latest_version', 1), ('created_at', -1)],
-                   [('source_version_ids', 1), ('updated_at', -1)]]
+                   [('source_version_ids', 1), ('updated_at', -1)],
+                   [('source_version_ids', 1), ('is_active', 1), ('id', 1)]]
 
     objects = MongoDBManager()
 
+    def save(self, *args, **kwargs):
+        self.update_content_hash()
+        super(ConceptVersion, self).save(*args, **kwargs)
+
+    def update_content_hash(self):
+        self.content_hash = get_content_hash(self.get_content())
+
+    def get_content(self):
+        """ The content an import line is compared against, see get_data_content """
+        return dict(
+            concept_class=self.concept_class,
+            datatype=self.datatype,
+            external_id=self.external_id,
+            retired=self.retired,
+            extras=self.get_decoded_extras(),
+            names=get_localized_texts_content(self.names),
+            descriptions=get_localized_texts_content(self.descriptions),
+        )
+
+    @classmethod
+    def get_data_content(cls, data):
+        """
+        Content of an import line in the form of get_content, so that a line whose hash equals the content hash
+        of the latest version would not change the concept. Values are not coerced: a line that differs only
+        in representation hashes differently and is diffed as usual.
+        """
+        return dict(
+            concept_class=data.get('concept_class'),
+            datatype=data.get('datatype'),
+            external_id=data.get('external_id'),
+            retired=data.get('retired', False),
+            extras=data.get('extras') or {},
+            names=get_localized_texts_data_content(data.get('names'), 'name'),
+            descriptions=get_localized_texts_data_content(data.get('descriptions'), 'description'),
+        )
+
+    @classmethod
+    def get_data_content_hash(cls, data):
+        return get_content_hash(cls.get_data_content(data))
+
     def clone(self):
         concept_version = ConceptVersion(
             mnemonic='--TEMP--',
@@ -546,6 +605,9 @@ class ConceptVersion(ConceptValidationMixin, ResourceVersionModel):
                 if obj.id:
                     obj.delete()
                 errors['non_field_errors'] = ['An error occurred while %s.' % errored_action]
+
+        if persisted and Concept.get_display_name_for(obj) != Concept.get_display_name_for(previous_version):
+            update_mapping_display_fields.delay(obj.versioned_object_id)
         return errors
 
     @classmethod
@@ -1,6 +1,7 @@
 from django.contrib.contenttypes.models import ContentType
 from haystack import indexes
-from concepts.models import ConceptVersion
+from collection.models import CollectionVersion, CollectionConcept
+from concepts.models import Concept, ConceptVersion
 from oclapi.search_backends import SortOrFilterField, FilterField
 from oclapi.search_indexes import OCLSearchIndex
 from sources.models import SourceVersion, Source
@@ -44,6 +45,21 @@ class ConceptVersionIndex(OCLSearchIndex, indexes.Indexable):
     def get_model(self):
         return ConceptVersion
 
+    def prepare_batch(self, objects):
+        concepts = dict((concept.id, concept) for concept in Concept.objects.filter(
+            id__in=list(set(obj.versioned_object_id for obj in objects))))
+        sources = Source.get_sources_with_owners(set(concept.parent_id for concept in concepts.values()))
+        for concept in concepts.values():
+            if concept.parent_id in sources:
+                concept.parent = sources[concept.parent_id]
+
+        collection_version_ids, collection_ids = CollectionVersion.get_collection_ids_by_child(
+            CollectionConcept, 'concept_id', [obj.id for obj in objects])
+        for obj in objects:
+            if obj.versioned_object_id in concepts:
+                obj.versioned_object = concepts[obj.versioned_object_id]
+            obj.cache_collection_ids(collection_version_ids[obj.id], collection_ids[obj.id])
+
     def prepare_locale(self, obj):
         locales = set()
         if obj.names:
@@ -7,6 +7,7 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import json
 import logging
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
@@ -17,9 +18,13 @@ from concepts.validation_messages import OPENMRS_ONE_FULLY_SPECIFIED_NAME_PER_LO
     OPENMRS_SHORT_NAME_CANNOT_BE_PREFERRED, OPENMRS_DESCRIPTION_LOCALE, OPENMRS_NAME_LOCALE, OPENMRS_DESCRIPTION_TYPE, \
     OPENMRS_NAME_TYPE, OPENMRS_DATATYPE, OPENMRS_CONCEPT_CLASS, BASIC_DESCRIPTION_CANNOT_BE_EMPTY, \
     OPENMRS_PREFERRED_NAME_UNIQUE_PER_SOURCE_LOCALE, OPENMRS_AT_LEAST_ONE_FULLY_SPECIFIED_NAME
+from concepts.export import ConceptVersionExportEncoder
+from concepts.search_indexes import ConceptVersionIndex
+from concepts.serializers import ConceptVersionDetailSerializer
 from concepts.validators import ValidatorSpecifier
 from concepts.views import ConceptVersionListView
 from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS
+from rest_framework.utils import encoders
 from test_helper.base import *
 
 logger = logging.getLogger('oclapi')
@@ -1178,6 +1183,29 @@ class ConceptVersionTest(ConceptBaseTest):
         self.assertEquals(concept_version.get_collection_version_ids()[1],
                           CollectionVersion.objects.get(mnemonic='version1').id)
 
+    def test_collection_ids_prepared_for_a_batch(self):
+        collection = Collection(name='collection2', mnemonic='collection2', full_name='Collection Two',
+                                collection_type='Dictionary', public_access=ACCESS_TYPE_EDIT, default_locale='en',
+                                supported_locales=['en'])
+        Collection.persist_new(collection, self.user1, parent_resource=self.userprofile1)
+        (concept, errors) = create_concept(mnemonic='concept12', user=self.user1, source=self.source1)
+        (other_concept, errors) = create_concept(mnemonic='concept13', user=self.user1, source=self.source1)
+        collection.expressions = ['/orgs/org1/sources/source1/concepts/concept12/']
+        collection.full_clean()
+        collection.save()
+        CollectionVersion.persist_new(CollectionVersion.for_base_object(collection, 'version1'))
+
+        concept_versions = list(ConceptVersion.objects.filter(versioned_object_id__in=[concept.id, other_concept.id]))
+        expected = [(version.get_collection_version_ids(), version.get_collection_ids())
+                    for version in concept_versions]
+        self.assertEquals(len(expected[0][0]) + len(expected[1][0]), 2)
+
+        ConceptVersionIndex().prepare_batch(concept_versions)
+        self.assertEquals([(version.get_collection_version_ids(), version.get_collection_ids())
+                           for version in concept_versions], expected)
+        self.assertEquals([version.versioned_object.parent.owner_name for version in concept_versions],
+                          ['org1', 'org1'])
+
     def test_create_concept_version_special_characters(self):
         # period in mnemonic
         create_concept(mnemonic='version.1', user=self.user1, source=self.source1)
@@ -1330,6 +1358,8 @@ class ConceptVersionListViewTest(ConceptBaseTest):
         self.assertEquals(csv_rows[0].get('Retired'), False)
         self.assertEquals(csv_rows[0].get('Datatype'), "None")
         self.assertEquals(csv_rows[0].get('Concept ID'), concept.mnemonic)
+        self.assertEquals(unicode(csv_rows[0].get('Owner')), self.source1.owner_name)
+        self.assertEquals(csv_rows[0].get('Source'), self.source1.mnemonic)
         self.assertEquals(csv_rows[0].get('External ID'), None)
         self.assertEquals(csv_rows[0].get('URI'), concept_version.uri)
         self.assertEquals(csv_rows[0].get('Synonyms'), 'concept1 [FULLY_SPECIFIED] [en]')
@@ -1637,3 +1667,21 @@ class ValidatorSpecifierTest(ConceptBaseTest):
         self.assertItemsEqual(expected_reference_values[u'Classes'], actual_reference_values[u'Classes'])
         self.assertItemsEqual(expected_reference_values[u'Locales'], actual_reference_values[u'Locales'])
         self.assertItemsEqual(expected_reference_values[u'NameTypes'], actual_reference_values[u'NameTypes'])
+
+
+class ConceptVersionExportEncoderTest(ConceptBaseTest):
+    def test_encode_batch_should_match_serializer(self):
+        create_concept(mnemonic='concept1', user=self.user1, source=self.source1, extras={'dotted.key': 'value'},
+                       names=[create_localized_text('concept1'),
+                              LocalizedText(name='en', locale='en', type='ISO 639-1')])
+        create_concept(mnemonic='concept2', user=self.user1, source=self.source1)
+        create_concept(mnemonic='concept3', user=self.user1, source=self.source2)
+        versions = ConceptVersion.objects.filter(
+            versioned_object_id__in=Concept.objects.values_list('id', flat=True)).order_by('id')
+        ids = list(versions.values_list('id', flat=True))
+
+        serialized = json.dumps(ConceptVersionDetailSerializer(versions, many=True).data, cls=encoders.JSONEncoder)
+        encoded = json.dumps(ConceptVersionExportEncoder().encode_batch(ids), cls=encoders.JSONEncoder)
+
+        self.assertEquals(3, len(ids))
+        self.assertEquals(serialized, encoded)
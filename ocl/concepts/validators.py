@@ -18,7 +18,61 @@ def message_with_name_details(message, name):
     preferred = 'yes' if name.locale_preferred else 'no'
     return unicode(u'{}: {} (locale: {}, preferred: {})'.format(message, unicode(name_str), locale, preferred))
 
+
+class SourceNameIndex(object):
+    """
+    In-memory (locale, name, type) index of the names of the active, non-retired concepts of a source,
+    so that the uniqueness of names within the source can be checked without querying the concepts.
+    """
+    SHORT_NAME_TYPES = frozenset(['SHORT', 'Short'])
+
+    def __init__(self):
+        # (locale, name) -> type -> IDs of the concepts having the name
+        self.names = dict()
+        # Concept ID -> (locale, name, type) keys of the names of the concept
+        self.keys = dict()
+
+    @classmethod
+    def load(cls, source):
+        """ Returns the index of the names of the source, loaded with a single query """
+        from concepts.models import Concept
+        index = cls()
+        for concept in Concept.objects.filter(parent_id=source.id, is_active=True, retired=False):
+            index.set_names(concept.id, concept.names)
+        return index
+
+    def set_names(self, concept_id, names):
+        """ Replaces the names of the concept in the index """
+        self.remove(concept_id)
+        keys = set((name.locale, name.name, name.type) for name in names or [])
+        for locale, name, name_type in keys:
+            self.names.setdefault((locale, name), dict()).setdefault(name_type, set()).add(concept_id)
+        self.keys[concept_id] = keys
+
+    def remove(self, concept_id):
+        """ Removes the names of a concept that has been retired, or that has not been written after all """
+        for locale, name, name_type in self.keys.pop(concept_id, ()):
+            types = self.names[(locale, name)]
+            types[name_type].discard(concept_id)
+            if not types[name_type]:
+                del types[name_type]
+            if not types:
+                del self.names[(locale, name)]
+
+    def other_concept_has_name(self, name, concept_id):
+        """ Whether a concept other than concept_id has a name other than a short name with the locale and name """
+        for name_type, concept_ids in self.names.get((name.locale, name.name), {}).iteritems():
+            if name_type in self.SHORT_NAME_TYPES:
+                continue
+            if concept_ids - set([concept_id]):
+                return True
+        return False
+
+
 class ValidatorSpecifier:
+    # Validators built by importers once per source for the duration of an import, by source ID
+    import_scoped_validators = dict()
+
     def __init__(self):
         from concepts.custom_validators import OpenMRSConceptValidator
         self.validator_map = {
@@ -26,6 +80,20 @@ class ValidatorSpecifier:
         }
         self.reference_values = dict()
         self.repo = None
+        self.name_index = None
+
+    @classmethod
+    def get_import_scoped(cls, repo):
+        """ Returns the validator registered for the repo by a running import, if any """
+        return cls.import_scoped_validators.get(repo.id)
+
+    @classmethod
+    def register_import_scoped(cls, repo, validator):
+        cls.import_scoped_validators[repo.id] = validator
+
+    @classmethod
+    def unregister_import_scoped(cls, repo):
+        cls.import_scoped_validators.pop(repo.id, None)
 
     def with_validation_schema(self, schema):
         self.validation_schema = schema
@@ -36,7 +104,12 @@ class ValidatorSpecifier:
 
         return self
 
-    def with_reference_values(self):
+    def with_name_index(self, name_index):
+        self.name_index = name_index
+
+        return self
+
+    def with_reference_values(self, frozen=False):
         from orgs.models import Organization
         from sources.models import Source
 
@@ -55,7 +128,7 @@ class ValidatorSpecifier:
             if not cache.has_key(source.mnemonic):
                 cache.set(source.mnemonic,self._get_reference_values(source), FIVE_MINS)
             reference_values = cache.get(source.mnemonic)
-            self.reference_values[source.mnemonic] = reference_values
+            self.reference_values[source.mnemonic] = frozenset(reference_values) if frozen else reference_values
 
         return self
 
@@ -70,7 +143,8 @@ class ValidatorSpecifier:
 
         kwargs = {
             'repo': self.repo,
-            'reference_values': self.reference_values
+            'reference_values': self.reference_values,
+            'name_index': self.name_index
         }
 
         return validator_class(**kwargs)
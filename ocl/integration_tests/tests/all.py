@@ -2514,6 +2514,52 @@ class SourceVersionExportViewTest(SourceBaseTest):
             self.fail('Second response must be 202 or 409')
 
 
+    @mock_s3
+    def test_post_export_with_unknown_base_version_or_format(self):
+        source = Source(
+            name='source',
+            mnemonic='source',
+            full_name='Source One',
+            source_type='Dictionary',
+            public_access=ACCESS_TYPE_EDIT,
+            default_locale='en',
+            supported_locales=['en'],
+            website='www.source1.com',
+            description='This is the first test source'
+        )
+
+        kwargs = {
+            'parent_resource': self.org1
+        }
+        Source.persist_new(source, self.user1, **kwargs)
+
+        source_version = SourceVersion(
+            name='version1',
+            mnemonic='version1',
+            versioned_object=source,
+            released=True,
+            created_by=self.user1,
+            updated_by=self.user1
+        )
+        SourceVersion.persist_new(source_version, self.user1)
+
+        self.client.login(username=self.user1.username, password=self.user1.password)
+
+        kwargs = {
+            'org': self.org1.mnemonic,
+            'source': source.mnemonic,
+            'version': 'version1'
+        }
+        uri = reverse('sourceversion-export', kwargs=kwargs)
+        response = self.client.post(uri + '?base=versionnotexist')
+        self.assertEquals(response.status_code, 404)
+
+        response = self.client.post(uri + '?base=HEAD')
+        self.assertEquals(response.status_code, 405)
+
+        response = self.client.post(uri + '?export_format=xml')
+        self.assertEquals(response.status_code, 400)
+
     @mock_s3
     def test_post_with_same_version_name_in_more_than_one_source(self):
         source1 = Source(
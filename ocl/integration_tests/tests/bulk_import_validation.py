@@ -1,19 +1,26 @@
+import json
+from StringIO import StringIO
+
 from django.contrib.auth.models import User
 
-from concepts.importer import ConceptsImporter, ValidationLogger
+from concepts.importer import ConceptsImporter, ValidationLogger, InputSharding, shard_of
 from concepts.validation_messages import OPENMRS_NAMES_EXCEPT_SHORT_MUST_BE_UNIQUE, OPENMRS_MUST_HAVE_EXACTLY_ONE_PREFERRED_NAME, \
     OPENMRS_SHORT_NAME_CANNOT_BE_PREFERRED, OPENMRS_PREFERRED_NAME_UNIQUE_PER_SOURCE_LOCALE, \
     OPENMRS_AT_LEAST_ONE_FULLY_SPECIFIED_NAME, OPENMRS_FULLY_SPECIFIED_NAME_UNIQUE_PER_SOURCE_LOCALE
 from concepts.models import Concept, ConceptVersion
 from concepts.tests import ConceptBaseTest
+from concepts.validators import ValidatorSpecifier
 from integration_tests.models import TestStream
-from mappings.importer import MappingsImporter
+from manage.imports.checkpoint import ImportCheckpoint
+from manage.imports.flex_importer import FlexImporter
+from mappings.importer import MappingsImporter, MappingsIndex
 from mappings.models import Mapping
 from mappings.models import MappingVersion
 from mappings.tests import MappingBaseTest
 from sources.models import SourceVersion
+from oclapi.management.commands import ImportActionHelper
 from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS, LOOKUP_CONCEPT_CLASSES
-from test_helper.base import create_source, create_user, create_concept
+from test_helper.base import create_source, create_user, create_concept, create_mapping
 
 
 class BulkConceptImporterTest(ConceptBaseTest):
@@ -47,6 +54,59 @@ class BulkConceptImporterTest(ConceptBaseTest):
         self.assertEquals(5, Concept.objects.exclude(concept_class__in=LOOKUP_CONCEPT_CLASSES).count())
         self.assertEquals(5, ConceptVersion.objects.exclude(concept_class__in=LOOKUP_CONCEPT_CLASSES).count())
 
+    def test_import_concepts_with_invalid_records_in_chunks(self):
+        self.testfile = open('./integration_tests/fixtures/valid_invalid_concepts.json', 'rb')
+        stderr_stub = TestStream()
+        source = create_source(self.user1, validation_schema=CUSTOM_VALIDATION_SCHEMA_OPENMRS)
+        importer = ConceptsImporter(source, self.testfile, 'test', TestStream(), stderr_stub, save_validation_errors=False)
+        importer.import_concepts(total=7, chunk_size=10)
+        self.assertTrue(OPENMRS_AT_LEAST_ONE_FULLY_SPECIFIED_NAME in stderr_stub.getvalue())
+        # The duplicate name is in the same chunk as the concept it duplicates
+        self.assertTrue(OPENMRS_FULLY_SPECIFIED_NAME_UNIQUE_PER_SOURCE_LOCALE in stderr_stub.getvalue())
+        self.assertEquals(5, Concept.objects.exclude(concept_class__in=LOOKUP_CONCEPT_CLASSES).count())
+        self.assertEquals(5, ConceptVersion.objects.exclude(concept_class__in=LOOKUP_CONCEPT_CLASSES).count())
+        self.assertIsNone(ValidatorSpecifier.get_import_scoped(source))
+
+    def test_import_concepts_with_invalid_records_in_parallel(self):
+        self.testfile = open('./integration_tests/fixtures/valid_invalid_concepts.json', 'rb')
+        stdout_stub = TestStream()
+        source = create_source(self.user1, validation_schema=CUSTOM_VALIDATION_SCHEMA_OPENMRS)
+        importer = ConceptsImporter(source, self.testfile, 'test', stdout_stub, TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=7, workers=2)
+        self.assertTrue('**** Processed 7 out of 7 concepts' in stdout_stub.getvalue())
+        self.assertEquals(5, importer.action_count.get(ImportActionHelper.IMPORT_ACTION_ADD))
+        self.assertEquals(5, Concept.objects.exclude(concept_class__in=LOOKUP_CONCEPT_CLASSES).count())
+        self.assertEquals(5, ConceptVersion.objects.exclude(concept_class__in=LOOKUP_CONCEPT_CLASSES).count())
+
+    def test_import_concepts_in_parallel_deactivates_missing_records(self):
+        self.testfile = open('./integration_tests/fixtures/valid_invalid_concepts.json', 'rb')
+        stdout_stub = TestStream()
+        source = create_source(self.user1, validation_schema=CUSTOM_VALIDATION_SCHEMA_OPENMRS)
+        (concept, _) = create_concept(mnemonic='missing', user=self.user1, source=source)
+        missing_version = ConceptVersion.get_latest_version_of(concept)
+
+        importer = ConceptsImporter(source, self.testfile, 'test', stdout_stub, TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=7, workers=2, deactivate_old_records=True)
+        self.assertFalse(ConceptVersion.objects.get(id=missing_version.id).is_active)
+        self.assertEquals(importer.action_count.get(ImportActionHelper.IMPORT_ACTION_DEACTIVATE), 1)
+        self.assertTrue(('Deactivated concept version: ' + missing_version.id) in stdout_stub.getvalue())
+
+    def test_import_concepts_sharing_a_name_in_parallel(self):
+        with open('./integration_tests/fixtures/valid_invalid_concepts.json', 'rb') as testfile:
+            data = json.loads(testfile.readline())
+        lines = [json.dumps(dict(data, id=mnemonic)) for mnemonic in map(str, range(20))]
+        # Concepts whose mnemonics hash to different shards
+        lines = [[line for line in lines if shard_of(line, 2) == shard][0] for shard in range(2)]
+        sharding = InputSharding(2)
+        self.assertEquals(sharding.shard_of(lines[0]), sharding.shard_of(lines[1]))
+
+        source = create_source(self.user1, validation_schema=CUSTOM_VALIDATION_SCHEMA_OPENMRS)
+        importer = ConceptsImporter(source, StringIO('\n'.join(lines)), 'test', TestStream(), TestStream(),
+                                    save_validation_errors=False)
+        importer.import_concepts(total=2, workers=2)
+        self.assertEquals(1, importer.action_count.get(ImportActionHelper.IMPORT_ACTION_ADD))
+        self.assertEquals(1, Concept.objects.exclude(concept_class__in=LOOKUP_CONCEPT_CLASSES).count())
+
     def test_update_concept_with_invalid_record(self):
         (concept, _) = create_concept(mnemonic='1', user=self.user1, source=self.source1, names=[self.name])
 
@@ -146,6 +206,98 @@ class ConceptImporterTest(ConceptBaseTest):
 
         self.assertTrue(('Updated concept, replacing version ID ' + latest_concept_version.previous_version.id) in stdout_stub.getvalue())
         self.assertTrue('**** Processed 1 out of 1 concepts - 1 updated, ****' in stdout_stub.getvalue())
+        self.assertItemsEqual(importer.index_recorder.ids[ConceptVersion],
+                              [latest_concept_version.id, latest_concept_version.previous_version.id])
+
+    def test_import_job_for_unchanged_record(self):
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', TestStream(), TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1)
+        inserted_concept_version = ConceptVersion.objects.get(versioned_object_id=Concept.objects.get(mnemonic='1').id)
+        with open('./integration_tests/fixtures/one_concept.json', 'rb') as testfile:
+            data = json.loads(testfile.read())
+        self.assertEquals(inserted_concept_version.content_hash, ConceptVersion.get_data_content_hash(data))
+
+        for chunk_size in [None, 10]:
+            stdout_stub = TestStream()
+            importer = ConceptsImporter(self.source1, open('./integration_tests/fixtures/one_concept.json', 'rb'), 'test',
+                                        stdout_stub, TestStream(), save_validation_errors=False)
+            importer.import_concepts(total=1, chunk_size=chunk_size)
+            self.assertEquals(importer.action_count, {ImportActionHelper.IMPORT_ACTION_NONE: 1})
+            self.assertEquals(len(importer.concept_version_ids), 0)
+        self.assertEquals(ConceptVersion.objects.filter(versioned_object_id=inserted_concept_version.versioned_object_id).count(), 1)
+
+    def test_import_job_deactivates_missing_records(self):
+        (concept, _) = create_concept(mnemonic='2', user=self.user1, source=self.source1)
+        missing_version = ConceptVersion.get_latest_version_of(concept)
+
+        stdout_stub = TestStream()
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', stdout_stub, TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1, deactivate_old_records=True)
+
+        self.assertFalse(ConceptVersion.objects.get(id=missing_version.id).is_active)
+        self.assertEquals(importer.action_count.get(ImportActionHelper.IMPORT_ACTION_DEACTIVATE), 1)
+        self.assertTrue(('Deactivated concept version: ' + missing_version.id) in stdout_stub.getvalue())
+        self.assertTrue(missing_version.id in importer.index_recorder.ids[ConceptVersion])
+
+    def test_import_job_in_chunks_refreshes_display_names_of_mappings(self):
+        (concept, _) = create_concept(mnemonic='1', user=self.user1, source=self.source1)
+        (other_concept, _) = create_concept(mnemonic='2', user=self.user1, source=self.source1)
+        mapping = create_mapping(self.user1, self.source1, concept, other_concept)
+        mapping_version = MappingVersion.objects.get(versioned_object_id=mapping.id)
+        self.assertNotEquals(mapping_version.from_concept_display_name, 'Anemia due to Blood Loss')
+
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', TestStream(), TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1, chunk_size=10)
+
+        self.assertEquals(MappingVersion.objects.get(id=mapping_version.id).from_concept_display_name,
+                          'Anemia due to Blood Loss')
+        self.assertTrue(mapping_version.id in importer.index_recorder.ids[MappingVersion])
+
+    def test_deactivate_concept_versions_reports_missing_ones(self):
+        (concept, _) = create_concept(mnemonic='2', user=self.user1, source=self.source1)
+        version = ConceptVersion.get_latest_version_of(concept)
+        missing_id = '000000000000000000000000'
+
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', TestStream(), TestStream(), save_validation_errors=False)
+        deactivated_ids, missing_ids = importer.deactivate_concept_versions([missing_id, version.id])
+
+        self.assertEquals(deactivated_ids, [version.id])
+        self.assertEquals(missing_ids, [missing_id])
+        self.assertFalse(ConceptVersion.objects.get(id=version.id).is_active)
+
+    def test_import_job_for_one_record_in_chunks(self):
+        stdout_stub = TestStream()
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', stdout_stub, TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1, chunk_size=10)
+        self.assertTrue('Created new concept: 1 = Diagnosis' in stdout_stub.getvalue())
+        inserted_concept = Concept.objects.get(mnemonic='1')
+        self.assertEquals(inserted_concept.parent, self.source1)
+        inserted_concept_version = ConceptVersion.objects.get(versioned_object_id=inserted_concept.id)
+        self.assertEquals(inserted_concept_version.mnemonic, inserted_concept_version.id)
+        self.assertEquals(inserted_concept_version.root_version, inserted_concept_version)
+        source_version_latest = SourceVersion.get_latest_version_of(self.source1)
+
+        self.assertItemsEqual(source_version_latest.get_concept_ids(), [inserted_concept_version.id])
+
+    def test_import_job_for_change_in_data_in_chunks(self):
+        stdout_stub = TestStream()
+        create_concept(mnemonic='1', user=self.user1, source=self.source1)
+
+        importer = ConceptsImporter(self.source1, self.testfile, 'test', stdout_stub, TestStream(), save_validation_errors=False)
+        importer.import_concepts(total=1, chunk_size=10)
+        all_concept_versions = ConceptVersion.objects.exclude(concept_class__in=LOOKUP_CONCEPT_CLASSES)
+        self.assertEquals(len(all_concept_versions), 2)
+
+        latest_concept_version = [version for version in all_concept_versions if version.previous_version][0]
+        self.assertTrue(latest_concept_version.is_latest_version)
+        self.assertFalse(latest_concept_version.previous_version.is_latest_version)
+        self.assertEquals(len(latest_concept_version.names), 4)
+        self.assertItemsEqual(SourceVersion.get_latest_version_of(self.source1).get_concept_ids(), [latest_concept_version.id])
+
+        self.assertTrue(('Updated concept, replacing version ID ' + latest_concept_version.previous_version.id) in stdout_stub.getvalue())
+        self.assertTrue('**** Processed 1 out of 1 concepts - 1 updated, ****' in stdout_stub.getvalue())
+        self.assertItemsEqual(importer.index_recorder.ids[ConceptVersion],
+                              [latest_concept_version.id, latest_concept_version.previous_version.id])
 
 
 class MappingImporterTest(MappingBaseTest):
@@ -175,6 +327,28 @@ class MappingImporterTest(MappingBaseTest):
         mapping_version = MappingVersion.objects.get(versioned_object_id=inserted_mapping.id, is_latest_version=True)
         self.assertEquals(mapping_ids[0], mapping_version.id)
 
+    def test_import_job_for_same_record_twice(self):
+        importer = MappingsImporter(self.source1, self.testfile, TestStream(), TestStream(), 'test')
+        importer.import_mappings(total=1)
+        stdout_stub = TestStream()
+        importer = MappingsImporter(self.source1, open('./integration_tests/fixtures/one_mapping.json', 'rb'), stdout_stub, TestStream(), 'test')
+        importer.import_mappings(total=1)
+
+        self.assertEquals(1, Mapping.objects.filter(to_concept_code='413532003').count())
+        self.assertFalse('Created new mapping:' in stdout_stub.getvalue())
+        self.assertEquals(importer.action_count, {ImportActionHelper.IMPORT_ACTION_NONE: 1})
+
+    def test_mappings_index(self):
+        index = MappingsIndex(self.source1)
+        self.assertEquals(self.concept1.id, index.get_concept_id(self.concept1.uri))
+        self.assertEquals(self.concept3.id, index.get_concept_id(self.concept3.uri))
+        self.assertIsNone(index.get_concept_id(self.source1.uri + 'concepts/missing/'))
+
+        index.add_mapping('mapping1', self.concept1.id, self.concept3.id, None, None, None, 'SAME-AS')
+        self.assertEquals('mapping1', index.find_mapping(self.concept1.id, self.concept3.id, None, None, None, 'SAME-AS'))
+        self.assertTrue(index.is_duplicate(self.concept1.id, self.concept3.id, None, None, 'SAME-AS'))
+        self.assertFalse(index.is_duplicate(self.concept1.id, self.concept3.id, None, None, 'NARROWER-THAN'))
+
     def test_import_job_for_one_invalid_record(self):
         stdout_stub = TestStream()
         stderr_stub = TestStream()
@@ -242,4 +416,43 @@ class MappingImporterTest(MappingBaseTest):
         self.assertTrue('Cannot map concept to itself.' in stderr_stub.getvalue())
         self.assertTrue("Must specify either 'to_concept' or 'to_source' & " in stderr_stub.getvalue())
         self.assertEquals(3, Mapping.objects.count())
-        self.assertEquals(3, MappingVersion.objects.count())
\ No newline at end of file
+        self.assertEquals(3, MappingVersion.objects.count())
+
+
+class FlexImporterTest(ConceptBaseTest):
+    def flex_concept(self, mnemonic, source='source1'):
+        return json.dumps({
+            'type': 'Concept', 'id': mnemonic, 'owner': 'org1', 'owner_type': 'Organization', 'source': source,
+            'concept_class': 'Diagnosis', 'datatype': 'None',
+            'names': [{'name': 'Flex ' + mnemonic, 'locale': 'en', 'name_type': 'FULLY_SPECIFIED', 'locale_preferred': True}]
+        })
+
+    def test_import_concepts(self):
+        input_file = StringIO('\n'.join([self.flex_concept('flex1'), self.flex_concept('flex2'),
+                                         self.flex_concept('flex3', source='missing')]))
+        importer = FlexImporter(input_file, self.userprofile1, update_if_exists=True)
+        importer.process()
+
+        self.assertEquals(3, importer.lines_handled)
+        self.assertItemsEqual(['flex1', 'flex2'], [concept.mnemonic for concept in Concept.objects.filter(parent_id=self.source1.id)])
+        self.assertEquals(2, len(SourceVersion.get_head_of(self.source1).get_concept_ids()))
+
+    def test_import_existing_concept_without_update(self):
+        create_concept(mnemonic='flex1', user=self.user1, source=self.source1)
+
+        importer = FlexImporter(StringIO(self.flex_concept('flex1')), self.userprofile1, update_if_exists=False)
+        importer.process()
+
+        self.assertEquals(1, ConceptVersion.objects.filter(versioned_object_id=Concept.objects.get(mnemonic='flex1').id).count())
+
+    def test_import_resumes_after_checkpoint(self):
+        first_line = self.flex_concept('flex1') + '\n'
+        input_file = StringIO(first_line + self.flex_concept('flex2'))
+        checkpoint = ImportCheckpoint('test', byte_offset=len(first_line), line_number=1,
+                                      action_counts={'Concept new 201': 1})
+        importer = FlexImporter(input_file, self.userprofile1, update_if_exists=True, checkpoint=checkpoint)
+        importer.process()
+
+        self.assertEquals(2, importer.lines_handled)
+        self.assertEquals(2, importer.action_counts['Concept new 201'])
+        self.assertItemsEqual(['flex2'], [concept.mnemonic for concept in Concept.objects.filter(parent_id=self.source1.id)])
@@ -1,8 +1,10 @@
-import json
+import hashlib
+from StringIO import StringIO
 
 from django.utils.text import compress_string
-from ocldev.oclfleximporter import OclFlexImporter
 
+from manage.imports.checkpoint import ImportCheckpoint
+from manage.imports.flex_importer import FlexImporter
 from users.models import UserProfile
 
 class ImportResults:
@@ -11,19 +13,35 @@ class ImportResults:
         self.detailed_summary = importer.import_results.get_detailed_summary()
         self.report = importer.import_results.display_report()
 
+        checkpoint = importer.checkpoint
+        if checkpoint and checkpoint.resumed_from_line:
+            resumed = 'Resumed after line %s. Lines per resource type, action and status, including those before: %s\n' % (
+                checkpoint.resumed_from_line, importer.action_counts)
+            self.detailed_summary = resumed + self.detailed_summary
+            self.report = resumed + self.report
+
 
 class BulkImport:
     def __init__(self):
         pass
 
-    def run_import(self, to_import, username, update_if_exists):
-        input_list = []
-        for line in to_import.splitlines():
-            input_list.append(json.loads(line))
-
+    def run_import(self, to_import, username, update_if_exists, parsed_task=None):
+        """
+        Imports the flex-import JSON lines of to_import. If given the parsed id of the bulk import task,
+        resumes after the last checkpoint saved for the task, as long as to_import has not changed.
+        """
+        checkpoint = None
+        if parsed_task:
+            checkpoint = ImportCheckpoint.load(parsed_task, hashlib.md5(to_import).hexdigest())
+        return self.run_import_from_file(StringIO(to_import), username, update_if_exists, checkpoint)
+
+    def run_import_from_file(self, input_file, username, update_if_exists, checkpoint=None):
+        """ Imports OCL flex-import JSON lines read one at a time from input_file, e.g. an upload on disk """
         profile = UserProfile.objects.get(mnemonic=username)
-        importer = OclFlexImporter(input_list=input_list, api_url_root='http://api.openconceptlab.org:8000',
-                                   api_token=profile.user.auth_token.key, do_update_if_exists=update_if_exists)
+        importer = FlexImporter(input_file, profile, update_if_exists=update_if_exists, checkpoint=checkpoint)
         importer.process()
 
-        return ImportResults(importer)
+        results = ImportResults(importer)
+        if checkpoint:
+            checkpoint.delete()
+        return results
@@ -0,0 +1,53 @@
+import json
+
+from oclapi.utils import RedisConnectionFactory
+
+# Checkpoints are kept as long as the results of the bulk import tasks
+CHECKPOINT_EXPIRES = 259200  # 72 hours
+
+
+class ImportCheckpoint(object):
+    """
+    Position in the input and counters of a bulk import, saved in Redis every few lines so that an import
+    restarted with the same task id resumes after the last checkpoint instead of from the first line.
+    """
+    KEY_PREFIX = 'bulk_import_checkpoint:'
+
+    def __init__(self, key, input_checksum=None, byte_offset=0, line_number=0, action_counts=None):
+        self.key = key
+        self.input_checksum = input_checksum
+        self.byte_offset = byte_offset
+        self.line_number = line_number
+        self.action_counts = action_counts or {}
+        self.resumed_from_line = line_number
+
+    @classmethod
+    def get_key(cls, parsed_task):
+        """ Keys the checkpoint by the uuid and username of a task id parsed by parse_bulk_import_task_id """
+        return '%s%s%s' % (cls.KEY_PREFIX, parsed_task['uuid'], parsed_task['username'])
+
+    @classmethod
+    def load(cls, parsed_task, input_checksum=None):
+        """ Returns the saved checkpoint of the task, or a new one if there is none for the same input """
+        key = cls.get_key(parsed_task)
+        value = RedisConnectionFactory.get_redis_connection().get(key)
+        if value:
+            saved = json.loads(value)
+            if saved.get('input_checksum') == input_checksum:
+                return cls(key, input_checksum, saved['byte_offset'], saved['line_number'], saved['action_counts'])
+        return cls(key, input_checksum)
+
+    def save(self, byte_offset, line_number, action_counts):
+        self.byte_offset = byte_offset
+        self.line_number = line_number
+        self.action_counts = dict(action_counts)
+        value = json.dumps({
+            'input_checksum': self.input_checksum,
+            'byte_offset': self.byte_offset,
+            'line_number': self.line_number,
+            'action_counts': self.action_counts,
+        })
+        RedisConnectionFactory.get_redis_connection().setex(self.key, CHECKPOINT_EXPIRES, value)
+
+    def delete(self):
+        RedisConnectionFactory.get_redis_connection().delete(self.key)
@@ -0,0 +1,412 @@
+"""
+In-process counterpart of ocldev's OclFlexImporter. Reads OCL flex-import JSON lines and dispatches them straight to
+the model layer, instead of making one REST call per resource back to the API.
+"""
+import json
+import logging
+import os
+from datetime import datetime
+
+import haystack
+from django.conf import settings
+from django.core.management.base import OutputWrapper
+from ocldev.oclfleximporter import OclImportResults
+
+from collection.models import Collection, CollectionVersion, CollectionReferenceUtils
+from collection.serializers import CollectionCreateSerializer, CollectionDetailSerializer, \
+    CollectionVersionCreateSerializer
+from concepts.importer import ConceptsImporter
+from mappings import importer as mappings_importer
+from mappings.importer import MappingsImporter
+from oclapi.management.commands import ImportActionHelper, MockRequest
+from oclapi.models import ACCESS_TYPE_EDIT
+from oclapi.search_indexing import SearchIndexRecorder
+from oclapi.utils import add_user_to_org
+from orgs.models import Organization
+from orgs.serializers import OrganizationCreateSerializer, OrganizationDetailSerializer
+from sources.models import Source, SourceVersion
+from sources.serializers import SourceCreateSerializer, SourceDetailSerializer, SourceVersionCreateSerializer
+from tasks import export_source, export_collection, update_collection_in_solr
+from users.models import UserProfile
+
+logger = logging.getLogger('batch')
+
+ORGANIZATION_TYPE = 'Organization'
+USER_TYPE = 'User'
+SOURCE_TYPE = 'Source'
+COLLECTION_TYPE = 'Collection'
+CONCEPT_TYPE = 'Concept'
+MAPPING_TYPE = 'Mapping'
+REFERENCE_TYPE = 'Reference'
+SOURCE_VERSION_TYPE = 'Source Version'
+COLLECTION_VERSION_TYPE = 'Collection Version'
+
+ACTION_TYPE_NEW = 'new'
+ACTION_TYPE_UPDATE = 'update'
+
+# Fields of a flex-import mapping line understood by MappingsImporter
+MAPPING_FIELDS = ('map_type', 'from_concept_url', 'to_concept_url', 'to_source_url', 'to_concept_code',
+                  'to_concept_name', 'external_id', 'extras', 'retired')
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def first_of(queryset):
+    results = list(queryset[:1])
+    return results[0] if results else None
+
+
+class FlexImportException(Exception):
+    """ Exception for a line that cannot be imported, e.g. because its owner or repository does not exist """
+    def __init__(self, message, status_code=400):
+        super(FlexImportException, self).__init__(message)
+        self.status_code = status_code
+
+
+class FlexImporter(object):
+    """
+    Imports OCL flex-import JSON lines. Consecutive concepts, mappings and references of the same repository are
+    imported in batches; owners, repositories and the per-source importers are loaded once per import.
+    If given an ImportCheckpoint, the import resumes after its last line and saves it every checkpoint_interval lines.
+    """
+
+    def __init__(self, input_file, profile, update_if_exists=False, batch_size=DEFAULT_BATCH_SIZE, checkpoint=None,
+                 checkpoint_interval=None):
+        self.input_file = input_file
+        self.profile = profile
+        self.user = profile.user
+        self.update_if_exists = update_if_exists
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval or settings.BULK_IMPORT_CHECKPOINT_INTERVAL
+        self.import_results = OclImportResults()
+        self.lines_handled = 0
+        self.byte_offset = 0
+        # Number of lines per resource type, action type and status code, including those before a resumed checkpoint
+        self.action_counts = {}
+        # Shared with the concepts and mappings importers, so that only the objects saved by the import are reindexed
+        self.index_recorder = SearchIndexRecorder()
+        self.owners = {}
+        self.repos = {}
+        self.concepts_importers = {}
+        self.mappings_importers = {}
+        output = OutputWrapper(open(os.devnull, 'w'))
+        self.stdout = output
+        self.stderr = output
+
+    def process(self):
+        """ Imports every line of the input file and returns the import results """
+        import_start_time = datetime.now()
+        initial_signal_processor = haystack.signal_processor
+        try:
+            haystack.signal_processor.teardown()
+            haystack.signal_processor = haystack.signals.BaseSignalProcessor
+            self.index_recorder.setup()
+            self.process_lines()
+
+            self.index_recorder.teardown()
+            logger.info('Indexing %s objects saved by the import' % self.index_recorder.count())
+            self.index_recorder.update_index()
+        finally:
+            self.index_recorder.teardown()
+            for importer in self.concepts_importers.values():
+                importer.teardown_validation()
+            haystack.signal_processor = initial_signal_processor
+            haystack.signal_processor.setup()
+
+        self.import_results.total_lines = self.lines_handled
+        self.import_results.elapsed_seconds = (datetime.now() - import_start_time).total_seconds()
+        return self.import_results
+
+    def process_lines(self):
+        if self.checkpoint and self.checkpoint.line_number:
+            self.resume_from_checkpoint()
+
+        batch = []
+        batch_key = None
+        for line in self.input_file:
+            self.byte_offset += len(line)
+            self.lines_handled += 1
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError as exc:
+                self.add_error('', '', '', 'Invalid JSON line: %s. JSON: %s' % (exc.args[0], line))
+                continue
+
+            key = self.get_batch_key(data)
+            if batch and (key != batch_key or len(batch) >= self.batch_size):
+                self.import_batch(batch)
+                batch = []
+                # Everything up to the current line has been imported
+                self.save_checkpoint_if_due(self.byte_offset - len(line), self.lines_handled - 1)
+            batch_key = key
+            batch.append(data)
+
+        if batch:
+            self.import_batch(batch)
+
+    def resume_from_checkpoint(self):
+        self.input_file.seek(self.checkpoint.byte_offset)
+        self.byte_offset = self.checkpoint.byte_offset
+        self.lines_handled = self.checkpoint.line_number
+        self.action_counts = dict(self.checkpoint.action_counts)
+        logger.info('Resuming bulk import after line %s' % self.lines_handled)
+
+    def save_checkpoint_if_due(self, byte_offset, line_number):
+        """ Saves the position of the first line not imported yet, if checkpoint_interval lines have passed """
+        if self.checkpoint and line_number - self.checkpoint.line_number >= self.checkpoint_interval:
+            self.checkpoint.save(byte_offset, line_number, self.action_counts)
+
+    def get_batch_key(self, data):
+        return (data.get('type'), data.get('owner_type'), data.get('owner'),
+                data.get('source') or data.get('collection'), data.get('__cascade'))
+
+    def import_batch(self, batch):
+        obj_type = batch[0].get('type')
+        try:
+            if obj_type == CONCEPT_TYPE:
+                self.import_concepts(batch)
+            elif obj_type == MAPPING_TYPE:
+                self.import_mappings(batch)
+            elif obj_type == REFERENCE_TYPE:
+                self.import_references(batch)
+            else:
+                for data in batch:
+                    self.import_object(data)
+        except FlexImportException as exc:
+            for data in batch:
+                self.add_error(obj_type, '', self.get_repo_url(data), exc.args[0], exc.status_code)
+        except Exception as exc:
+            logger.exception('Failed to import %s batch' % obj_type)
+            for data in batch:
+                self.add_error(obj_type, '', self.get_repo_url(data), 'Something unexpected occured: %s' % exc, 500)
+
+    def import_object(self, data):
+        obj_type = data.get('type')
+        handlers = {
+            ORGANIZATION_TYPE: self.import_organization,
+            SOURCE_TYPE: self.import_source,
+            COLLECTION_TYPE: self.import_collection,
+            SOURCE_VERSION_TYPE: self.import_source_version,
+            COLLECTION_VERSION_TYPE: self.import_collection_version,
+        }
+        if obj_type not in handlers:
+            self.add_error(obj_type, '', '', 'Unrecognized resource type %s' % obj_type)
+            return
+        try:
+            handlers[obj_type](data)
+        except FlexImportException as exc:
+            self.add_error(obj_type, '', self.get_repo_url(data), exc.args[0], exc.status_code)
+        except Exception as exc:
+            logger.exception('Failed to import %s' % obj_type)
+            self.add_error(obj_type, '', self.get_repo_url(data), 'Something unexpected occured: %s' % exc, 500)
+
+    def import_organization(self, data):
+        context = {'request': MockRequest(self.user)}
+        organization = first_of(Organization.objects.filter(mnemonic=data.get('id')))
+        if organization:
+            self.check_can_edit(organization)
+            if not self.update_if_exists:
+                self.add_skip(ORGANIZATION_TYPE, organization.url, 'Organization already exists')
+                return
+            serializer = OrganizationDetailSerializer(organization, data=data, context=context, partial=True)
+            self.save_serializer(serializer, ORGANIZATION_TYPE, ACTION_TYPE_UPDATE, '/', force_update=True)
+            return
+
+        serializer = OrganizationCreateSerializer(data=data, context=context)
+        organization = self.save_serializer(serializer, ORGANIZATION_TYPE, ACTION_TYPE_NEW, '/', force_insert=True)
+        if organization:
+            add_user_to_org(self.profile, organization)
+
+    def import_source(self, data):
+        self.import_repo(data, SOURCE_TYPE, Source, SourceCreateSerializer, SourceDetailSerializer)
+
+    def import_collection(self, data):
+        self.import_repo(data, COLLECTION_TYPE, Collection, CollectionCreateSerializer, CollectionDetailSerializer)
+
+    def import_repo(self, data, obj_type, model, create_serializer_class, detail_serializer_class):
+        context = {'request': MockRequest(self.user)}
+        owner = self.get_owner(data)
+        self.check_can_edit(owner)
+        repo = first_of(model.objects.filter(parent_id=owner.id, mnemonic=data.get('id')))
+        if repo:
+            if not self.update_if_exists:
+                self.add_skip(obj_type, repo.url, '%s already exists' % obj_type)
+                return
+            serializer = detail_serializer_class(repo, data=data, context=context, partial=True)
+            self.save_serializer(serializer, obj_type, ACTION_TYPE_UPDATE, owner.url,
+                                 force_update=True, parent_resource=owner)
+            return
+
+        serializer = create_serializer_class(data=data, context=context)
+        self.save_serializer(serializer, obj_type, ACTION_TYPE_NEW, owner.url, force_insert=True, parent_resource=owner)
+
+    def import_source_version(self, data):
+        self.import_repo_version(data, Source, SourceVersion, SourceVersionCreateSerializer, export_source)
+
+    def import_collection_version(self, data):
+        self.import_repo_version(data, Collection, CollectionVersion, CollectionVersionCreateSerializer,
+                                 export_collection)
+
+    def import_repo_version(self, data, model, version_model, serializer_class, export_task):
+        repo = self.get_repo(data, model)
+        obj_type = data.get('type')
+        if version_model.objects.filter(versioned_object_id=repo.id, mnemonic=data.get('id')).exists():
+            self.add_skip(obj_type, '%s%s/' % (repo.url, data.get('id')), '%s already exists' % obj_type)
+            return
+
+        serializer = serializer_class(data=data, context={'request': MockRequest(self.user)})
+        version = self.save_serializer(serializer, obj_type, ACTION_TYPE_NEW, repo.url,
+                                       force_insert=True, versioned_object=repo)
+        if version:
+            export_task.delay(version.id)
+
+    def save_serializer(self, serializer, obj_type, action_type, repo_url, **kwargs):
+        """ Saves the object of a serializer like the API views do and records the result """
+        if serializer.is_valid():
+            obj = serializer.save(**kwargs)
+            if serializer.is_valid():
+                self.add_result(obj_type, obj.url, repo_url, action_type,
+                                201 if action_type == ACTION_TYPE_NEW else 200)
+                return obj
+        self.add_error(obj_type, '', repo_url, json.dumps(serializer.errors, default=unicode))
+        return None
+
+    def import_concepts(self, batch):
+        source = self.get_repo(batch[0], Source)
+        self.get_concepts_importer(source).import_chunk(batch)
+
+    def get_concepts_importer(self, source):
+        if source.id not in self.concepts_importers:
+            importer = ConceptsImporter(source, None, self.user, self.stdout, self.stderr,
+                                        save_validation_errors=False)
+            importer.prepare_import(chunk_size=self.batch_size)
+            importer.update_if_exists = self.update_if_exists
+            importer.index_recorder = self.index_recorder
+            importer.result_handler = lambda data, update_action, message: self.add_action(
+                CONCEPT_TYPE, '%sconcepts/%s/' % (source.url, data.get('id')), source.url, update_action, message)
+            self.concepts_importers[source.id] = importer
+        return self.concepts_importers[source.id]
+
+    def import_mappings(self, batch):
+        source = self.get_repo(batch[0], Source)
+        importer = self.get_mappings_importer(source)
+        for data in batch:
+            mapping_url = '%smappings/%s/' % (source.url, data['id']) if data.get('id') else ''
+            message = None
+            try:
+                update_action = importer.handle_mapping(
+                    dict((field, data[field]) for field in MAPPING_FIELDS if field in data))
+                if update_action == ImportActionHelper.IMPORT_ACTION_SKIP:
+                    message = 'The from concept, to concept or to source of the mapping does not exist'
+            except (mappings_importer.IllegalInputException, mappings_importer.InvalidStateException) as exc:
+                update_action = ImportActionHelper.IMPORT_ACTION_SKIP
+                message = exc.args[0]
+            self.add_action(MAPPING_TYPE, mapping_url, source.url, update_action, message)
+
+    def get_mappings_importer(self, source):
+        if source.id not in self.mappings_importers:
+            importer = MappingsImporter(source, None, self.stdout, self.stderr, self.user)
+            importer.source_version = SourceVersion.get_head_of(source)
+            importer.mapping_ids = set(importer.source_version.get_mapping_ids())
+            importer.update_if_exists = self.update_if_exists
+            importer.index_recorder = self.index_recorder
+            self.mappings_importers[source.id] = importer
+        return self.mappings_importers[source.id]
+
+    def import_references(self, batch):
+        """ Adds the references of all lines of the batch to the collection at once """
+        collection = self.get_repo(batch[0], Collection)
+        expressions_per_line = []
+        for data in batch:
+            reference_data = data.get('data') or {}
+            expressions_per_line.append(reference_data.get('expressions', []) +
+                                        reference_data.get('concepts', []) + reference_data.get('mappings', []))
+
+        expressions = set(expression for line_expressions in expressions_per_line for expression in line_expressions)
+        if batch[0].get('__cascade') == 'sourcemappings':
+            expressions = expressions.union(CollectionReferenceUtils.get_all_related_mappings(expressions, collection))
+        added_references, errors = collection.add_references_in_bulk(expressions)
+        if added_references:
+            update_collection_in_solr.delay(collection.get_head().id, added_references)
+
+        for line_expressions in expressions_per_line:
+            line_errors = dict((expression, errors[expression]) for expression in line_expressions if expression in errors)
+            if line_errors:
+                self.add_error(REFERENCE_TYPE, collection.url + 'references/', collection.url,
+                               json.dumps(line_errors, default=unicode))
+            else:
+                self.add_result(REFERENCE_TYPE, collection.url + 'references/', collection.url, ACTION_TYPE_NEW, 200)
+
+    def get_owner(self, data):
+        key = (data.get('owner_type'), data.get('owner'))
+        if key not in self.owners:
+            model = UserProfile if data.get('owner_type') == USER_TYPE else Organization
+            owner = first_of(model.objects.filter(mnemonic=data.get('owner')))
+            if owner is None:
+                raise FlexImportException('%s %s does not exist' % (data.get('owner_type'), data.get('owner')), 404)
+            self.owners[key] = owner
+        return self.owners[key]
+
+    def get_repo(self, data, model):
+        """ Returns the source or collection of a line, once checked that the user can edit it """
+        owner = self.get_owner(data)
+        obj_type, repo_key = (SOURCE_TYPE, 'source') if model is Source else (COLLECTION_TYPE, 'collection')
+        key = (model, owner.id, data.get(repo_key))
+        if key not in self.repos:
+            repo = first_of(model.objects.filter(parent_id=owner.id, mnemonic=data.get(repo_key)))
+            if repo is None:
+                raise FlexImportException('%s %s does not exist' % (obj_type, data.get(repo_key)), 404)
+            if repo.public_access != ACCESS_TYPE_EDIT:
+                self.check_can_edit(owner)
+            self.repos[key] = repo
+        return self.repos[key]
+
+    def get_repo_url(self, data):
+        repo = data.get('source') or data.get('collection')
+        if not data.get('owner') or not repo:
+            return ''
+        owner_prefix = '/users/' if data.get('owner_type') == USER_TYPE else '/orgs/'
+        repo_prefix = '/sources/' if data.get('source') else '/collections/'
+        return '%s%s%s%s/' % (owner_prefix, data.get('owner'), repo_prefix, repo)
+
+    def check_can_edit(self, owner):
+        """ Applies the ownership rules of the API views, as there is no request to check permissions on """
+        if self.user.is_staff or self.user.is_superuser:
+            return
+        if isinstance(owner, UserProfile) and owner.id == self.profile.id:
+            return
+        if isinstance(owner, Organization) and self.profile.id in owner.members:
+            return
+        raise FlexImportException('User %s is not allowed to edit %s' % (self.profile.mnemonic, owner.mnemonic), 403)
+
+    def add_action(self, obj_type, obj_url, repo_url, update_action, message=None):
+        """ Records a line handled by the concepts or mappings importer """
+        if update_action == ImportActionHelper.IMPORT_ACTION_SKIP:
+            self.add_error(obj_type, obj_url, repo_url, message)
+        elif update_action == ImportActionHelper.IMPORT_ACTION_NONE:
+            self.add_skip(obj_type, obj_url, 'No changes')
+        elif update_action & ImportActionHelper.IMPORT_ACTION_ADD:
+            self.add_result(obj_type, obj_url, repo_url, ACTION_TYPE_NEW, 201)
+        else:
+            self.add_result(obj_type, obj_url, repo_url, ACTION_TYPE_UPDATE, 200)
+
+    def count_action(self, obj_type, action_type, status_code):
+        key = '%s %s %s' % (obj_type, action_type, status_code)
+        self.action_counts[key] = self.action_counts.get(key, 0) + 1
+
+    def add_result(self, obj_type, obj_url, repo_url, action_type, status_code, text=''):
+        self.count_action(obj_type, action_type, status_code)
+        self.import_results.add(obj_url=obj_url, action_type=action_type, obj_type=obj_type, obj_repo_url=repo_url,
+                                http_method='POST' if action_type == ACTION_TYPE_NEW else 'PUT',
+                                obj_owner_url=repo_url, status_code=status_code, text=text)
+
+    def add_error(self, obj_type, obj_url, repo_url, text, status_code=400):
+        logger.warning('Failed to import %s %s: %s' % (obj_type, obj_url, text))
+        self.add_result(obj_type, obj_url, repo_url, ACTION_TYPE_NEW, status_code, text)
+
+    def add_skip(self, obj_type, obj_url, text):
+        self.count_action(obj_type, 'skip', '')
+        self.import_results.add_skip(obj_type=obj_type, text='%s %s' % (obj_url, text))
@@ -129,8 +129,13 @@ class BulkImportView(APIView):
         else:
             return Response({'exception': 'update_if_exists must be either \'true\' or \'false\''},
                             status=status.HTTP_400_BAD_REQUEST)
+
+        # Resubmitting the same import with the id of a task that died resumes it after its last checkpoint
+        resume_task_id = request.GET.get('resume')
+        if resume_task_id and parse_bulk_import_task_id(resume_task_id)['username'] != username:
+            return Response(status=status.HTTP_403_FORBIDDEN)
         try:
-            task = queue_bulk_import(request.body, import_queue, username, update_if_exists)
+            task = queue_bulk_import(request.body, import_queue, username, update_if_exists, resume_task_id)
         except AlreadyQueued:
             return Response({'exception': 'The same import has been already queued'}, status=status.HTTP_409_CONFLICT)
 
@@ -3,15 +3,16 @@ import json
 import logging
 
 import haystack
+from bson import ObjectId
 from datetime import datetime
 from django.core.management import CommandError
-from django.db.models import Q
-from haystack.management.commands import update_index
 
 from mappings.models import Mapping
+from mappings.validation_messages import MAPPING_NOT_UNIQUE, EXTERNAL_MAPPING_NOT_UNIQUE
 from concepts.models import Concept
 from mappings.serializers import MappingCreateSerializer, MappingUpdateSerializer
 from oclapi.management.commands import MockRequest, ImportActionHelper
+from oclapi.search_indexing import SearchIndexRecorder
 from sources.models import Source, SourceVersion
 
 from mappings.models import MappingVersion
@@ -19,6 +20,9 @@ from mappings.models import MappingVersion
 __author__ = 'misternando,paynejd'
 logger = logging.getLogger('batch')
 
+# Fields of an input line that are resolved through the index rather than passed on to the model
+URL_FIELDS = ('from_concept_url', 'to_concept_url', 'to_source_url')
+
 
 class IllegalInputException(Exception):
     """ Exception for invalid JSON read from input file """
@@ -30,27 +34,128 @@ class InvalidStateException(Exception):
     pass
 
 
+def source_url_of(concept_url):
+    """ Returns the URL of the source of a concept URL, e.g. /orgs/CIEL/sources/CIEL/ """
+    index = concept_url.find('/concepts/') if concept_url else -1
+    return concept_url[:index + 1] if index > 0 else None
+
+
+class MappingsIndex(object):
+    """
+    In-memory index of the concepts and mappings a mapping import resolves against, so that concept URLs and
+    existing mappings are looked up in dicts instead of with queries for every line.
+    The concepts of a source are loaded with a single query the first time one of its concepts is referenced.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.sources = {}
+        self.concept_ids = {}
+        self.mapping_ids = {}
+        self.unique_keys = set()
+        self.latest_version_ids = {}
+        self.content_hashes = {}
+        self.index_source(source)
+        self.index_mappings()
+
+    def index_source(self, source):
+        self.sources[source.uri] = source
+        for uri, concept_id in Concept.objects.filter(parent_id=source.id).values_list('uri', 'id'):
+            self.concept_ids[uri] = concept_id
+
+    def index_mappings(self):
+        mappings = Mapping.objects.filter(parent_id=self.source.id).values_list(
+            'id', 'from_concept', 'to_concept', 'to_source', 'to_concept_code', 'to_concept_name', 'map_type',
+            'content_hash')
+        for mapping_id, from_id, to_id, to_source_id, to_code, to_name, map_type, content_hash in mappings:
+            self.add_mapping(mapping_id, from_id, to_id, to_source_id, to_code, to_name, map_type)
+            if content_hash:
+                self.content_hashes[mapping_id] = content_hash
+
+        versions = MappingVersion.objects.filter(parent_id=self.source.id, is_latest_version=True).values_list(
+            'versioned_object_id', 'id')
+        for mapping_id, version_id in versions:
+            self.latest_version_ids[mapping_id] = version_id
+
+    def get_source(self, source_url):
+        """ Returns the source of the URL, or raises Source.DoesNotExist """
+        if source_url not in self.sources:
+            self.sources[source_url] = Source.objects.get(uri=source_url)
+        return self.sources[source_url]
+
+    def get_concept_id(self, concept_url):
+        """ Returns the id of the concept of the URL, or None if there is no such concept """
+        if concept_url in self.concept_ids:
+            return self.concept_ids[concept_url]
+
+        source_url = source_url_of(concept_url)
+        if source_url and source_url not in self.sources:
+            try:
+                self.index_source(self.get_source(source_url))
+            except Source.DoesNotExist:
+                self.sources[source_url] = None
+            if concept_url in self.concept_ids:
+                return self.concept_ids[concept_url]
+
+        # Not indexed, e.g. created after its source was indexed or referenced by an unusual URL
+        concept_ids = list(Concept.objects.filter(uri=concept_url).values_list('id', flat=True))
+        if concept_ids:
+            self.concept_ids[concept_url] = concept_ids[0]
+            return concept_ids[0]
+        return None
+
+    def add_mapping(self, mapping_id, from_id, to_id, to_source_id, to_code, to_name, map_type):
+        self.mapping_ids[self.get_key(from_id, to_id, to_source_id, to_code, to_name, map_type)] = mapping_id
+        self.unique_keys.add(self.get_unique_key(from_id, to_id, to_source_id, to_code, map_type))
+
+    def is_unchanged(self, mapping_id, data):
+        """ Whether the line has the content of the mapping, judged by content hash alone """
+        content_hash = self.content_hashes.get(mapping_id)
+        return content_hash is not None and content_hash == Mapping.get_data_content_hash(data)
+
+    def find_mapping(self, from_id, to_id, to_source_id, to_code, to_name, map_type):
+        """ Returns the id of the mapping with the same from and to concepts and map type, or None """
+        return self.mapping_ids.get(self.get_key(from_id, to_id, to_source_id, to_code, to_name, map_type))
+
+    def is_duplicate(self, from_id, to_id, to_source_id, to_code, map_type):
+        """ Whether a new mapping would violate the uniqueness checked by MappingValidationMixin.clean """
+        return self.get_unique_key(from_id, to_id, to_source_id, to_code, map_type) in self.unique_keys
+
+    def get_key(self, from_id, to_id, to_source_id, to_code, to_name, map_type):
+        if to_id:
+            return from_id, map_type, to_id
+        return from_id, map_type, to_source_id, to_code, to_name
+
+    def get_unique_key(self, from_id, to_id, to_source_id, to_code, map_type):
+        if to_id:
+            return from_id, map_type, to_id
+        return from_id, map_type, to_source_id, to_code
+
+
 class MappingsImporter(object):
     """ Class to import mappings """
 
     def __init__(self, source, mappings_file, output_stream, error_stream, user):
         """ Initialize mapping importer """
         self.source = source
-        self.sources_cache = {}
-        self.concepts_cache = {}
+        self.index = None
         self.mappings_file = mappings_file
         self.stdout = output_stream
         self.stderr = error_stream
         self.user = user
         self.count = 0
         self.test_mode = False
+        self.update_if_exists = True
         self.action_count = {}
+        # Records the mapping versions saved by the import, so that only those are reindexed
+        self.index_recorder = SearchIndexRecorder()
 
     def import_mappings(self, new_version=False, total=0, test_mode=False, deactivate_old_records=False, **kwargs):
         initial_signal_processor = haystack.signal_processor
         try:
             haystack.signal_processor.teardown()
             haystack.signal_processor = haystack.signals.BaseSignalProcessor
+            self.index_recorder.setup()
             import_start_time = datetime.now()
             logger.info('Started import at {}'.format(import_start_time.strftime("%Y-%m-%dT%H:%M:%S")))
 
@@ -75,19 +180,13 @@ class MappingsImporter(object):
 
             # Load the JSON file line by line and import each line
             self.mapping_ids = set(self.source_version.get_mapping_ids())
+            self.index = MappingsIndex(self.source)
             self.count = 0
             for line in self.mappings_file:
 
                 # Load the next JSON line
                 self.count += 1
-                data = None
-                try:
-                    data = json.loads(line)
-                except ValueError as exc:
-                    str_log = 'Skipping invalid JSON line: %s. JSON: %s\n' % (exc.args[0], line)
-                    self.stderr.write(str_log)
-                    logger.warning(str_log)
-                    self.count_action(ImportActionHelper.IMPORT_ACTION_SKIP)
+                data = self.json_to_mapping(line)
 
                 # Process the import for the current JSON line
                 if data:
@@ -135,20 +234,20 @@ class MappingsImporter(object):
                 str_log = 'Deactivating old mappings...\n'
                 self.stdout.write(str_log)
                 logger.info(str_log)
-                for mapping_id in self.mapping_ids:
-                    try:
-                        if self.remove_mapping(mapping_id):
-                            self.count_action(ImportActionHelper.IMPORT_ACTION_DEACTIVATE)
+                deactivated_ids, missing_ids = self.deactivate_mappings(self.mapping_ids)
+                for mapping_id in missing_ids:
+                    str_log = 'Failed to inactivate mapping on ID %s! ' \
+                              'Cannot deactivate mapping because it doesn\'t exist!\n' % mapping_id
+                    self.stderr.write(str_log)
+                    logger.warning(str_log)
 
-                            # Log the mapping deactivation
-                            str_log = 'Deactivated mapping: %s\n' % mapping_id
-                            self.stdout.write(str_log)
-                            logger.info(str_log)
+                for mapping_id in deactivated_ids:
+                    self.count_action(ImportActionHelper.IMPORT_ACTION_DEACTIVATE)
 
-                    except InvalidStateException as exc:
-                        str_log = 'Failed to inactivate mapping on ID %s! %s\n' % (mapping_id, exc.args[0])
-                        self.stderr.write(str_log)
-                        logger.warning(str_log)
+                    # Log the mapping deactivation
+                    str_log = 'Deactivated mapping: %s\n' % mapping_id
+                    self.stdout.write(str_log)
+                    logger.info(str_log)
             else:
                 str_log = 'Skipping deactivation loop...\n'
                 self.stdout.write(str_log)
@@ -163,88 +262,65 @@ class MappingsImporter(object):
             self.stdout.write(str_log, ending='\r')
             logger.info(str_log)
 
-            actions = self.action_count
-            update_index_required = actions.get(ImportActionHelper.IMPORT_ACTION_ADD, 0) > 0
-            update_index_required |= actions.get(ImportActionHelper.IMPORT_ACTION_UPDATE, 0) > 0
-
-            if update_index_required:
-                logger.info('Indexing objects updated since {}'.format(import_start_time.strftime("%Y-%m-%dT%H:%M:%S")))
-                update_index.Command().handle(start_date=import_start_time.strftime("%Y-%m-%dT%H:%M:%S"), verbosity=2,
-                                              workers=4, batchsize=100)
+            self.index_recorder.teardown()
+            logger.info('Indexing %s objects saved by the import' % self.index_recorder.count())
+            self.index_recorder.update_index()
         finally:
+            self.index_recorder.teardown()
             haystack.signal_processor = initial_signal_processor
             haystack.signal_processor.setup()
 
+    def json_to_mapping(self, line):
+        data = None
+        try:
+            data = json.loads(line)
+        except ValueError as exc:
+            str_log = 'Skipping invalid JSON line: %s. JSON: %s\n' % (exc.args[0], line)
+            self.stderr.write(str_log)
+            logger.warning(str_log)
+            self.count_action(ImportActionHelper.IMPORT_ACTION_SKIP)
+        return data
+
     def handle_mapping(self, data):
         """ Handle importing of a single mapping """
-        update_action = ImportActionHelper.IMPORT_ACTION_NONE
-
-        # If mapping exists, update the mapping with the new data
-        try:
-            try:
-                from_concept = self.get_concept(data['from_concept_url'])
-            except Concept.DoesNotExist:
-                str_log = 'from_concept_url %s does not exist' % (data['from_concept_url'])
+        if self.index is None:
+            self.index = MappingsIndex(self.source)
+
+        from_concept_id = self.index.get_concept_id(data['from_concept_url'])
+        if not from_concept_id:
+            str_log = 'from_concept_url %s does not exist' % (data['from_concept_url'])
+            self.stderr.write(str_log)
+            logger.warning(str_log)
+            return ImportActionHelper.IMPORT_ACTION_SKIP
+        data['from_concept_id'] = from_concept_id
+
+        to_concept_id = to_source_id = None
+        if data.get('to_concept_url'):  # Internal mapping
+            to_concept_id = self.index.get_concept_id(data['to_concept_url'])
+            if not to_concept_id:
+                str_log = 'to_concept_url %s does not exist' % (data['to_concept_url'])
                 self.stderr.write(str_log)
                 logger.warning(str_log)
-                update_action = ImportActionHelper.IMPORT_ACTION_SKIP
-                return update_action
-
-            data['from_concept'] = from_concept
-            query = Q(parent_id=self.source.id, map_type=data['map_type'],
-                      from_concept_id=from_concept.id)
-            if data.get('to_concept_url'):  # Internal mapping
-                try:
-                    to_concept = self.get_concept(data['to_concept_url'])
-                except Concept.DoesNotExist:
-                    str_log = 'to_concept_url %s does not exist' % (data['to_concept_url'])
-                    self.stderr.write(str_log)
-                    logger.warning(str_log)
-                    update_action = ImportActionHelper.IMPORT_ACTION_SKIP
-                    return update_action
-
-                data['to_concept'] = to_concept
-                query = query & Q(to_concept_id=to_concept.id)
-            else:   # External mapping
-                try:
-                    to_source = self.get_source(data['to_source_url'])
-                except Source.DoesNotExist:
-                    str_log = 'to_source_url %s does not exist' % (data['to_source_url'])
-                    self.stderr.write(str_log)
-                    logger.warning(str_log)
-                    update_action = ImportActionHelper.IMPORT_ACTION_SKIP
-                    return update_action
-
-                data['to_source'] = to_source
-                query = query & Q(to_source_id=to_source.id,
-                                  to_concept_code=data['to_concept_code'],
-                                  to_concept_name=data.get('to_concept_name'))
-
-            # Perform the query - throws exception if does not exist
-            mapping = Mapping.objects.get(query)
-
-            # Mapping exists, but not in this source version
-            mapping_version = MappingVersion.objects.get(versioned_object_id=mapping.id, is_latest_version=True)
-
-            # Finish updating the mapping
-            update_action = self.update_mapping(mapping, data)
-
-            # Remove ID from the mapping list so that we know that mapping has been handled
+                return ImportActionHelper.IMPORT_ACTION_SKIP
+            data['to_concept_id'] = to_concept_id
+        else:   # External mapping
             try:
-                self.mapping_ids.remove(mapping_version.id)
-            except KeyError:
-                str_log = 'Key not found. Could not remove key %s from list of mapping IDs: %s\n' % (mapping.id, data)
+                to_source = self.index.get_source(data['to_source_url'])
+            except Source.DoesNotExist:
+                to_source = None
+            if to_source is None:
+                str_log = 'to_source_url %s does not exist' % (data['to_source_url'])
                 self.stderr.write(str_log)
                 logger.warning(str_log)
+                return ImportActionHelper.IMPORT_ACTION_SKIP
+            data['to_source'] = to_source
+            to_source_id = to_source.id
 
-            # Log the update
-            if update_action:
-                str_log = 'Updated mapping with ID %s: %s\n' % (mapping.id, data)
-                self.stdout.write(str_log)
-                logger.info(str_log)
+        mapping_id = self.index.find_mapping(from_concept_id, to_concept_id, to_source_id,
+                                             data.get('to_concept_code'), data.get('to_concept_name'), data['map_type'])
 
         # Mapping does not exist, so create new one
-        except Mapping.DoesNotExist:
+        if mapping_id is None:
             update_action = self.add_mapping(data)
 
             # Log the insert
@@ -252,6 +328,35 @@ class MappingsImporter(object):
                 str_log = 'Created new mapping: to - %s\n' % (data.get('to_concept_url') or (data.get('to_source_url') + ':' + data.get('to_concept_code')))
                 self.stdout.write(str_log)
                 logger.info(str_log)
+            return update_action
+
+        # If mapping exists, update the mapping with the new data
+        if not self.update_if_exists:
+            raise IllegalInputException('Mapping %s already exists' % mapping_id)
+
+        if self.index.is_unchanged(mapping_id, data):
+            # Neither load nor diff the mapping
+            update_action = ImportActionHelper.IMPORT_ACTION_NONE
+            mapping = None
+        else:
+            # The line may change the mapping, so its content hash no longer applies
+            self.index.content_hashes.pop(mapping_id, None)
+            mapping = Mapping.objects.get(id=mapping_id)
+            update_action = self.update_mapping(mapping, data)
+
+        # Remove ID from the mapping list so that we know that mapping has been handled
+        try:
+            self.mapping_ids.remove(self.index.latest_version_ids.get(mapping_id))
+        except KeyError:
+            str_log = 'Key not found. Could not remove key %s from list of mapping IDs: %s\n' % (mapping_id, data)
+            self.stderr.write(str_log)
+            logger.warning(str_log)
+
+        # Log the update
+        if update_action:
+            str_log = 'Updated mapping with ID %s: %s\n' % (mapping_id, data)
+            self.stdout.write(str_log)
+            logger.info(str_log)
 
         # Return the action performed
         return update_action
@@ -259,8 +364,17 @@ class MappingsImporter(object):
     def add_mapping(self, data):
         """ Create a new mapping """
 
+        # Check uniqueness against the index instead of querying in MappingValidationMixin.clean
+        to_source = data.get('to_source')
+        to_source_id = to_source.id if to_source else None
+        if self.index.is_duplicate(data['from_concept_id'], data.get('to_concept_id'), to_source_id,
+                                   data.get('to_concept_code'), data['map_type']):
+            message = EXTERNAL_MAPPING_NOT_UNIQUE if to_source_id else MAPPING_NOT_UNIQUE
+            raise IllegalInputException('Could not persist new mapping due to %s' % {'__all__': [message]})
+
         # Create the new mapping
-        mapping = Mapping(**data)
+        mapping = Mapping(**dict((key, value) for key, value in data.items() if key not in URL_FIELDS))
+        mapping.uniqueness_checked = True
         kwargs = {'parent_resource': self.source}
         if self.test_mode:
             mapping.save=lambda x: None
@@ -270,6 +384,8 @@ class MappingsImporter(object):
             raise IllegalInputException(
                 'Could not persist new mapping due to %s' % errors)
 
+        self.index.add_mapping(mapping.id, mapping.from_concept_id, mapping.to_concept_id, to_source_id,
+                               mapping.to_concept_code, mapping.to_concept_name, mapping.map_type)
         return ImportActionHelper.IMPORT_ACTION_ADD
 
     def update_mapping(self, mapping, data):
@@ -280,8 +396,10 @@ class MappingsImporter(object):
         if 'retired' in data and mapping.retired != data['retired']:
             diffs['retired'] = {'was': mapping.retired, 'is': data['retired']}
         original = mapping.clone(self.user)
+        # The from and to concepts identify the mapping, so there is no need to resolve their URLs again
+        update_data = dict((key, value) for key, value in data.items() if key not in URL_FIELDS)
         serializer = MappingUpdateSerializer(
-            mapping, data=data, context={'request': MockRequest(self.user)})
+            mapping, data=update_data, context={'request': MockRequest(self.user)})
         if not serializer.is_valid():
             raise IllegalInputException(
                 'Could not parse mapping to update mapping %s due to %s.' %
@@ -303,23 +421,36 @@ class MappingsImporter(object):
             return ImportActionHelper.IMPORT_ACTION_UPDATE
 
         # No diff, so do nothing
+        if not mapping.content_hash and not self.test_mode:
+            # Hash mappings saved before content hashes were introduced, so that the next import can skip them
+            original.update_content_hash()
+            Mapping.objects.filter(id=mapping.id).update(content_hash=original.content_hash)
         return ImportActionHelper.IMPORT_ACTION_NONE
 
-    def remove_mapping(self, mapping_id):
-        """ Deactivates a mapping """
-        try:
-            mapping_version = MappingVersion.objects.get(id=mapping_id)
-            mapping = Mapping.objects.get(id = mapping_version.versioned_object_id)
-            if mapping.is_active:
-                if not self.test_mode:
-                    mapping.is_active = False
-                    mapping.save()
-                return ImportActionHelper.IMPORT_ACTION_DEACTIVATE
-            else:
-                return ImportActionHelper.IMPORT_ACTION_NONE
-        except:
-            raise InvalidStateException(
-                "Cannot deactivate mapping %s because it doesn't exist!" % mapping_id)
+    def deactivate_mappings(self, version_ids):
+        """
+        Deactivates the active mappings of the mapping versions, and the versions themselves, with one update each.
+        Returns the IDs of the versions whose mappings have been deactivated and of those that do not exist.
+        The versions are reindexed with the other objects saved by the import.
+        """
+        version_ids = list(version_ids)
+        mapping_ids = dict(MappingVersion.objects.filter(id__in=version_ids).values_list('id', 'versioned_object_id'))
+        active_mapping_ids = set(Mapping.objects.filter(
+            id__in=mapping_ids.values(), is_active=True).values_list('id', flat=True))
+        missing_ids = [version_id for version_id in version_ids if version_id not in mapping_ids]
+
+        deactivated_ids = [version_id for version_id in version_ids
+                           if mapping_ids.get(version_id) in active_mapping_ids]
+        if deactivated_ids and not self.test_mode:
+            updated_at = datetime.now()
+            Mapping.objects.raw_update(
+                {'_id': {'$in': [ObjectId(mapping_ids[version_id]) for version_id in deactivated_ids]}},
+                {'$set': {'is_active': False, 'updated_at': updated_at}})
+            MappingVersion.objects.raw_update(
+                {'_id': {'$in': [ObjectId(version_id) for version_id in deactivated_ids]}},
+                {'$set': {'is_active': False, 'updated_at': updated_at}})
+            self.index_recorder.record(MappingVersion, deactivated_ids)
+        return deactivated_ids, missing_ids
 
     def count_action(self, update_action):
         """ Increments the counter for the specified action """
@@ -327,16 +458,3 @@ class MappingsImporter(object):
             self.action_count[update_action] += 1
         else:
             self.action_count[update_action] = 1
-    def get_concept(self, concept_url):
-        result = self.concepts_cache.get(concept_url)
-        if not result:
-            result = Concept.objects.get(uri=concept_url)
-            self.concepts_cache[concept_url] = result
-        return result
-    def get_source(self, source_url):
-        result = self.sources_cache.get(source_url)
-        if not result:
-            result = Source.objects.get(uri=source_url)
-
-            self.sources_cache[source_url] = result
-        return result
\ No newline at end of file
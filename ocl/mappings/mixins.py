@@ -2,44 +2,87 @@ from django.core.exceptions import ValidationError
 
 from concepts.models import Concept
 from mappings.custom_validators import OpenMRSMappingValidator
+from mappings.validation_messages import MAPPING_NOT_UNIQUE, EXTERNAL_MAPPING_NOT_UNIQUE
 from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS
+from oclapi.utils import get_content_hash
 from sources.models import Source
 
 import os
 
 
+class MappingContentMixin(object):
+    """ Keeps content_hash up to date, so that an importer can tell an unchanged line without loading the mapping """
+
+    def save(self, *args, **kwargs):
+        self.update_content_hash()
+        super(MappingContentMixin, self).save(*args, **kwargs)
+
+    def update_content_hash(self):
+        self.content_hash = get_content_hash(self.get_content())
+
+    def get_content(self):
+        """ The content an import line is compared against, see get_data_content """
+        return dict(
+            map_type=self.map_type,
+            to_concept_code=self.to_concept_code,
+            to_concept_name=self.to_concept_name,
+            external_id=self.external_id,
+            retired=self.retired,
+            extras=self.get_decoded_extras(),
+        )
+
+    @classmethod
+    def get_data_content(cls, data):
+        """ Content of an import line in the form of get_content. Values are not coerced. """
+        return dict(
+            map_type=data.get('map_type'),
+            to_concept_code=data.get('to_concept_code'),
+            to_concept_name=data.get('to_concept_name'),
+            external_id=data.get('external_id'),
+            retired=data.get('retired', False),
+            extras=data.get('extras') or {},
+        )
+
+    @classmethod
+    def get_data_content_hash(cls, data):
+        return get_content_hash(cls.get_data_content(data))
+
+
 class MappingValidationMixin:
+    # Set by importers that have already checked uniqueness against their in-memory index
+    uniqueness_checked = False
+
     def clean(self):
         basic_errors = []
 
-        try:
-            if self.from_concept == self.to_concept:
-                basic_errors.append("Cannot map concept to itself.")
-        except Concept.DoesNotExist:
+        # Compare ids rather than concepts, so that neither concept has to be loaded
+        if not self.from_concept_id:
             basic_errors.append("Must specify a 'from_concept'.")
+        elif self.from_concept_id == self.to_concept_id:
+            basic_errors.append("Cannot map concept to itself.")
 
-        if self.to_concept and (self.to_source or self.to_concept_code):
+        if self.to_concept_id and (self.to_source_id or self.to_concept_code):
             basic_errors.append(
                 "Must specify either 'to_concept' or 'to_source' & 'to_concept_code'. Cannot specify both.")
-        elif not (self.to_concept or (self.to_source and self.to_concept_code)):
+        elif not (self.to_concept_id or (self.to_source_id and self.to_concept_code)):
             basic_errors.append("Must specify either 'to_concept' or 'to_source' & 'to_concept_code")
-        else:
+        elif not self.uniqueness_checked:
             try:
-                if self.from_concept:
+                if self.from_concept_id:
                     from mappings.models import Mapping
-                    if self.to_source == None:
+                    if self.to_source_id == None:
                         mappings = Mapping.objects.filter(parent=self.parent, map_type=self.map_type,
-                                                          from_concept=self.from_concept, to_concept=self.to_concept) \
+                                                          from_concept_id=self.from_concept_id, to_concept_id=self.to_concept_id) \
                             .exclude(id=self.id)
                         if mappings:
-                            basic_errors.append("Parent, map_type, from_concept, to_concept must be unique.")
+                            basic_errors.append(MAPPING_NOT_UNIQUE)
                     else:
                         mappings = Mapping.objects.filter(parent=self.parent, map_type=self.map_type,
-                                                          from_concept=self.from_concept, to_source=self.to_source,
+                                                          from_concept_id=self.from_concept_id, to_source_id=self.to_source_id,
                                                           to_concept_code=self.to_concept_code) \
                             .exclude(id=self.id)
                         if mappings:
-                            basic_errors.append("Parent, map_type, from_concept, to_source, to_concept_code must be unique.")
+                            basic_errors.append(EXTERNAL_MAPPING_NOT_UNIQUE)
             except Concept.DoesNotExist:
                 pass #the error was reported earlier
             except Source.DoesNotExist:
@@ -7,7 +7,7 @@ from django.dispatch import receiver
 from django_mongodb_engine.contrib import MongoDBManager
 
 from concepts.models import Concept
-from mappings.mixins import MappingValidationMixin
+from mappings.mixins import MappingValidationMixin, MappingContentMixin
 from oclapi.models import BaseModel, ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW, ResourceVersionModel, BaseResourceModel
 from sources.models import Source, SourceVersion
 from djangotoolbox.fields import SetField
@@ -17,7 +17,7 @@ import uuid
 MAPPING_RESOURCE_TYPE = 'Mapping'
 MAPPING_VERSION_RESOURCE_TYPE = 'MappingVersion'
 
-class Mapping(MappingValidationMixin, BaseModel):
+class Mapping(MappingValidationMixin, MappingContentMixin, BaseModel):
     mnemonic = models.CharField(max_length=255, default=uuid.uuid4, validators=[RegexValidator(regex=NAMESPACE_REGEX)])
     parent = models.ForeignKey(Source, related_name='mappings_from')
     map_type = models.TextField()
@@ -28,6 +28,7 @@ class Mapping(MappingValidationMixin, BaseModel):
     to_concept_name = models.TextField(null=True, blank=True)
     retired = models.BooleanField(default=False)
     external_id = models.TextField(null=True, blank=True)
+    content_hash = models.TextField(null=True, blank=True)
 
     class Meta:
         unique_together = ('mnemonic', 'parent')
@@ -220,6 +221,7 @@ class Mapping(MappingValidationMixin, BaseModel):
             new_latest_version.previous_version = prev_latest_version
             new_latest_version.update_comment = update_comment
             new_latest_version.mnemonic = int(prev_latest_version.mnemonic) + 1
+            new_latest_version.set_display_fields(prev_latest_version)
             new_latest_version.save()
 
             source_version.update_mapping_version(new_latest_version)
@@ -274,6 +276,7 @@ class Mapping(MappingValidationMixin, BaseModel):
             #Initial mapping version
             initial_version = MappingVersion.for_mapping(mapping)
             initial_version.mnemonic = 1
+            initial_version.set_display_fields()
             initial_version.save()
 
             # Save again to get the correct URL
@@ -328,7 +331,7 @@ class Mapping(MappingValidationMixin, BaseModel):
         return diffs
 
 
-class MappingVersion(MappingValidationMixin, ResourceVersionModel):
+class MappingVersion(MappingValidationMixin, MappingContentMixin, ResourceVersionModel):
     parent = models.ForeignKey(Source, related_name='mappings_version_from')
     map_type = models.TextField()
     from_concept = models.ForeignKey(Concept, related_name='mappings_version_from')
@@ -341,6 +344,25 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
     is_latest_version = models.BooleanField(default=True)
     update_comment = models.TextField(null=True, blank=True)
     source_version_ids = SetField()
+    content_hash = models.TextField(null=True, blank=True)
+    # Codes, names, sources and owners of the concepts, denormalized so that exports and the index read no concepts
+    from_concept_owner = models.TextField(null=True, blank=True)
+    from_concept_owner_type = models.TextField(null=True, blank=True)
+    from_concept_source = models.TextField(null=True, blank=True)
+    from_concept_mnemonic = models.TextField(null=True, blank=True)
+    from_concept_display_name = models.TextField(null=True, blank=True)
+    from_concept_uri = models.TextField(null=True, blank=True)
+    to_concept_owner = models.TextField(null=True, blank=True)
+    to_concept_owner_type = models.TextField(null=True, blank=True)
+    to_concept_source = models.TextField(null=True, blank=True)
+    to_concept_mnemonic = models.TextField(null=True, blank=True)
+    to_concept_display_name = models.TextField(null=True, blank=True)
+
+    # The display fields are read from the concepts and source these fields refer to
+    DISPLAY_FIELDS = ('from_concept_owner', 'from_concept_owner_type', 'from_concept_source', 'from_concept_mnemonic',
+                      'from_concept_display_name', 'from_concept_uri', 'to_concept_owner', 'to_concept_owner_type',
+                      'to_concept_source', 'to_concept_mnemonic', 'to_concept_display_name')
+    DISPLAY_FIELDS_SOURCES = ('from_concept_id', 'to_concept_id', 'to_source_id', 'to_concept_code', 'to_concept_name')
 
     objects = MongoDBManager()
 
@@ -350,6 +372,7 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
                    [('parent', 1), ('from_concept', 1), ('to_concept', 1), ('retired', 1)],
                    [('versioned_object_id', 1), ('is_latest_version', 1), ('created_at', -1)],
                    [('source_version_ids', 1), ('updated_at', -1)],
+                   [('source_version_ids', 1), ('is_active', 1), ('id', 1)],
                    [('parent_version', 1)],
                    [('previous_version', 1)],
                    [('from_concept', 1)],
@@ -361,9 +384,9 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
             mnemonic='--TEMP--',
             parent= self.parent,
             map_type=self.map_type,
-            from_concept=self.from_concept,
-            to_concept=self.to_concept,
-            to_source=self.to_source,
+            from_concept_id=self.from_concept_id,
+            to_concept_id=self.to_concept_id,
+            to_source_id=self.to_source_id,
             to_concept_code=self.to_concept_code,
             to_concept_name=self.to_concept_name,
             retired=self.retired,
@@ -405,21 +428,59 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
     def from_source(self):
         return self.from_concept.parent
 
+    @property
+    def has_display_fields(self):
+        return self.from_concept_mnemonic is not None
+
+    def get_display_fields(self):
+        """ The values of the display fields, read from the concepts, their sources and owners """
+        from_source = self.from_concept.parent
+        to_source = self.to_source or self.to_concept and self.to_concept.parent
+        return {
+            'from_concept_owner': from_source.owner_name,
+            'from_concept_owner_type': from_source.owner_type,
+            'from_concept_source': from_source.mnemonic,
+            'from_concept_mnemonic': self.from_concept.mnemonic,
+            'from_concept_display_name': self.from_concept.display_name,
+            'from_concept_uri': self.from_concept.url,
+            'to_concept_owner': to_source.owner_name if to_source else None,
+            'to_concept_owner_type': to_source.owner_type if to_source else None,
+            'to_concept_source': to_source.mnemonic if to_source else None,
+            'to_concept_mnemonic': self.to_concept_code or (self.to_concept and self.to_concept.mnemonic),
+            'to_concept_display_name': self.to_concept_name or (self.to_concept and self.to_concept.display_name),
+        }
+
+    def set_display_fields(self, previous_version=None):
+        """
+        Sets the display fields, copied from the previous version if it maps from and to the same concepts,
+        so that a new version of an unchanged mapping loads no concepts, sources or owners.
+        """
+        if previous_version is not None and previous_version.has_display_fields and all(
+                getattr(self, field_name) == getattr(previous_version, field_name)
+                for field_name in self.DISPLAY_FIELDS_SOURCES):
+            display_fields = dict(
+                (field_name, getattr(previous_version, field_name)) for field_name in self.DISPLAY_FIELDS)
+        else:
+            display_fields = self.get_display_fields()
+        for field_name, value in display_fields.items():
+            setattr(self, field_name, value)
+
     @property
     def from_source_owner(self):
-        return self.from_source.owner_name
+        return self.from_concept_owner if self.has_display_fields else self.from_source.owner_name
 
     @property
     def from_source_owner_mnemonic(self):
-        return self.from_source.owner.mnemonic
+        # The owner name is the mnemonic of the owner
+        return self.from_concept_owner if self.has_display_fields else self.from_source.owner.mnemonic
 
     @property
     def from_source_owner_type(self):
-        return self.from_source.owner_type
+        return self.from_concept_owner_type if self.has_display_fields else self.from_source.owner_type
 
     @property
     def from_source_name(self):
-        return self.from_source.mnemonic
+        return self.from_concept_source if self.has_display_fields else self.from_source.mnemonic
 
     @property
     def from_source_url(self):
@@ -431,15 +492,15 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
 
     @property
     def from_concept_code(self):
-        return self.from_concept.mnemonic
+        return self.from_concept_mnemonic if self.has_display_fields else self.from_concept.mnemonic
 
     @property
     def from_concept_name(self):
-        return self.from_concept.display_name
+        return self.from_concept_display_name if self.has_display_fields else self.from_concept.display_name
 
     @property
     def from_concept_url(self):
-        return self.from_concept.url
+        return self.from_concept_uri if self.has_display_fields else self.from_concept.url
 
     @property
     def from_concept_shorthand(self):
@@ -450,6 +511,8 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
 
     @property
     def to_source_name(self):
+        if self.has_display_fields:
+            return self.to_concept_source
         return self.get_to_source() and self.get_to_source().mnemonic
 
     @property
@@ -463,14 +526,20 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
 
     @property
     def to_source_owner(self):
+        if self.has_display_fields:
+            return self.to_concept_owner
         return self.get_to_source() and unicode(self.get_to_source().parent)
 
     @property
     def to_source_owner_mnemonic(self):
+        if self.has_display_fields:
+            return self.to_concept_owner
         return self.get_to_source() and self.get_to_source().owner.mnemonic
 
     @property
     def to_source_owner_type(self):
+        if self.has_display_fields:
+            return self.to_concept_owner_type
         return self.get_to_source() and self.get_to_source().owner_type
 
     @property
@@ -478,9 +547,13 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
         return self.get_to_source() and "%s:%s" % (self.to_source_owner_mnemonic, self.to_source_name)
 
     def get_to_concept_name(self):
+        if self.has_display_fields:
+            return self.to_concept_display_name
         return self.to_concept_name or (self.to_concept and self.to_concept.display_name)
 
     def get_to_concept_code(self):
+        if self.has_display_fields:
+            return self.to_concept_mnemonic
         return self.to_concept_code or (self.to_concept and self.to_concept.mnemonic)
 
     @property
@@ -509,14 +582,14 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
 
     @classmethod
     def for_mapping(cls, mapping, previous_version=None, parent_version=None):
-        return MappingVersion(
+        mapping_version = MappingVersion(
             public_access=mapping.public_access,
             is_active=True,
             parent=mapping.parent,
             map_type=mapping.map_type,
-            from_concept=mapping.from_concept,
-            to_concept=mapping.to_concept,
-            to_source=mapping.to_source,
+            from_concept_id=mapping.from_concept_id,
+            to_concept_id=mapping.to_concept_id,
+            to_source_id=mapping.to_source_id,
             to_concept_code=mapping.to_concept_code,
             to_concept_name=mapping.to_concept_name,
             retired=mapping.retired,
@@ -529,6 +602,7 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
             created_by=mapping.created_by,
             updated_by=mapping.updated_by
         )
+        return mapping_version
 
     @classmethod
     def get_latest_version_by_id(cls, id):
@@ -543,6 +617,7 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
             return errors
         obj.version_created_by = user.username
         previous_version = obj.previous_version
+        obj.set_display_fields(previous_version)
         previous_was_latest = previous_version.is_latest_version and obj.is_latest_version
         source_version = SourceVersion.get_head_of(obj.versioned_object.parent)
 
@@ -577,6 +652,38 @@ class MappingVersion(MappingValidationMixin, ResourceVersionModel):
                 errors['non_field_errors'] = ['An error occurred while %s.' % errored_action]
         return errors
 
+    @classmethod
+    def refresh_display_fields_of(cls, concept):
+        """
+        Updates the display names of the versions mapping from or to the concept, after its names have changed.
+        Returns the IDs of the updated versions.
+        """
+        return cls.refresh_display_fields({concept.id: concept.display_name})
+
+    @classmethod
+    def refresh_display_fields(cls, display_names):
+        """
+        Updates the display names of the versions mapping from or to many concepts, given their new display names
+        by concept id, with a query per direction and an update per concept. Returns the IDs of the updated versions.
+        """
+        from_ids, to_ids = {}, {}
+        for version_id, concept_id, display_name in cls.objects.filter(
+                from_concept_id__in=display_names.keys()).values_list('id', 'from_concept_id', 'from_concept_display_name'):
+            if display_name != display_names[concept_id]:
+                from_ids.setdefault(concept_id, []).append(version_id)
+        # A to concept name given in the mapping takes precedence over the names of the concept
+        for version_id, concept_id, display_name, to_concept_name in cls.objects.filter(
+                to_concept_id__in=display_names.keys()).values_list(
+                'id', 'to_concept_id', 'to_concept_display_name', 'to_concept_name'):
+            if not to_concept_name and display_name != display_names[concept_id]:
+                to_ids.setdefault(concept_id, []).append(version_id)
+
+        for concept_id, version_ids in from_ids.items():
+            cls.objects.filter(id__in=version_ids).update(from_concept_display_name=display_names[concept_id])
+        for concept_id, version_ids in to_ids.items():
+            cls.objects.filter(id__in=version_ids).update(to_concept_display_name=display_names[concept_id])
+        return set(version_id for version_ids in from_ids.values() + to_ids.values() for version_id in version_ids)
+
 
 @receiver(post_save, sender=Source)
 def propagate_parent_attributes(sender, instance=None, created=False, **kwargs):
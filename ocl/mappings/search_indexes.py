@@ -1,8 +1,10 @@
 from haystack import indexes
+from collection.models import CollectionVersion, CollectionMapping
+from concepts.models import Concept
 from mappings.models import Mapping, MappingVersion
 from oclapi.search_backends import SortOrFilterField, FilterField
 from oclapi.search_indexes import OCLSearchIndex
-from sources.models import SourceVersion
+from sources.models import Source, SourceVersion
 from django.db.models import get_model
 
 __author__ = 'misternando'
@@ -38,6 +40,36 @@ class MappingVersionIndex(OCLSearchIndex, indexes.Indexable):
     def get_model(self):
         return MappingVersion
 
+    def prepare_batch(self, objects):
+        # Versions saved before the display fields were denormalized read them from their concepts
+        concept_ids = set()
+        for obj in objects:
+            if not obj.has_display_fields:
+                concept_ids.update(concept_id for concept_id in [obj.from_concept_id, obj.to_concept_id] if concept_id)
+        concepts = dict((concept.id, concept) for concept in Concept.objects.filter(
+            id__in=list(concept_ids))) if concept_ids else {}
+
+        source_ids = set(obj.parent_id for obj in objects)
+        source_ids.update(concept.parent_id for concept in concepts.values())
+        source_ids.update(obj.to_source_id for obj in objects if obj.to_source_id and not obj.has_display_fields)
+        sources = Source.get_sources_with_owners(source_ids)
+        for concept in concepts.values():
+            if concept.parent_id in sources:
+                concept.parent = sources[concept.parent_id]
+
+        collection_version_ids, collection_ids = CollectionVersion.get_collection_ids_by_child(
+            CollectionMapping, 'mapping_id', [obj.id for obj in objects])
+        for obj in objects:
+            if obj.parent_id in sources:
+                obj.parent = sources[obj.parent_id]
+            if obj.from_concept_id in concepts:
+                obj.from_concept = concepts[obj.from_concept_id]
+            if obj.to_concept_id in concepts:
+                obj.to_concept = concepts[obj.to_concept_id]
+            if obj.to_source_id in sources:
+                obj.to_source = sources[obj.to_source_id]
+            obj.cache_collection_ids(collection_version_ids[obj.id], collection_ids[obj.id])
+
     def prepare(self, obj):
         self.prepared_data = super(MappingVersionIndex, self).prepare(obj)
         self.prepared_data['fromConcept'] = [obj.from_concept_url, obj.from_concept_code, obj.from_concept_name]
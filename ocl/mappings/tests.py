@@ -13,6 +13,7 @@ from django.db.utils import IntegrityError
 from django.test import Client
 from django.test.client import MULTIPART_CONTENT, FakePayload
 from django.utils.encoding import force_str
+from mock import mock
 
 from mappings.validation_messages import OPENMRS_SINGLE_MAPPING_BETWEEN_TWO_CONCEPTS, OPENMRS_INVALID_MAPTYPE
 from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS
@@ -879,6 +880,66 @@ class MappingClassMethodsTest(MappingBaseTest):
         self.assertEquals(1, len(source_version.get_mapping_ids()))
         self.assertTrue(MappingVersion.objects.get(versioned_object_id=mapping.id).id in source_version.get_mapping_ids())
 
+    def test_persist_new_denormalizes_display_fields(self):
+        mapping = Mapping(
+            mnemonic='TestMapping',
+            map_type='Same As',
+            from_concept=self.concept1,
+            to_concept=self.concept3,
+            external_id='mapping1',
+        )
+        errors = Mapping.persist_new(mapping, self.user1, parent_resource=self.source1)
+        self.assertEquals(0, len(errors))
+
+        mapping_version = MappingVersion.objects.get(versioned_object_id=mapping.id, is_latest_version=True)
+        self.assertEquals(self.source1.owner_name, mapping_version.from_concept_owner)
+        self.assertEquals(self.source1.owner_type, mapping_version.from_concept_owner_type)
+        self.assertEquals(self.source1.mnemonic, mapping_version.from_concept_source)
+        self.assertEquals(self.concept1.mnemonic, mapping_version.from_concept_mnemonic)
+        self.assertEquals(self.concept1.display_name, mapping_version.from_concept_display_name)
+        self.assertEquals(self.concept1.url, mapping_version.from_concept_uri)
+        self.assertEquals(self.source2.owner_name, mapping_version.to_concept_owner)
+        self.assertEquals(self.source2.owner_type, mapping_version.to_concept_owner_type)
+        self.assertEquals(self.source2.mnemonic, mapping_version.to_concept_source)
+        self.assertEquals(self.concept3.mnemonic, mapping_version.to_concept_mnemonic)
+        self.assertEquals(self.concept3.display_name, mapping_version.to_concept_display_name)
+
+        self.concept3.names = [create_localized_text('Renamed')]
+        self.concept3.save()
+        self.assertSetEqual({mapping_version.id}, MappingVersion.refresh_display_fields_of(self.concept3))
+        self.assertSetEqual(set(), MappingVersion.refresh_display_fields_of(self.concept3))
+        mapping_version = MappingVersion.objects.get(id=mapping_version.id)
+        self.assertEquals('Renamed', mapping_version.get_to_concept_name())
+        self.assertEquals(self.concept1.display_name, mapping_version.from_concept_name)
+
+    def test_persist_changes_copies_display_fields_of_unchanged_concepts(self):
+        mapping = Mapping(
+            mnemonic='TestMapping',
+            map_type='Same As',
+            from_concept=self.concept1,
+            to_concept=self.concept3,
+            external_id='mapping1',
+        )
+        errors = Mapping.persist_new(mapping, self.user1, parent_resource=self.source1)
+        self.assertEquals(0, len(errors))
+
+        mapping.external_id = 'mapping2'
+        with mock.patch.object(MappingVersion, 'get_display_fields') as get_display_fields:
+            errors = Mapping.persist_changes(mapping, self.user1)
+        self.assertEquals(0, len(errors))
+        self.assertFalse(get_display_fields.called)
+
+        mapping_version = MappingVersion.objects.get(versioned_object_id=mapping.id, is_latest_version=True)
+        self.assertEquals('mapping2', mapping_version.external_id)
+        self.assertEquals(self.concept1.display_name, mapping_version.from_concept_display_name)
+        self.assertEquals(self.concept3.display_name, mapping_version.to_concept_display_name)
+
+        mapping.to_concept = self.concept2
+        errors = Mapping.persist_changes(mapping, self.user1)
+        self.assertEquals(0, len(errors))
+        mapping_version = MappingVersion.objects.get(versioned_object_id=mapping.id, is_latest_version=True)
+        self.assertEquals(self.concept2.mnemonic, mapping_version.to_concept_mnemonic)
+        self.assertEquals(self.concept2.display_name, mapping_version.to_concept_display_name)
 
     def test_persist_new_negative__no_creator(self):
         mapping = Mapping(
@@ -1,2 +1,4 @@
 OPENMRS_SINGLE_MAPPING_BETWEEN_TWO_CONCEPTS = 'There can be only one mapping between two concepts'
-OPENMRS_INVALID_MAPTYPE = 'Invalid mapping type'
\ No newline at end of file
+OPENMRS_INVALID_MAPTYPE = 'Invalid mapping type'
+MAPPING_NOT_UNIQUE = 'Parent, map_type, from_concept, to_concept must be unique.'
+EXTERNAL_MAPPING_NOT_UNIQUE = 'Parent, map_type, from_concept, to_source, to_concept_code must be unique.'
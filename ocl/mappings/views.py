@@ -13,7 +13,7 @@ from mappings.serializers import MappingCreateSerializer, MappingUpdateSerialize
 from oclapi.mixins import ListWithHeadersMixin
 from oclapi.models import ACCESS_TYPE_NONE
 from oclapi.views import ConceptDictionaryMixin, BaseAPIView, parse_updated_since_param, VersionedResourceChildMixin
-from sources.models import SourceVersion
+from sources.models import Source, SourceVersion
 from orgs.models import Organization
 from users.models import UserProfile, ORG_OBJECT_TYPE
 
@@ -56,30 +56,41 @@ class MappingVersionCsvMixin:
     def get_csv_rows(self, queryset=None):
         if not queryset:
             queryset = self.get_queryset()
-        values = queryset.values('map_type','versioned_object_id','uri')
+        values = queryset.values('id', 'parent_id', 'map_type', 'to_concept_id', 'retired', 'external_id', 'updated_at',
+                                 'updated_by', 'uri', 'from_concept_owner', 'from_concept_source', 'from_concept_mnemonic',
+                                 'from_concept_display_name', 'to_concept_owner', 'to_concept_source', 'to_concept_mnemonic',
+                                 'to_concept_display_name')
+        sources = {}
         for value in values:
-            mapping = Mapping.objects.get(id=value.pop('versioned_object_id'))
-            value['From Concept Owner'] = mapping.from_source_owner
-            value['From Concept Source'] = mapping.from_source_name
-            value['From Concept Code'] = mapping.from_concept_code
-            value['From Concept Name'] = mapping.from_concept_name
+            version_id = value.pop('id')
+            if value['from_concept_mnemonic'] is None:
+                # Versions saved before the display fields were denormalized
+                display_fields = MappingVersion.objects.get(id=version_id).get_display_fields()
+                value.update([(key, display_fields[key]) for key in value if key in display_fields])
+            source_id = value.pop('parent_id')
+            if source_id not in sources:
+                sources[source_id] = Source.objects.get(id=source_id)
+            value['From Concept Owner'] = value.pop('from_concept_owner')
+            value['From Concept Source'] = value.pop('from_concept_source')
+            value['From Concept Code'] = value.pop('from_concept_mnemonic')
+            value['From Concept Name'] = value.pop('from_concept_display_name')
             value['Map Type'] = value.pop('map_type')
-            value['To Concept Owner'] = mapping.to_source_owner
-            value['To Concept Source'] = mapping.to_source_name
-            value['To Concept Code'] = mapping.get_to_concept_code()
-            value['To Concept Name'] = mapping.get_to_concept_name()
-            value['Internal/External'] = 'Internal' if mapping.to_concept_url else 'External'
-            value['Retired'] = mapping.retired
-            value['External ID'] = mapping.external_id
-            value['Last Updated'] = mapping.updated_at
-            value['Updated By'] = mapping.updated_by
-            value['Mapping Owner'] = mapping.owner
-            value['Mapping Source'] = mapping.source
+            value['To Concept Owner'] = value.pop('to_concept_owner')
+            value['To Concept Source'] = value.pop('to_concept_source')
+            value['To Concept Code'] = value.pop('to_concept_mnemonic')
+            value['To Concept Name'] = value.pop('to_concept_display_name')
+            value['Internal/External'] = 'Internal' if value.pop('to_concept_id') else 'External'
+            value['Retired'] = value.pop('retired')
+            value['External ID'] = value.pop('external_id')
+            value['Last Updated'] = value.pop('updated_at')
+            value['Updated By'] = value.pop('updated_by')
+            value['Mapping Owner'] = sources[source_id].owner_name
+            value['Mapping Source'] = sources[source_id].mnemonic
             value['URI'] = value.pop('uri')
 
         values.field_names.extend(['From Concept Owner','From Concept Source','From Concept Code','From Concept Name','Map Type','To Concept Owner',
                                    'To Concept Source','To Concept Code','To Concept Name','Internal/External','Retired','External ID','Last Updated','Updated By','Mapping Owner','Mapping Source','URI'])
-        del values.field_names[0:3]
+        del values.field_names[0:17]
         return values
 
 class MappingVersionBaseView(ConceptDictionaryMixin):
@@ -0,0 +1,1012 @@
+import Queue
+import collections
+import csv
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import struct
+import threading
+import time
+import urllib
+import zipfile
+import zlib
+import tempfile
+from cStringIO import StringIO
+from datetime import datetime
+
+import msgpack
+from bson import ObjectId
+from django.conf import settings
+from django.db import connections, models
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from rest_framework.utils import encoders
+
+from oclapi.utils import S3ConnectionFactory, RedisConnectionFactory, close_db_connections, get_class
+
+# General purpose flag of zip entries whose sizes and CRC follow their data
+ZIP_DATA_DESCRIPTOR_FLAG = 0x08
+ZIP_DATA_DESCRIPTOR_SIGNATURE = 'PK\x07\x08'
+
+# Progress of exports is kept this long after it was last updated
+EXPORT_PROGRESS_EXPIRES = 86400  # 24 hours
+
+# Query params that do not change the rows of a CSV download
+CSV_DOWNLOAD_IGNORED_PARAMS = ['user']
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class ExportProgress(object):
+    """
+    Phase, items done out of total, throughput and ETA of an export being written, published to Redis under its
+    export path. An export in progress may be cancelled, which it notices between batches.
+    """
+    KEY_PREFIX = 'export_progress:'
+    CANCEL_KEY_PREFIX = 'export_cancel:'
+    COMPLETED = 'completed'
+    CANCELLED = 'cancelled'
+    FAILED = 'failed'
+    ENDED_PHASES = [COMPLETED, CANCELLED, FAILED]
+
+    def __init__(self, export_path):
+        self.key = self.KEY_PREFIX + export_path
+        self.cancel_key = self.CANCEL_KEY_PREFIX + export_path
+        self.started_at = time.time()
+        self.phase = None
+        self.phase_started_at = self.started_at
+        self.done = 0
+        self.total = None
+
+    @classmethod
+    def load(cls, export_path):
+        """ Returns the progress last published for the export path, or None """
+        value = RedisConnectionFactory.get_redis_connection().get(cls.KEY_PREFIX + export_path)
+        return json.loads(value) if value else None
+
+    @classmethod
+    def cancel(cls, export_path):
+        RedisConnectionFactory.get_redis_connection().setex(cls.CANCEL_KEY_PREFIX + export_path,
+                                                            EXPORT_PROGRESS_EXPIRES, 1)
+
+    @classmethod
+    def clear_cancel(cls, export_path):
+        """
+        Clears the cancellation of an earlier export of the path when a new export is requested, so that it does
+        not apply to the new one. An export of the path still in progress stays cancelled.
+        """
+        progress = cls.load(export_path)
+        if progress is None or progress['phase'] in cls.ENDED_PHASES:
+            RedisConnectionFactory.get_redis_connection().delete(cls.CANCEL_KEY_PREFIX + export_path)
+
+    def check_cancelled(self):
+        if RedisConnectionFactory.get_redis_connection().exists(self.cancel_key):
+            raise ExportCancelled()
+
+    def start_phase(self, phase, total=None):
+        self.check_cancelled()
+        self.phase = phase
+        self.phase_started_at = time.time()
+        self.done = 0
+        self.total = total
+        self.publish()
+
+    def advance(self, count):
+        self.done += count
+        self.publish()
+        self.check_cancelled()
+
+    def end(self, phase):
+        """ Publishes one of ENDED_PHASES """
+        self.phase = phase
+        self.publish()
+        RedisConnectionFactory.get_redis_connection().delete(self.cancel_key)
+
+    def get_data(self):
+        now = time.time()
+        phase_seconds = now - self.phase_started_at
+        items_per_second = self.done / phase_seconds if self.done and phase_seconds > 0 else None
+        eta_seconds = None
+        if items_per_second and self.total is not None and self.phase not in self.ENDED_PHASES:
+            eta_seconds = round((self.total - self.done) / items_per_second, 1)
+        return {
+            'phase': self.phase,
+            'done': self.done,
+            'total': self.total,
+            'items_per_second': round(items_per_second, 1) if items_per_second else None,
+            'eta_seconds': eta_seconds,
+            'elapsed_seconds': round(now - self.started_at, 1),
+        }
+
+    def publish(self):
+        RedisConnectionFactory.get_redis_connection().setex(self.key, EXPORT_PROGRESS_EXPIRES,
+                                                            json.dumps(self.get_data()))
+
+
+def write_export_file(version, resource_type, resource_serializer_type, logger, base_version=None, export_format='json'):
+    """
+    Writes the export of the version in one of EXPORT_FORMATS, deflated into a zip archive on the fly and uploaded in
+    parts while the concepts and mappings are still being serialized, so that the export never lands on disk as a whole.
+    With a base version, only the concepts and mappings added or changed since the base version are exported, and
+    a manifest.json lists the URLs of the versions added, changed and removed.
+    Progress is published as an ExportProgress, and raises ExportCancelled once the export has been cancelled and its
+    partial upload removed.
+    """
+    export_path = version.get_export_path(base_version, export_format)
+    progress = ExportProgress(export_path)
+    upload = None
+    try:
+        progress.start_phase('preparing')
+        logger.info('Found %s version %s.  Looking up resource...' % (resource_type, version.mnemonic))
+        resource = version.versioned_object
+        logger.info('Found %s %s.  Serializing attributes...' % (resource_type, resource.mnemonic))
+
+        resource_serializer = get_class(resource_serializer_type)(version)
+        data = resource_serializer.data
+        output_format = EXPORT_FORMATS[export_format]
+        resource_string = output_format.get_header(data)
+        logger.info('Done serializing attributes.')
+
+        batch_size = 1000
+        if base_version:
+            progress.start_phase('comparing')
+            logger.info('Comparing with %s version %s...' % (resource_type, base_version.mnemonic))
+            concepts_delta = get_export_delta(
+                'concepts.models.ConceptVersion', base_version.get_concept_id_batches(batch_size, active_only=False),
+                version.get_concept_id_batches(batch_size, active_only=False), version.get_concept_id_batches(batch_size))
+            mappings_delta = get_export_delta(
+                'mappings.models.MappingVersion', base_version.get_mapping_id_batches(batch_size, active_only=False),
+                version.get_mapping_id_batches(batch_size, active_only=False), version.get_mapping_id_batches(batch_size))
+            concept_id_batches = concepts_delta.get_exported_id_batches(batch_size)
+            mapping_id_batches = mappings_delta.get_exported_id_batches(batch_size)
+            logger.info('Concepts %s, mappings %s.' % (concepts_delta, mappings_delta))
+        else:
+            concept_id_batches = version.get_concept_id_batches(batch_size)
+            mapping_id_batches = version.get_mapping_id_batches(batch_size)
+
+        upload = get_export_storage().get_upload(export_path)
+        logger.info('Uploading export to %s...' % export_path)
+        out = StreamingZipFile(upload)
+        out.start_entry(output_format.entry_name)
+        out.write(resource_string)
+        logger.info('Serializing concepts in batches of %d...' % batch_size)
+        write_export_batches(out, concept_id_batches, 'concepts.models.ConceptVersion',
+                             'concepts.export.ConceptVersionExportEncoder', 'concepts', logger, export_format,
+                             progress=progress)
+        logger.info('Done serializing concepts.')
+
+        out.write(output_format.get_mappings_header())
+        logger.info('Serializing mappings in batches of %d...' % batch_size)
+        write_export_batches(out, mapping_id_batches, 'mappings.models.MappingVersion',
+                             'mappings.serializers.MappingVersionDetailSerializer', 'mappings', logger, export_format,
+                             progress=progress)
+        logger.info('Done serializing mappings.')
+        out.write(output_format.get_footer())
+
+        if base_version:
+            out.start_entry('manifest.json')
+            out.write(json.dumps({
+                'version_url': version.url,
+                'base_version_url': base_version.url,
+                'concepts': concepts_delta.get_manifest(),
+                'mappings': mappings_delta.get_manifest(),
+            }))
+        out.close()
+        progress.start_phase('uploading')
+        logger.info('Done compressing.  Completing upload...')
+        upload.complete()
+    except ExportCancelled:
+        if upload:
+            upload.cancel()
+        progress.end(ExportProgress.CANCELLED)
+        logger.info('Export to %s cancelled.' % export_path)
+        raise
+    except:
+        if upload:
+            upload.cancel()
+        progress.end(ExportProgress.FAILED)
+        raise
+    progress.end(ExportProgress.COMPLETED)
+    logger.info('Uploaded to %s.' % export_path)
+
+
+def diff_sorted_ids(base_ids, ids):
+    """
+    Returns the ids only in ids and the ids only in base_ids. Both must be iterables of ids in ascending order,
+    which are compared as they are iterated, so that neither needs to be held in memory.
+    """
+    base_ids, ids = iter(base_ids), iter(ids)
+    added_ids, removed_ids = [], []
+    base_id, _id = next(base_ids, None), next(ids, None)
+    while base_id is not None or _id is not None:
+        if base_id is None or (_id is not None and _id < base_id):
+            added_ids.append(_id)
+            _id = next(ids, None)
+        elif _id is None or base_id < _id:
+            removed_ids.append(base_id)
+            base_id = next(base_ids, None)
+        else:
+            base_id, _id = next(base_ids, None), next(ids, None)
+    return added_ids, removed_ids
+
+
+class ExportDelta(object):
+    """
+    Versions of concepts or mappings added, changed or removed between two versions of a source or collection,
+    as (id, url) pairs. A version is changed rather than added if a version of the same concept or mapping has
+    been removed.
+    """
+
+    def __init__(self, added, changed, removed):
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+
+    def __str__(self):
+        return '%d added, %d changed, %d removed' % (len(self.added), len(self.changed), len(self.removed))
+
+    def get_exported_id_batches(self, batch_size):
+        ids = sorted(_id for _id, _ in self.added + self.changed)
+        return [ids[start:start + batch_size] for start in range(0, len(ids), batch_size)]
+
+    def get_manifest(self):
+        return dict((name, [url for _, url in versions]) for name, versions in [
+            ('added', self.added), ('changed', self.changed), ('removed', self.removed)])
+
+
+def get_export_delta(model_type, base_id_batches, id_batches, active_id_batches=None):
+    """
+    Compares the member ids of two versions, streamed in ascending order in batches, and returns an ExportDelta.
+    Members are compared regardless of is_active, since a version deactivated in place stays a member of both. Given
+    the active member ids of the target version, members inactive in the target are reported as removed.
+    """
+    model = get_class(model_type)
+    added_ids, removed_ids = diff_sorted_ids(
+        itertools.chain.from_iterable(base_id_batches), itertools.chain.from_iterable(id_batches))
+    if active_id_batches is not None:
+        inactive_ids, _ = diff_sorted_ids(
+            itertools.chain.from_iterable(active_id_batches), itertools.chain.from_iterable(id_batches))
+        inactive_ids = set(inactive_ids)
+        if inactive_ids:
+            removed_ids += sorted(inactive_ids.difference(added_ids))
+            added_ids = [_id for _id in added_ids if _id not in inactive_ids]
+
+    def get_versions(ids):
+        versions = []
+        for _id, versioned_object_id, uri in model.objects.filter(id__in=ids).values_list(
+                'id', 'versioned_object_id', 'uri'):
+            versions.append((versioned_object_id, (_id, uri or model.objects.get(id=_id).url)))
+        return versions
+
+    added_versions, removed_versions = get_versions(added_ids), get_versions(removed_ids)
+    added_objects = set(versioned_object_id for versioned_object_id, _ in added_versions)
+    removed_objects = set(versioned_object_id for versioned_object_id, _ in removed_versions)
+    return ExportDelta(
+        sorted(version for versioned_object_id, version in added_versions if versioned_object_id not in removed_objects),
+        sorted(version for versioned_object_id, version in added_versions if versioned_object_id in removed_objects),
+        sorted(version for versioned_object_id, version in removed_versions if versioned_object_id not in added_objects))
+
+
+class JsonExportFormat(object):
+    """ A JSON object with the attributes of the resource and arrays of its concepts and mappings """
+    name = 'json'
+    entry_name = 'export.json'
+    batch_separator = ', '
+
+    def get_header(self, data):
+        return '%s, "concepts": [' % json.dumps(data, cls=encoders.JSONEncoder)[:-1]
+
+    def get_mappings_header(self):
+        return '], "mappings": ['
+
+    def get_footer(self):
+        return ']}'
+
+    def serialize(self, data):
+        """ Serializes a list of concepts or mappings, without the enclosing brackets """
+        return json.dumps(data, cls=encoders.JSONEncoder)[1:-1]
+
+
+class NdjsonExportFormat(JsonExportFormat):
+    """ Newline-delimited JSON: the resource, then each concept and mapping, one per line """
+    name = 'ndjson'
+    entry_name = 'export.ndjson'
+    batch_separator = ''
+
+    def get_header(self, data):
+        return self.serialize([data])
+
+    def get_mappings_header(self):
+        return ''
+
+    def get_footer(self):
+        return ''
+
+    def serialize(self, data):
+        return ''.join(json.dumps(item, cls=encoders.JSONEncoder) + '\n' for item in data)
+
+
+class MessagePackExportFormat(NdjsonExportFormat):
+    """ A stream of MessagePack maps: the resource, then each concept and mapping """
+    name = 'msgpack'
+    entry_name = 'export.msgpack'
+
+    def serialize(self, data):
+        encoder = encoders.JSONEncoder()
+        return ''.join(msgpack.packb(item, default=encoder.default) for item in data)
+
+
+EXPORT_FORMATS = dict((export_format.name, export_format) for export_format in [
+    JsonExportFormat(), NdjsonExportFormat(), MessagePackExportFormat()])
+
+
+class ExportEncoder(object):
+    """
+    Encodes batches of objects of an export into the data their detail serializer would produce, without going
+    through the serializer. An encoder is created once per export and worker process, so it may cache what the
+    batches of an export share, such as their sources and owners.
+    """
+
+    def encode_batch(self, ids):
+        """ Returns the data of the objects with the ids, in ascending order of id """
+        raise NotImplementedError
+
+
+# Encoders of the export being written, by type
+export_encoders = {}
+
+
+def get_export_encoder(encoder_type):
+    if encoder_type not in export_encoders:
+        export_encoders[encoder_type] = get_class(encoder_type)()
+    return export_encoders[encoder_type]
+
+
+def find_export_documents(model, ids, fields):
+    """ Reads the raw documents of the objects with the ids, in ascending order of id, with only the fields given """
+    collection = connections['default'].get_collection(model._meta.db_table)
+    return collection.find({'_id': {'$in': [ObjectId(_id) for _id in ids]}}, fields=fields).sort('_id', 1)
+
+
+def serialize_export_batch(batch):
+    """
+    Serializes a batch of objects of an export in one of EXPORT_FORMATS, with an ExportEncoder or a serializer
+    """
+    model_type, serializer_type, export_format, ids = batch
+    serializer_class = get_class(serializer_type)
+    if issubclass(serializer_class, ExportEncoder):
+        data = get_export_encoder(serializer_type).encode_batch(ids)
+    else:
+        objects = get_class(model_type).objects.filter(id__in=ids).order_by('id')
+        data = serializer_class(objects, many=True).data
+    return EXPORT_FORMATS[export_format].serialize(data)
+
+
+def init_export_worker():
+    close_db_connections()
+    export_encoders.clear()
+
+
+def imap_bounded(pool, func, items, window):
+    """ Like pool.imap, but with at most window items being processed or waiting to be consumed at any time """
+    pending = collections.deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def write_export_batches(out, id_batches, model_type, serializer_type, resource_name, logger, export_format='json',
+                         workers=None, progress=None):
+    """
+    Serializes the batches of objects in settings.EXPORT_WORKERS worker processes and writes them to out in the
+    order of the batches. Workers serialize at most two batches each ahead of the writer. serializer_type is the
+    type of either a serializer or an ExportEncoder. With an ExportProgress, the batches written are counted in a
+    phase named after resource_name.
+    """
+    workers = workers or settings.EXPORT_WORKERS
+    id_batches = list(id_batches)
+    if progress:
+        progress.start_phase(resource_name, sum(len(ids) for ids in id_batches))
+    batches = [(model_type, serializer_type, export_format, ids) for ids in id_batches]
+    pool = None
+    try:
+        if workers > 1 and len(batches) > 1:
+            close_db_connections()
+            pool = multiprocessing.Pool(min(workers, len(batches)), initializer=init_export_worker)
+            serialized_batches = imap_bounded(pool, serialize_export_batch, batches, 2 * workers)
+        else:
+            serialized_batches = itertools.imap(serialize_export_batch, batches)
+
+        start = 0
+        for index, serialized_batch in enumerate(serialized_batches):
+            end = start + len(id_batches[index])
+            logger.info('Serialized %s %d - %d.' % (resource_name, start + 1, end))
+            if index:
+                out.write(EXPORT_FORMATS[export_format].batch_separator)
+            out.write(serialized_batch)
+            start = end
+            if progress:
+                progress.advance(len(id_batches[index]))
+
+        if pool:
+            pool.close()
+            pool.join()
+    finally:
+        export_encoders.clear()
+        if pool:
+            pool.terminate()
+
+
+class StreamingZipFile(object):
+    """
+    Deflates what is written to it into the entries of a zip archive, written to stream as it goes.
+    The sizes and CRC of each entry follow its data in a data descriptor, so the stream needs not be seekable.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.offset = 0
+        self.entries = []
+        self.entry = None
+        self.compressor = None
+
+    def start_entry(self, name, date_time=None):
+        """ Finishes the current entry, if any, and starts a new one that what is written next goes to """
+        self.finish_entry()
+        self.entry = zipfile.ZipInfo(name, (date_time or datetime.now()).timetuple()[:6])
+        self.entry.compress_type = zipfile.ZIP_DEFLATED
+        self.entry.flag_bits = ZIP_DATA_DESCRIPTOR_FLAG
+        self.entry.header_offset = self.offset
+        self.entry.CRC = self.entry.compress_size = self.entry.file_size = 0
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.write_to_stream(self.entry.FileHeader())
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.check_size(self.entry.file_size + len(data))
+        self.entry.CRC = zlib.crc32(data, self.entry.CRC)
+        self.entry.file_size += len(data)
+        compressed = self.compressor.compress(data)
+        self.entry.compress_size += len(compressed)
+        self.write_to_stream(compressed)
+
+    def finish_entry(self):
+        if self.entry is None:
+            return
+        compressed = self.compressor.flush()
+        self.entry.compress_size += len(compressed)
+        self.write_to_stream(compressed)
+        self.entry.CRC &= 0xffffffff
+        self.write_to_stream(struct.pack(
+            '<4s3L', ZIP_DATA_DESCRIPTOR_SIGNATURE, self.entry.CRC, self.entry.compress_size, self.entry.file_size))
+        self.entries.append(self.entry)
+        self.entry = None
+
+    def close(self):
+        """ Finishes the current entry and writes the central directory """
+        self.finish_entry()
+        central_directory_offset = self.offset
+        for entry in self.entries:
+            dos_date = (entry.date_time[0] - 1980) << 9 | entry.date_time[1] << 5 | entry.date_time[2]
+            dos_time = entry.date_time[3] << 11 | entry.date_time[4] << 5 | entry.date_time[5] // 2
+            self.write_to_stream(struct.pack(
+                zipfile.structCentralDir, zipfile.stringCentralDir, 20, 3, 20, 0, entry.flag_bits,
+                entry.compress_type, dos_time, dos_date, entry.CRC, entry.compress_size, entry.file_size,
+                len(entry.filename), 0, 0, 0, 0, 0644 << 16, entry.header_offset))
+            self.write_to_stream(entry.filename)
+        self.write_to_stream(struct.pack(
+            zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0, len(self.entries), len(self.entries),
+            self.offset - central_directory_offset, central_directory_offset, 0))
+
+    def check_size(self, size):
+        """ Raises LargeZipFile before a size or offset past what a zip archive without ZIP64 extensions holds """
+        if size > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile('The export is too large for a zip archive without ZIP64 extensions')
+
+    def write_to_stream(self, data):
+        # The compressed size of an entry never exceeds the offset of the end of its data
+        self.check_size(self.offset + len(data))
+        self.stream.write(data)
+        self.offset += len(data)
+
+
+class ExportUpload(object):
+    """
+    Buffers what is written to it in memory and hands every part of part_size bytes to a background thread that
+    uploads it while writing continues. At most one part waits for the upload of the previous one.
+    """
+
+    def __init__(self, part_size):
+        self.part_size = part_size
+        self.part = StringIO()
+        self.part_number = 0
+        self.parts = Queue.Queue(maxsize=1)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.upload_parts)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data):
+        self.part.write(data)
+        if self.part.tell() >= self.part_size:
+            self.flush_part()
+
+    def flush_part(self):
+        if self.error:
+            raise self.error
+        self.part_number += 1
+        self.part.seek(0)
+        self.parts.put((self.part_number, self.part))
+        self.part = StringIO()
+
+    def upload_parts(self):
+        while True:
+            item = self.parts.get()
+            if item is None:
+                return
+            if self.error:
+                continue
+            try:
+                self.upload_part(*item)
+            except Exception as exc:
+                self.error = exc
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.parts.put(None)
+            self.thread.join()
+
+    def complete(self):
+        """ Uploads the last part and waits for the upload of all parts to finish """
+        if self.part.tell() or not self.part_number:
+            self.flush_part()
+        self.close()
+        if self.error:
+            raise self.error
+        self.finish()
+
+    def cancel(self):
+        self.close()
+        self.abort()
+
+    def upload_part(self, part_number, part):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class S3MultipartUpload(ExportUpload):
+    """ Uploads the parts to the export bucket as a multipart upload """
+
+    def __init__(self, key_name, part_size):
+        self.multipart_upload = S3ConnectionFactory.get_export_bucket().initiate_multipart_upload(key_name)
+        super(S3MultipartUpload, self).__init__(part_size)
+
+    def upload_part(self, part_number, part):
+        self.multipart_upload.upload_part_from_file(part, part_number)
+
+    def finish(self):
+        self.multipart_upload.complete_upload()
+
+    def abort(self):
+        self.multipart_upload.cancel_upload()
+
+
+class LocalDirectoryUpload(ExportUpload):
+    """ Stand-in for S3MultipartUpload that appends the parts to a file under a local directory """
+
+    def __init__(self, directory, key_name, part_size):
+        self.file_name = os.path.join(directory, key_name)
+        if not os.path.exists(os.path.dirname(self.file_name)):
+            os.makedirs(os.path.dirname(self.file_name))
+        self.file = open(self.file_name + '.part', 'wb')
+        super(LocalDirectoryUpload, self).__init__(part_size)
+
+    def upload_part(self, part_number, part):
+        shutil.copyfileobj(part, self.file)
+
+    def finish(self):
+        self.file.close()
+        os.rename(self.file_name + '.part', self.file_name)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.file_name + '.part')
+
+
+class ExportStorage(object):
+    """ Where the exports of source and collection versions are kept, by export path """
+
+    def exists(self, key_name):
+        raise NotImplementedError
+
+    def get_url(self, key_name, expires_in):
+        """ Returns a URL that the export can be downloaded from for expires_in seconds """
+        raise NotImplementedError
+
+    def get_upload(self, key_name):
+        """ Returns an ExportUpload of the export """
+        raise NotImplementedError
+
+    def delete(self, key_name):
+        raise NotImplementedError
+
+    def key_names(self, prefix):
+        """ Returns the paths of the exports that start with prefix """
+        raise NotImplementedError
+
+
+class S3ExportStorage(ExportStorage):
+    """ Keeps exports in the export bucket """
+
+    def get_bucket(self):
+        return S3ConnectionFactory.get_export_bucket(validate=False)
+
+    def exists(self, key_name):
+        return self.get_bucket().get_key(key_name) is not None
+
+    def get_url(self, key_name, expires_in):
+        # The URL is signed locally, without a request to S3
+        return self.get_bucket().new_key(key_name).generate_url(expires_in)
+
+    def get_upload(self, key_name):
+        return S3MultipartUpload(key_name, settings.EXPORT_PART_SIZE)
+
+    def delete(self, key_name):
+        self.get_bucket().delete_key(key_name)
+
+    def key_names(self, prefix):
+        return [key.name for key in self.get_bucket().list(prefix)]
+
+
+class LocalDirectoryExportStorage(ExportStorage):
+    """ Stand-in for S3ExportStorage that keeps exports under a local directory, served under url if it is given """
+
+    def __init__(self, directory, url=None):
+        self.directory = directory
+        self.url = url
+
+    def get_file_name(self, key_name):
+        return os.path.join(self.directory, key_name)
+
+    def exists(self, key_name):
+        return os.path.exists(self.get_file_name(key_name))
+
+    def get_url(self, key_name, expires_in):
+        if self.url:
+            return self.url + urllib.quote(key_name)
+        return 'file://' + urllib.pathname2url(os.path.abspath(self.get_file_name(key_name)))
+
+    def get_upload(self, key_name):
+        return LocalDirectoryUpload(self.directory, key_name, settings.EXPORT_PART_SIZE)
+
+    def delete(self, key_name):
+        if self.exists(key_name):
+            os.remove(self.get_file_name(key_name))
+
+    def key_names(self, prefix):
+        key_names = []
+        for directory, _, file_names in os.walk(self.get_file_name(os.path.dirname(prefix))):
+            for file_name in file_names:
+                key_name = os.path.relpath(os.path.join(directory, file_name), self.directory)
+                if key_name.startswith(prefix) and not key_name.endswith('.part'):
+                    key_names.append(key_name)
+        return key_names
+
+
+class CachedExportStorage(ExportStorage):
+    """
+    Cache tier in front of another ExportStorage, on a local or shared directory. Export paths include the time of
+    the last change to the version, so an export never changes once it exists: the cache remembers which exports
+    exist and keeps copies of the exports uploaded through it, served under url if it is given. When the copies
+    grow past max_size bytes, the least recently used ones are evicted.
+    """
+    EXISTS_DIRECTORY = '.exists'
+    TEMPORARY_PREFIX = '.upload'
+
+    def __init__(self, storage, directory, max_size, url=None):
+        self.storage = storage
+        self.directory = directory
+        self.max_size = max_size
+        self.url = url
+
+    def get_file_name(self, key_name):
+        return os.path.join(self.directory, key_name)
+
+    def get_marker_name(self, key_name):
+        return os.path.join(self.directory, self.EXISTS_DIRECTORY, key_name)
+
+    def remember(self, key_name):
+        marker_name = self.get_marker_name(key_name)
+        if not os.path.exists(os.path.dirname(marker_name)):
+            os.makedirs(os.path.dirname(marker_name))
+        open(marker_name, 'a').close()
+
+    def forget(self, key_name):
+        for file_name in [self.get_file_name(key_name), self.get_marker_name(key_name)]:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    def exists(self, key_name):
+        try:
+            # Markers are evicted with the least recently used exports
+            os.utime(self.get_marker_name(key_name), None)
+            return True
+        except OSError:
+            pass
+        exists = self.storage.exists(key_name)
+        if exists:
+            self.remember(key_name)
+        return exists
+
+    def get_url(self, key_name, expires_in):
+        file_name = self.get_file_name(key_name)
+        if self.url and os.path.exists(file_name):
+            try:
+                os.utime(file_name, None)
+                return self.url + urllib.quote(key_name)
+            except OSError:
+                pass  # Evicted in the meantime
+        return self.storage.get_url(key_name, expires_in)
+
+    def get_upload(self, key_name):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        return CachingUpload(self.storage.get_upload(key_name), self, key_name)
+
+    def delete(self, key_name):
+        self.forget(key_name)
+        self.storage.delete(key_name)
+
+    def key_names(self, prefix):
+        return self.storage.key_names(prefix)
+
+    def add(self, key_name, temporary_file_name):
+        """ Moves the file of an export just uploaded into the cache, unless it would not fit on its own """
+        self.remember(key_name)
+        if os.path.getsize(temporary_file_name) > self.max_size:
+            os.remove(temporary_file_name)
+            return
+        file_name = self.get_file_name(key_name)
+        if not os.path.exists(os.path.dirname(file_name)):
+            os.makedirs(os.path.dirname(file_name))
+        os.rename(temporary_file_name, file_name)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used exports until the cache is no larger than max_size, with their markers, and
+        the markers of exports that are not cached if they were used less recently than any export left
+        """
+        cached_files, markers = [], []
+        for directory, directory_names, file_names in os.walk(self.directory):
+            is_marker = directory.startswith(os.path.join(self.directory, self.EXISTS_DIRECTORY))
+            for file_name in file_names:
+                if file_name.startswith(self.TEMPORARY_PREFIX):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(directory, file_name))
+                except OSError:
+                    continue
+                entry = (stat.st_mtime, stat.st_size, os.path.join(directory, file_name))
+                (markers if is_marker else cached_files).append(entry)
+
+        size = sum(file_size for _, file_size, _ in cached_files)
+        cached_files.sort()
+        while cached_files and size > self.max_size:
+            _, file_size, file_name = cached_files.pop(0)
+            self.remove(file_name)
+            self.remove(self.get_marker_name(os.path.relpath(file_name, self.directory)))
+            size -= file_size
+
+        oldest = cached_files[0][0] if cached_files else None
+        for mtime, _, marker_name in markers:
+            key_name = os.path.relpath(marker_name, os.path.join(self.directory, self.EXISTS_DIRECTORY))
+            if (oldest is None or mtime < oldest) and not os.path.exists(self.get_file_name(key_name)):
+                self.remove(marker_name)
+
+    def remove(self, file_name):
+        try:
+            os.remove(file_name)
+        except OSError:
+            pass  # Evicted by another process
+
+
+class CachingUpload(object):
+    """ An upload that also writes the export to a file, added to the cache once the upload completes """
+
+    def __init__(self, upload, cache, key_name):
+        self.upload = upload
+        self.cache = cache
+        self.key_name = key_name
+        self.file = tempfile.NamedTemporaryFile(prefix=cache.TEMPORARY_PREFIX, dir=cache.directory, delete=False)
+
+    def write(self, data):
+        self.upload.write(data)
+        self.file.write(data)
+
+    def remove_file(self):
+        self.file.close()
+        if os.path.exists(self.file.name):
+            os.remove(self.file.name)
+
+    def complete(self):
+        self.file.close()
+        try:
+            self.upload.complete()
+        except:
+            self.remove_file()
+            raise
+        self.cache.add(self.key_name, self.file.name)
+
+    def cancel(self):
+        self.remove_file()
+        self.upload.cancel()
+
+
+def get_export_storage():
+    """
+    Returns the storage of exports: settings.EXPORT_LOCAL_DIRECTORY if it is set, or S3, behind a cache in
+    settings.EXPORT_CACHE_DIRECTORY if it is set
+    """
+    if settings.EXPORT_LOCAL_DIRECTORY:
+        storage = LocalDirectoryExportStorage(settings.EXPORT_LOCAL_DIRECTORY)
+    else:
+        storage = S3ExportStorage()
+    if settings.EXPORT_CACHE_DIRECTORY:
+        storage = CachedExportStorage(storage, settings.EXPORT_CACHE_DIRECTORY, settings.EXPORT_CACHE_SIZE,
+                                      settings.EXPORT_CACHE_URL)
+    return storage
+
+
+def keyset_batches(queryset, batch_size, key='id', after=None):
+    """
+    Yields the results of the queryset in batches ordered by key. Each batch is queried for the keys after the last
+    one of the previous batch, rather than skipping over the previous batches, so that the cost of a batch does not
+    grow with how far into the results it is. Works with flat values_list querysets of the key as well.
+    Given after, starts with the keys after it.
+    """
+    last_key = after
+    while True:
+        page = queryset.order_by(key)
+        if last_key is not None:
+            page = page.filter(**{'%s__gt' % key: last_key})
+        batch = list(page[:batch_size])
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            return
+        last = batch[-1]
+        last_key = getattr(last, key) if isinstance(last, models.Model) else last
+
+
+class CsvLineBuffer(object):
+    """ Hands back what a csv writer writes to it, so that the lines it writes can be yielded one at a time """
+
+    def write(self, line):
+        return line
+
+
+def get_csv_value(value):
+    """ The value as djqscsv writes it: datetimes in ISO 8601, None as an empty string and text in UTF-8 """
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+def iter_csv(rows, field_names):
+    """ Yields the header, then the lines of the rows, dicts such as those of a values queryset, as CSV """
+    writer = csv.writer(CsvLineBuffer())
+    yield writer.writerow([get_csv_value(field_name) for field_name in field_names])
+    for row in rows:
+        yield writer.writerow([get_csv_value(row.get(field_name)) for field_name in field_names])
+
+
+def iter_chunks(strings, chunk_size=65536):
+    """ Joins the strings into chunks of about chunk_size bytes """
+    chunk, size = [], 0
+    for string in strings:
+        chunk.append(string)
+        size += len(string)
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def gzip_chunks(chunks):
+    """ Compresses the chunks into a gzip stream as they are iterated """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def get_csv_response(data, filename, compress=False):
+    """
+    Streams the rows of data, a values queryset as CSV, as they are formatted, gzip-compressed on the fly if
+    compress is set
+    """
+    content = iter_chunks(iter_csv(data, data.field_names))
+    response = StreamingHttpResponse(gzip_chunks(content) if compress else content, content_type='text/csv')
+    if compress:
+        response['Content-Encoding'] = 'gzip'
+    patch_vary_headers(response, ['Accept-Encoding'])
+    response['Content-Disposition'] = 'attachment; filename="%s.csv"' % filename
+    return response
+
+
+def get_csv_download_prefix(filename, is_owner):
+    """ The prefix of the keys of the CSV downloads of filename """
+    return '%s/%s/' % ('downloads/creator' if is_owner else 'downloads/reader', filename)
+
+
+def get_csv_download_key(filename, is_owner, query_params, last_update=None):
+    """
+    The key of the CSV download of filename for the query params, ignoring their order and the empty ones. Downloads
+    of the children of a version are keyed by its last child update as well, so they are reused until it changes.
+    """
+    params = sorted((name, [value.encode('utf-8') for value in query_params.getlist(name) if value])
+                    for name in query_params if name not in CSV_DOWNLOAD_IGNORED_PARAMS)
+    digest = hashlib.md5(urllib.urlencode([param for param in params if param[1]], True)).hexdigest()
+    prefix = get_csv_download_prefix(filename, is_owner)
+    if last_update is None:
+        return '%s%s.csv.zip' % (prefix, digest)
+    return '%s%s/%s.csv.zip' % (prefix, last_update.strftime('%Y%m%d%H%M%S'), digest)
+
+
+def write_csv_download(data, key_name, storage, filename='download'):
+    """
+    Writes the rows of data, a values queryset, as a zipped CSV file named filename to the storage. The files are
+    written under a temporary directory of their own, so that concurrent downloads do not share them.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        csv_path = os.path.join(tmpdir, filename + '.csv')
+        with open(csv_path, 'wb') as csv_file:
+            for chunk in iter_chunks(iter_csv(data, data.field_names)):
+                csv_file.write(chunk)
+        zip_path = csv_path + '.zip'
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip:
+            zip.write(csv_path, os.path.basename(csv_path))
+
+        upload = storage.get_upload(key_name)
+        try:
+            with open(zip_path, 'rb') as zip_file:
+                shutil.copyfileobj(zip_file, upload)
+        except:
+            upload.cancel()
+            raise
+        upload.complete()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def evict_csv_downloads(storage, prefix, key_name):
+    """ Deletes the CSV downloads under prefix that were written for other versions than the one of key_name """
+    version_prefix = key_name[:key_name.rindex('/') + 1]
+    for stale_key_name in storage.key_names(prefix):
+        if not stale_key_name.startswith(version_prefix):
+            storage.delete(stale_key_name)
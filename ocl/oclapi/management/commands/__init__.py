@@ -58,6 +58,13 @@ class ImportActionHelper(object):
                 combined_action_value -= individual_action_value
         return combined_action_text
 
+    @classmethod
+    def merge_action_count(cls, action_count, other_action_count):
+        """ Adds the counts of other_action_count, e.g. of an import worker, to action_count """
+        for action_value, num in other_action_count.items():
+            action_count[action_value] = action_count.get(action_value, 0) + num
+        return action_count
+
     @classmethod
     def get_progress_descriptor(cls, str_import_type, current_num, total_num, action_count):
         """ Returns a string with the current counts of the import process """
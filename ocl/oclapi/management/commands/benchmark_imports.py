@@ -0,0 +1,305 @@
+""" benchmark_imports - Command to benchmark the concepts and mappings importers on the perf_data files """
+import json
+import os
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import BaseCommand, CommandError
+from django.core.management.base import OutputWrapper
+
+from concepts.importer import ConceptsImporter
+from concepts.models import Concept, ConceptVersion, LocalizedText
+from mappings.importer import MappingsImporter, MappingsIndex
+from mappings.models import Mapping, MappingVersion
+from oclapi.management.commands import ImportActionHelper
+from orgs.models import Organization
+from sources.models import Source, SourceVersion
+from users.models import UserProfile
+
+PERF_DATA_DIR = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'perf_data')
+CONCEPTS_FILE = os.path.join(PERF_DATA_DIR, 'ciel_20160711_concepts_2k.json')
+MAPPINGS_FILE = os.path.join(PERF_DATA_DIR, 'ciel_20160711_mappings_2k.json')
+
+# The source the perf_data files are imported into, followed by the sources their external mappings point to
+ORG_SOURCES = [('perf', 'src'), ('IHTSDO', 'SNOMED-CT'), ('WHO', 'ICD-10-WHO'), ('AMPATH', 'AMPATH'),
+               ('IMO', 'IMO-ProblemIT'), ('3BT', '3BT'), ('WICC', 'ICPC2'), ('IHTSDO', 'SNOMED-NP'), ('PIH', 'PIH'),
+               ('IMO', 'IMO-ProcedureIT'), ('HL7', 'HL-7-CVX'), ('Regenstrief', 'LOINC'), ('PIH', 'PIH-Malawi'),
+               ('OpenMRS', 'org.openmrs.module.mdrtb'), ('NLM', 'RxNORM'), ('WHO', 'ICD-10-WHO-2nd'),
+               ('CIEL', 'SNOMED-MVP'), ('NLM', 'RxNORM-Comb'), ('OpenMRS', 'org.openmrs.module.emrapi')]
+
+PHASES = ['parse', 'lookup', 'validate', 'write', 'index']
+
+# Every DIFF_INTERVAL-th line is changed for the diff re-import
+DIFF_INTERVAL = 10
+
+
+class PhaseTimer(object):
+    """
+    Accumulates the time spent in the methods wrapped for each phase. Time spent in a nested phase, e.g. validation
+    while a mapping is written, counts towards the nested phase only.
+    """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.stack = []
+        self.patches = []
+
+    def start(self, phase):
+        now = time.time()
+        if self.stack:
+            outer_phase, outer_start = self.stack[-1]
+            self.seconds[outer_phase] += now - outer_start
+        self.stack.append([phase, now])
+
+    def stop(self):
+        now = time.time()
+        phase, started = self.stack.pop()
+        self.seconds[phase] += now - started
+        if self.stack:
+            self.stack[-1][1] = now
+
+    def wrap(self, phase, function):
+        def timed(*args, **kwargs):
+            self.start(phase)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.stop()
+        return timed
+
+    def instrument(self, phase, obj, *names):
+        """ Times the methods of an object or a class until restore is called """
+        for name in names:
+            self.patches.append((obj, name, obj.__dict__.get(name)))
+            setattr(obj, name, self.wrap(phase, getattr(obj, name)))
+
+    def restore(self):
+        for obj, name, original in reversed(self.patches):
+            if original is None:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, original)
+        self.patches = []
+
+
+def use_mongomock():
+    """ Replaces the MongoDB connection of django_mongodb_engine with an in-memory mongomock one """
+    try:
+        import mongomock
+    except ImportError:
+        raise CommandError('--mongomock requires the mongomock package.')
+    from django_mongodb_engine import base
+    if not hasattr(base, 'Connection'):
+        raise CommandError('This version of django_mongodb_engine cannot be run against mongomock.')
+    base.Connection = mongomock.MongoClient
+
+
+def write_lines(lines):
+    input_file = tempfile.NamedTemporaryFile(prefix='benchmark_', suffix='.json', delete=False)
+    with input_file:
+        for line in lines:
+            input_file.write(line if line.endswith('\n') else line + '\n')
+    return input_file.name
+
+
+def change_concept(line, revision):
+    data = json.loads(line)
+    data['extras'] = dict(data.get('extras') or {}, benchmark_revision=revision)
+    return json.dumps(data)
+
+
+def change_mapping(line, revision):
+    data = json.loads(line)
+    data['retired'] = not data.get('retired', False)
+    return json.dumps(data)
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    """ Command to benchmark the concepts and mappings importers """
+    help = 'Benchmark the first import, a no-op re-import and a diff re-import of the perf_data files. ' \
+           'Must be run with the Benchmark configuration, as it wipes the database.'
+    option_list = BaseCommand.option_list + (
+        make_option('--output',
+                    action='store',
+                    dest='output',
+                    default=None,
+                    help='Save the results as JSON to this file, e.g. to compare them between commits.'),
+        make_option('--baseline',
+                    action='store',
+                    dest='baseline',
+                    default=None,
+                    help='Results saved by a previous run, to compare the lines per second with.'),
+        make_option('--chunk-size',
+                    action='store',
+                    type='int',
+                    dest='chunk_size',
+                    default=1000,
+                    help='Chunk size of the concepts import, 0 to import concepts line by line.'),
+        make_option('--concepts-file',
+                    action='store',
+                    dest='concepts_file',
+                    default=CONCEPTS_FILE,
+                    help='Concepts to import.'),
+        make_option('--mappings-file',
+                    action='store',
+                    dest='mappings_file',
+                    default=MAPPINGS_FILE,
+                    help='Mappings to import, from the concepts of the concepts file.'),
+        make_option('--mongomock',
+                    action='store_true',
+                    dest='mongomock',
+                    default=False,
+                    help='Run against an in-memory mongomock database instead of the configured MongoDB.'),
+    )
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'IMPORT_BENCHMARK', False):
+            raise CommandError('Run with DJANGO_CONFIGURATION=Benchmark, the benchmark wipes the database.')
+        if options['mongomock']:
+            use_mongomock()
+
+        with open(options['concepts_file'], 'rb') as concepts_file:
+            concept_lines = concepts_file.readlines()
+        with open(options['mappings_file'], 'rb') as mappings_file:
+            mapping_lines = mappings_file.readlines()
+        revision = datetime.now().strftime('%Y%m%d%H%M%S')
+
+        self.clear_database()
+        self.user = User.objects.create(username='benchmark', email='benchmark@ocl.com', is_staff=True,
+                                        is_superuser=True)
+        self.source = self.create_sources()
+
+        scenarios = [
+            ('first import', concept_lines, mapping_lines),
+            ('no-op re-import', concept_lines, mapping_lines),
+            ('diff re-import',
+             [change_concept(line, revision) if i % DIFF_INTERVAL == 0 else line for i, line in enumerate(concept_lines)],
+             [change_mapping(line, revision) if i % DIFF_INTERVAL == 0 else line for i, line in enumerate(mapping_lines)]),
+        ]
+        results = []
+        for name, scenario_concept_lines, scenario_mapping_lines in scenarios:
+            results.append(self.run_concepts_import(name, scenario_concept_lines, options['chunk_size']))
+            results.append(self.run_mappings_import(name, scenario_mapping_lines))
+
+        report = {
+            'commit': get_commit(),
+            'created_at': datetime.now().isoformat(),
+            'chunk_size': options['chunk_size'],
+            'mongomock': options['mongomock'],
+            'results': results,
+        }
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline'], 'rb') as baseline_file:
+                baseline = dict((result['name'], result) for result in json.load(baseline_file)['results'])
+        self.output_report(report, baseline)
+
+        if options['output']:
+            with open(options['output'], 'wb') as output_file:
+                json.dump(report, output_file, indent=2, sort_keys=True)
+            self.stdout.write('Saved results to %s\n' % options['output'])
+
+    def clear_database(self):
+        for model in [LocalizedText, ConceptVersion, Concept, MappingVersion, Mapping, SourceVersion, Source,
+                      Organization, UserProfile, User]:
+            model.objects.all().delete()
+
+    def create_sources(self):
+        orgs = {}
+        sources = []
+        for org_mnemonic, source_mnemonic in ORG_SOURCES:
+            if org_mnemonic not in orgs:
+                orgs[org_mnemonic] = Organization.objects.create(
+                    name=org_mnemonic, mnemonic=org_mnemonic, members=[self.user.id], created_by=self.user.username,
+                    updated_by=self.user.username)
+            source = Source(name=source_mnemonic, mnemonic=source_mnemonic, full_name=source_mnemonic,
+                            source_type='Dictionary', default_locale='en', supported_locales=['en'])
+            errors = Source.persist_new(source, self.user, parent_resource=orgs[org_mnemonic])
+            if errors:
+                raise CommandError('Could not create source %s: %s' % (source_mnemonic, errors))
+            sources.append(source)
+        return Source.objects.get(id=sources[0].id)
+
+    def run_concepts_import(self, name, lines, chunk_size):
+        file_name = write_lines(lines)
+        output = OutputWrapper(open(os.devnull, 'w'))
+        importer = ConceptsImporter(self.source, open(file_name, 'rb'), self.user, output, output,
+                                    save_validation_errors=False)
+        timer = PhaseTimer()
+        timer.instrument('parse', importer, 'json_to_concept')
+        timer.instrument('lookup', importer, 'load_content_hashes', 'is_unchanged', 'prefetch_chunk')
+        timer.instrument('validate', importer, 'prepare_concept')
+        timer.instrument('validate', Concept, 'clean')
+        timer.instrument('validate', ConceptVersion, 'clean')
+        timer.instrument('write', importer, 'handle_concept', 'write_chunk', 'finish_pending_concept')
+        timer.instrument('index', importer.index_recorder, 'update_index')
+        try:
+            return self.run_import('concepts ' + name, timer, len(lines), lambda: importer.import_concepts(
+                total=len(lines), chunk_size=chunk_size or None), importer)
+        finally:
+            timer.restore()
+            os.remove(file_name)
+
+    def run_mappings_import(self, name, lines):
+        file_name = write_lines(lines)
+        output = OutputWrapper(open(os.devnull, 'w'))
+        importer = MappingsImporter(self.source, open(file_name, 'rb'), output, output, self.user)
+        timer = PhaseTimer()
+        timer.instrument('parse', importer, 'json_to_mapping')
+        timer.instrument('lookup', MappingsIndex, 'index_source', 'index_mappings', 'get_source', 'get_concept_id',
+                         'find_mapping', 'is_unchanged', 'is_duplicate')
+        timer.instrument('validate', Mapping, 'clean')
+        timer.instrument('validate', MappingVersion, 'clean')
+        timer.instrument('write', importer, 'add_mapping', 'update_mapping')
+        timer.instrument('index', importer.index_recorder, 'update_index')
+        try:
+            return self.run_import('mappings ' + name, timer, len(lines), lambda: importer.import_mappings(
+                total=len(lines)), importer)
+        finally:
+            timer.restore()
+            os.remove(file_name)
+
+    def run_import(self, name, timer, lines, run, importer):
+        started = time.time()
+        run()
+        seconds = time.time() - started
+
+        phases = dict((phase, round(timer.seconds[phase], 3)) for phase in PHASES)
+        phases['other'] = round(max(seconds - sum(timer.seconds.values()), 0), 3)
+        actions = dict((ImportActionHelper.get_action_string(action), count)
+                       for action, count in importer.action_count.items())
+        result = {
+            'name': name,
+            'lines': lines,
+            'seconds': round(seconds, 3),
+            'lines_per_second': round(lines / seconds, 1) if seconds else None,
+            'phases': phases,
+            'actions': actions,
+        }
+        self.stdout.write('%s: %s lines in %.1fs\n' % (name, lines, seconds))
+        return result
+
+    def output_report(self, report, baseline):
+        self.stdout.write('\n%-32s %10s %10s  %s\n' % ('import', 'lines/s', 'seconds', '  '.join(PHASES + ['other'])))
+        for result in report['results']:
+            line = '%-32s %10s %10s  %s' % (
+                result['name'], result['lines_per_second'], result['seconds'],
+                '  '.join('%s=%.2f' % (phase, result['phases'][phase]) for phase in PHASES + ['other']))
+            previous = baseline.get(result['name']) if baseline else None
+            if previous and previous.get('lines_per_second') and result['lines_per_second']:
+                line += '  (%+.0f%% lines/s)' % (
+                    100.0 * (result['lines_per_second'] - previous['lines_per_second']) / previous['lines_per_second'])
+            self.stdout.write(line + '\n')
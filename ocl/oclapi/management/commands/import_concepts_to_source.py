@@ -1,10 +1,27 @@
 """ import_concepts_to_source - Command to import JSON lines concept file into OCL """
+from optparse import make_option
+
 from concepts.importer import ConceptsImporter, ValidationLogger
 from oclapi.management.commands import ImportCommand
 
 class Command(ImportCommand):
     """ Command to import JSON lines concept file into OCL """
     help = 'Import concepts from a JSON file into a source'
+    option_list = ImportCommand.option_list + (
+        make_option('--chunk-size',
+                    action='store',
+                    type='int',
+                    dest='chunk_size',
+                    default=None,
+                    help='Import N lines at a time, resolving existing concepts with one query per chunk and '
+                         'writing new concepts in bulk. Without it concepts are imported line by line.'),
+        make_option('--workers',
+                    action='store',
+                    type='int',
+                    dest='workers',
+                    default=None,
+                    help='Split the input file by concept and import it in N processes.'),
+    )
 
     def do_import(self, user, source, input_file, options):
         """ Performs the import of JSON lines concept file into OCL """
@@ -13,4 +30,4 @@ class Command(ImportCommand):
         if output_file_name:
             validation_logger = ValidationLogger(output_file_name=output_file_name)
         importer = ConceptsImporter(source, input_file, user, self.stdout, self.stderr, validation_logger=validation_logger)
-        importer.import_concepts(**options)
\ No newline at end of file
+        importer.import_concepts(**options)
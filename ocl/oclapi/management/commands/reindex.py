@@ -0,0 +1,68 @@
+""" reindex - Command to reindex all objects of a model in parallel, resuming after the last checkpoint of a failed run """
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import models
+
+from oclapi.search_indexing import SearchReindex, SearchReindexCheckpoint
+
+# Progress is written at most this often
+PROGRESS_INTERVAL = 10  # seconds
+
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName>'
+    help = 'Reindex all objects of a model, e.g. concepts.ConceptVersion, resuming a failed reindex of the model.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--shards',
+                    action='store',
+                    type='int',
+                    dest='shards',
+                    default=None,
+                    help='Number of id ranges fetched in parallel, the number of workers by default.'),
+        make_option('--workers',
+                    action='store',
+                    type='int',
+                    dest='workers',
+                    default=settings.SEARCH_REINDEX_WORKERS,
+                    help='Number of threads preparing and posting batches to the search backend.'),
+        make_option('--batch-size',
+                    action='store',
+                    type='int',
+                    dest='batch_size',
+                    default=1000,
+                    help='Number of objects posted to the search backend at once.'),
+        make_option('--restart',
+                    action='store_true',
+                    dest='restart',
+                    default=False,
+                    help='Reindex from the first object even if a failed reindex of the model left a checkpoint.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0].count('.') != 1:
+            raise CommandError('Give the model to reindex as app_label.ModelName.')
+        model = models.get_model(*args[0].split('.'))
+        if model is None:
+            raise CommandError('Unknown model %s.' % args[0])
+
+        checkpoint = SearchReindexCheckpoint.load(args[0])
+        if options['restart']:
+            checkpoint.delete()
+            checkpoint = SearchReindexCheckpoint(args[0])
+        elif checkpoint.ranges is not None:
+            self.stdout.write('Resuming after %s objects' % checkpoint.done)
+
+        self.last_written = time.time()
+        reindex = SearchReindex(model, model.objects.all(), shards=options['shards'], workers=options['workers'],
+                                batch_size=options['batch_size'], checkpoint=checkpoint, progress=self.write_progress)
+        done = reindex.run()
+        self.stdout.write('Reindexed %s objects (%s per second)' % (done, reindex.get_items_per_second()))
+
+    def write_progress(self, done, items_per_second):
+        if time.time() - self.last_written >= PROGRESS_INTERVAL:
+            self.last_written = time.time()
+            self.stdout.write('%s objects (%s per second)' % (done, items_per_second))
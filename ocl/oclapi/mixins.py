@@ -1,11 +1,18 @@
+from collections import defaultdict
+
+from django.conf import settings
 from django.core.urlresolvers import resolve
-from oclapi.utils import compact, write_csv_to_s3, get_csv_from_s3
+from oclapi.export import get_csv_response, get_export_storage, get_csv_download_key, get_csv_download_prefix, \
+    write_csv_download, evict_csv_downloads
 from rest_framework.mixins import ListModelMixin
 from rest_framework.response import Response
 from oclapi.utils import compact, extract_values
 from users.models import UserProfile
 from oclapi.filters import SearchQuerySetWrapper
 from mappings.models import Mapping
+from concepts.models import Concept
+from oclapi.models import decode_extras
+from sources.models import Source
 
 __author__ = 'misternando'
 
@@ -121,33 +128,40 @@ class ListWithHeadersMixin(ListModelMixin):
         return map(lambda o: o.id, self.object_list[0:100])
 
     def get_csv(self, request, queryset=None):
-        filename, url, prepare_new_file, is_member = None, None, True, False
+        filename, is_member, last_update = None, False, None
 
         parent = self.get_parent()
 
         if parent:
-            prepare_new_file = False
             user = request.QUERY_PARAMS.get('user', None)
             is_member = self._is_member(parent, user)
+            parent_version = self.get_parent_version(parent)
+            if parent_version:
+                last_update = parent_version.last_child_update
 
         try:
             path = request.__dict__.get('_request').path
             filename = '_'.join(compact(path.split('/'))).replace('.', '_')
-            kwargs = {
-                'filename': filename,
-            }
         except Exception:
-            kwargs = {}
+            filename = None
+        download_name = filename or 'download'
 
-        if filename and prepare_new_file:
-            url = get_csv_from_s3(filename, is_member)
+        queryset = queryset or self._get_query_set_from_view(is_member)
+        if queryset.count() <= settings.CSV_STREAMING_MAX_ROWS:
+            data = self.get_csv_rows(queryset) if hasattr(self, 'get_csv_rows') else queryset.values()
+            compress = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+            return get_csv_response(data, download_name, compress)
 
-        if not url:
-            queryset = queryset or self._get_query_set_from_view(is_member)
+        storage = get_export_storage()
+        key_name = get_csv_download_key(download_name, is_member, request.QUERY_PARAMS, last_update)
+        # Downloads of the children of a version are reused until it changes, others are written again every time
+        if last_update is None or not storage.exists(key_name):
             data = self.get_csv_rows(queryset) if hasattr(self, 'get_csv_rows') else queryset.values()
-            url = write_csv_to_s3(data, is_member, **kwargs)
+            write_csv_download(data, key_name, storage, download_name)
+            if last_update is not None:
+                evict_csv_downloads(storage, get_csv_download_prefix(download_name, is_member), key_name)
 
-        return Response({'url': url}, status=200)
+        return Response({'url': storage.get_url(key_name, 600)}, status=200)
 
     def _is_member(self, parent, requesting_user):
         if not parent or type(parent).__name__ in ['UserProfile', 'Organization']:
@@ -169,6 +183,15 @@ class ListWithHeadersMixin(ListModelMixin):
 
         return parent
 
+    @staticmethod
+    def get_parent_version(parent):
+        """ The version whose last child update tells whether the children of the parent have changed, if any """
+        if hasattr(parent, 'last_child_update'):
+            return parent
+        if hasattr(parent, 'get_head'):
+            return parent.get_head()
+        return None
+
     @staticmethod
     def prepend_head(objects):
         if len(objects) > 0 and hasattr(objects[0], 'mnemonic'):
@@ -192,13 +215,15 @@ class ConceptVersionCSVFormatterMixin():
             queryset = self.get_queryset()
 
         values = queryset.values('id', 'external_id', 'uri', 'concept_class', 'datatype', 'retired', 'names',
-                                            'descriptions', 'created_by', 'created_at')
+                                 'descriptions', 'created_by', 'created_at', 'versioned_object_id', 'extras')
+        concepts, concept_mappings = self.get_csv_lookups(list(values))
 
         for value in values:
-            concept_ver = self.model.objects.get(id=value.pop('id'))
-            value['Owner'] = concept_ver.owner
-            value['Source'] = concept_ver.parent_resource
-            value['Concept ID']  = concept_ver.versioned_object.mnemonic
+            value.pop('id')
+            concept = concepts[value.pop('versioned_object_id')]
+            value['Owner'] = concept.owner
+            value['Source'] = concept.parent_resource
+            value['Concept ID']  = concept.mnemonic
 
             names = value.pop('names')
             descriptions = value.pop('descriptions')
@@ -217,20 +242,21 @@ class ConceptVersionCSVFormatterMixin():
             value['URI'] = value.pop('uri')
 
             #Include extras
+            extras = value.pop('extras')
+            decode_extras(extras)
             value['Attributes'] = ''
-            if concept_ver.extras:
+            if extras:
                 attributes = []
-                for key in concept_ver.extras:
-                    attributes.append(key + ': ' + concept_ver.extras[key])
+                for key in extras:
+                    attributes.append(key + ': ' + extras[key])
 
                 value['Attributes'] = '; '.join(attributes)
 
             #Include mappings
             value['Mappings'] = ''
-            concept_mappings = Mapping.objects.filter(from_concept=concept_ver.versioned_object)
-            if concept_mappings:
+            if concept_mappings[concept.id]:
                 mappings = []
-                for mapping in concept_mappings:
+                for mapping in concept_mappings[concept.id]:
                     row = mapping.owner + ' / ' + mapping.parent.name + ' / ' + mapping.from_concept_code + ' : ' \
                           + mapping.from_concept_name + ' <' + mapping.map_type +'> ' \
                           + mapping.to_source_owner_mnemonic + ' / ' + mapping.to_source_name
@@ -247,9 +273,43 @@ class ConceptVersionCSVFormatterMixin():
 
         values.field_names.extend(['Owner','Source','Concept ID','Preferred Name','Preferred Name Locale','Concept Class','Datatype','Retired','Synonyms','Description'
                                       ,'External ID','Mappings','Attributes','Last Updated','Updated By','URI'])
-        del values.field_names[0:10]
+        del values.field_names[0:12]
         return values
 
+    def get_csv_lookups(self, values):
+        """
+        Looks up the concepts of the concept versions, the mappings from them, and the concepts, sources and owners
+        these refer to with a query per model, and caches them on one another, so that formatting the rows does not
+        query anything else. Returns the concepts by id and the lists of mappings by the id of their from concept.
+        """
+        concepts = dict((concept.id, concept) for concept in Concept.objects.filter(
+            id__in=list(set(value['versioned_object_id'] for value in values))))
+        mappings = list(Mapping.objects.filter(from_concept_id__in=concepts.keys())) if concepts else []
+        to_concept_ids = set(mapping.to_concept_id for mapping in mappings if mapping.to_concept_id) - set(concepts)
+        if to_concept_ids:
+            concepts.update((concept.id, concept) for concept in Concept.objects.filter(id__in=list(to_concept_ids)))
+
+        source_ids = set(concept.parent_id for concept in concepts.values())
+        source_ids.update(mapping.parent_id for mapping in mappings)
+        source_ids.update(mapping.to_source_id for mapping in mappings if mapping.to_source_id)
+        sources = Source.get_sources_with_owners(source_ids)
+
+        for concept in concepts.values():
+            if concept.parent_id in sources:
+                concept.parent = sources[concept.parent_id]
+
+        concept_mappings = defaultdict(list)
+        for mapping in mappings:
+            if mapping.parent_id in sources:
+                mapping.parent = sources[mapping.parent_id]
+            mapping.from_concept = concepts[mapping.from_concept_id]
+            if mapping.to_concept_id in concepts:
+                mapping.to_concept = concepts[mapping.to_concept_id]
+            if mapping.to_source_id in sources:
+                mapping.to_source = sources[mapping.to_source_id]
+            concept_mappings[mapping.from_concept_id].append(mapping)
+        return concepts, concept_mappings
+
     def join_values(self, objects):
         localize_text_keys = ['name', 'locale', 'type']
         return ', '.join(
@@ -1,4 +1,5 @@
 import collections
+import copy
 import logging
 import re
 import ast
@@ -38,6 +39,23 @@ ACCESS_TYPE_CHOICES = ((ACCESS_TYPE_VIEW, 'View'),
                        (ACCESS_TYPE_NONE, 'None'))
 
 
+def decode_extras(extras):
+    """ Decodes in place the keys of extras as read from the database, which BaseModel.encode_extras encoded """
+    if isinstance(extras, collections.Mapping):
+        for old_key in extras:
+            key = old_key
+            key = key.replace('%25', '%')
+            key = key.replace('%2E', '.')
+            value = extras.get(old_key)
+            decode_extras(value)
+            if key is not old_key:
+                extras.pop(old_key)
+                extras[key] = value
+    elif isinstance(extras, list):
+        for item in extras:
+            decode_extras(item)
+
+
 class BaseModel(models.Model):
     """
     Base model from which all resources inherit.  Contains timestamps and is_active field for logical deletion.
@@ -124,20 +142,15 @@ class BaseModel(models.Model):
             for item in extras:
                 self.encode_extras_recursively(item)
 
+    def get_decoded_extras(self):
+        """ Returns a copy of the extras with decoded keys, also once they have been encoded for saving """
+        extras = copy.deepcopy(self.extras) if self.extras else {}
+        if self.extras_have_been_encoded:
+            self.decode_extras(extras)
+        return extras
+
     def decode_extras(self, extras):
-        if isinstance(extras, collections.Mapping):
-            for old_key in extras:
-                key = old_key
-                key = key.replace('%25', '%')
-                key = key.replace('%2E', '.')
-                value = extras.get(old_key)
-                self.decode_extras(value)
-                if key is not old_key:
-                    extras.pop(old_key)
-                    extras[key] = value
-        elif isinstance(extras, list):
-            for item in extras:
-                self.decode_extras(item)
+        decode_extras(extras)
 
 
 class BaseResourceModel(BaseModel):
@@ -232,6 +245,9 @@ class ResourceVersionModel(BaseModel):
     released = models.BooleanField(default=False, blank=True)
     previous_version = models.ForeignKey('self', related_name='next', null=True, blank=True, db_index=False)
     parent_version = models.ForeignKey('self', related_name='child', null=True, blank=True, db_index=False)
+    # Set by cache_collection_ids
+    _collection_version_ids = None
+    _collection_ids = None
 
     class Meta:
         abstract = True
@@ -279,11 +295,20 @@ class ResourceVersionModel(BaseModel):
         return Collection.objects.filter(id__in=list(collection_ids))
 
     def get_collection_ids(self):
+        if self._collection_ids is not None:
+            return self._collection_ids
         return list(self.get_collections().values_list('id', flat=True))
 
     def get_collection_version_ids(self):
+        if self._collection_version_ids is not None:
+            return self._collection_version_ids
         return list(self.get_collection_versions().values_list('id', flat=True))
 
+    def cache_collection_ids(self, collection_version_ids, collection_ids):
+        """ Caches the ids looked up for many versions at once, e.g. by CollectionVersion.get_collection_ids_by_child """
+        self._collection_version_ids = collection_version_ids
+        self._collection_ids = collection_ids
+
     @classmethod
     def get_latest_version_of(cls, versioned_object):
         versions = versioned_object.get_version_model().objects.filter(versioned_object_id=versioned_object.id, is_active=True).order_by('-created_at')
@@ -1,9 +1,8 @@
 from bson import ObjectId
 from django.db import connections
 
-from oclapi.utils import remove_from_search_index
-from oclapi.utils import update_search_index_by_id
-from tasks import update_search_index_task
+from oclapi.search_indexing import SearchIndexQueue
+from tasks import update_search_index_task, queue_search_index_update
 
 
 class RawQueries():
@@ -13,14 +12,12 @@ class RawQueries():
     def bulk_delete(self, type, ids):
         collection = self.db.get_collection(type._meta.db_table)
         collection.remove({'_id': {'$in': [ObjectId(id) for id in ids]}})
-        for id in ids:
-            remove_from_search_index(type, id)
+        queue_search_index_update(type, ids, SearchIndexQueue.REMOVE)
 
     def bulk_delete_from_list(self, type, ids, list_field, list_values):
         collection = self.db.get_collection(type._meta.db_table)
         collection.update({'_id': {'$in': [ObjectId(id) for id in ids]}}, {'$pull': {list_field: {'$in': list_values}}})
-        for id in ids:
-            update_search_index_by_id(type, id)
+        queue_search_index_update(type, ids)
 
     def find_by_id(self, type, id):
         collection = self.db.get_collection(type._meta.db_table)
@@ -60,12 +57,10 @@ class RawQueries():
         from mappings.models import MappingVersion
         mapping_version_ids = list(MappingVersion.objects.filter(versioned_object_id__in=mapping_ids).values_list('id', flat=True))
         MappingVersion.objects.filter(versioned_object_id__in=mapping_ids).delete()
-        for mapping_version_id in mapping_version_ids:
-            remove_from_search_index(MappingVersion, mapping_version_id)
+        queue_search_index_update(MappingVersion, mapping_version_ids, SearchIndexQueue.REMOVE)
 
         Mapping.objects.filter(parent_id=source.id).delete()
-        for mapping_id in mapping_ids:
-            remove_from_search_index(Mapping, mapping_id)
+        queue_search_index_update(Mapping, mapping_ids, SearchIndexQueue.REMOVE)
 
         from concepts.models import Concept
         concept_ids = list(Concept.objects.filter(parent_id=source.id).values_list('id', flat=True))
@@ -74,17 +69,14 @@ class RawQueries():
         from concepts.models import ConceptVersion
         concept_version_ids = list(ConceptVersion.objects.filter(versioned_object_id__in=concept_ids).values_list('id', flat=True))
         ConceptVersion.objects.filter(versioned_object_id__in=concept_ids).delete()
-        for concept_version_id in concept_version_ids:
-            remove_from_search_index(ConceptVersion, concept_version_id)
+        queue_search_index_update(ConceptVersion, concept_version_ids, SearchIndexQueue.REMOVE)
 
         Concept.objects.filter(parent_id=source.id).delete()
-        for concept_id in concept_ids:
-            remove_from_search_index(Concept, concept_id)
+        queue_search_index_update(Concept, concept_ids, SearchIndexQueue.REMOVE)
 
         SourceVersion.objects.filter(versioned_object_id=source.id).delete()
-        for source_version_id in source_version_ids:
-            remove_from_search_index(SourceVersion, source_version_id)
+        queue_search_index_update(SourceVersion, source_version_ids, SearchIndexQueue.REMOVE)
 
         from sources.models import Source
         Source.objects.filter(id=source.id).delete()
-        remove_from_search_index(Source, source.id)
+        queue_search_index_update(Source, [source.id], SearchIndexQueue.REMOVE)
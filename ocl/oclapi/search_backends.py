@@ -1,9 +1,23 @@
 
+from haystack.backends.simple_backend import SimpleSearchBackend, SimpleEngine
 from haystack.backends.solr_backend import SolrSearchBackend, SolrEngine
+from haystack.constants import ID
 from haystack.fields import CharField, MultiValueField
+from haystack.utils import get_identifier
+
+from oclapi.search_indexes import OCLSearchIndex
 
 __author__ = 'misternando'
 
+
+def prepare_batch(index, iterable):
+    """ Lets an OCLSearchIndex look up what the objects need for the whole batch before they are prepared """
+    objects = list(iterable)
+    if objects and isinstance(index, OCLSearchIndex):
+        index.prepare_batch(objects)
+    return objects
+
+
 class SortOrFilterField(CharField):
     field_type = 'lowercase'
 
@@ -75,7 +89,7 @@ class OCLSolrBackend(SolrSearchBackend):
         return (content_field_name, schema_fields)
 
     def update(self, index, iterable, commit=False):
-        super(OCLSolrBackend, self).update(index, iterable, commit=commit)
+        super(OCLSolrBackend, self).update(index, prepare_batch(index, iterable), commit=commit)
 
     def remove(self, obj_or_string, commit=False):
         super(OCLSolrBackend, self).remove(obj_or_string, commit=commit)
@@ -83,6 +97,38 @@ class OCLSolrBackend(SolrSearchBackend):
     def clear(self, models=[], commit=False):
         super(OCLSolrBackend, self).clear(models, commit=commit)
 
+    def remove_identifiers(self, identifiers, commit=False):
+        """ Removes the documents with the identifiers in one request """
+        query = ' OR '.join('%s:"%s"' % (ID, identifier) for identifier in identifiers)
+        self.conn.delete(q=query, commit=commit)
+
 
 class OCLSolrEngine(SolrEngine):
     backend = OCLSolrBackend
+
+
+class InMemorySearchBackend(SimpleSearchBackend):
+    """
+    Prepares documents like the Solr backend does, but keeps them in a dict, e.g. to benchmark indexing without
+    a Solr server. Searches fall back to the database, as with the simple backend.
+    """
+    documents = {}
+
+    def update(self, index, iterable, commit=True):
+        for obj in prepare_batch(index, iterable):
+            document = index.full_prepare(obj)
+            self.documents[document[ID]] = document
+
+    def remove(self, obj_or_string, commit=True):
+        self.documents.pop(get_identifier(obj_or_string), None)
+
+    def remove_identifiers(self, identifiers, commit=True):
+        for identifier in identifiers:
+            self.documents.pop(identifier, None)
+
+    def clear(self, models=[], commit=True):
+        self.documents.clear()
+
+
+class InMemoryEngine(SimpleEngine):
+    backend = InMemorySearchBackend
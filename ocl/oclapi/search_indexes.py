@@ -10,6 +10,13 @@ class OCLSearchIndex(SearchIndex):
     def get_updated_field(self):
         return 'updated_at'
 
+    def prepare_batch(self, objects):
+        """
+        Called with each batch of objects before they are prepared, to look up what they need for the whole batch
+        and cache it on them
+        """
+        pass
+
 
     def prepare(self, obj):
         self.prepared_data = super(OCLSearchIndex, self).prepare(obj)
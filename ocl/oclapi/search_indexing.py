@@ -0,0 +1,360 @@
+import collections
+import json
+import multiprocessing
+import Queue
+import threading
+import time
+
+import haystack
+from bson import ObjectId
+from django.conf import settings
+from django.db import models
+from django.db.models.signals import post_save, post_delete
+from haystack.signals import BaseSignalProcessor
+from haystack.utils import loading
+
+from oclapi.export import keyset_batches
+from oclapi.utils import RedisConnectionFactory, close_db_connections
+
+haystack_connections = loading.ConnectionHandler(settings.HAYSTACK_CONNECTIONS)
+
+# A scheduled flush of the search index queue whose task was lost is scheduled again after this long
+SEARCH_INDEX_FLUSH_EXPIRES = 300  # 5 minutes
+
+# Ranges left to reindex are kept this long, for a failed reindex to be resumed
+SEARCH_REINDEX_CHECKPOINT_EXPIRES = 604800  # 7 days
+
+
+def get_search_index_identifier(type, id):
+    return '%s.%s.%s' % (type._meta.app_label, type._meta.module_name, id)
+
+
+def update_all_in_index(model, qs):
+    if not qs.exists():
+        return
+    SearchReindex(model, qs, workers=settings.SEARCH_REINDEX_WORKERS).run()
+
+
+def split_id_range(queryset, shards):
+    """
+    Splits the range of the ObjectIds of the queryset into at most shards ranges of equal width, as (after, upto)
+    pairs of the ids the ranges start after and end with. Ids that are not ObjectIds make a single unbounded range.
+    """
+    first = list(queryset.order_by('id').values_list('id', flat=True)[:1])
+    if not first:
+        return []
+    last = list(queryset.order_by('-id').values_list('id', flat=True)[:1])
+    if not (ObjectId.is_valid(str(first[0])) and ObjectId.is_valid(str(last[0]))):
+        return [(None, None)]
+
+    low, high = int(str(first[0]), 16) - 1, int(str(last[0]), 16)
+    width = max((high - low) // shards, 1)
+    ranges = []
+    after = low
+    while after < high:
+        upto = high if len(ranges) == shards - 1 else min(after + width, high)
+        ranges.append(('%024x' % after, '%024x' % upto))
+        after = upto
+    return ranges
+
+
+class SearchReindexCheckpoint(object):
+    """
+    The id ranges a SearchReindex has left to post and the number of objects it posted, saved in Redis after every
+    batch so that a reindex under the same name resumes where it stopped, e.g. after a failure.
+    """
+    KEY_PREFIX = 'search_reindex_checkpoint:'
+
+    def __init__(self, name, ranges=None, done=0):
+        self.key = self.KEY_PREFIX + name
+        self.ranges = ranges
+        self.done = done
+
+    @classmethod
+    def load(cls, name):
+        """ Returns the saved checkpoint of the name, or a new one if there is none """
+        value = RedisConnectionFactory.get_redis_connection().get(cls.KEY_PREFIX + name)
+        if value:
+            saved = json.loads(value)
+            return cls(name, [tuple(id_range) for id_range in saved['ranges']], saved['done'])
+        return cls(name)
+
+    def save(self, ranges, done):
+        self.ranges = list(ranges)
+        self.done = done
+        value = json.dumps({'ranges': self.ranges, 'done': self.done})
+        RedisConnectionFactory.get_redis_connection().setex(self.key, SEARCH_REINDEX_CHECKPOINT_EXPIRES, value)
+
+    def delete(self):
+        RedisConnectionFactory.get_redis_connection().delete(self.key)
+
+
+class SearchReindex(object):
+    """
+    Reindexes the objects of a queryset of a model. The range of their ids is split into shards, each walked in
+    keyset batches by a thread of its own, while workers threads prepare the fetched batches and post them to the
+    backend, so that fetching, preparing and posting overlap. At most two batches per worker wait to be posted.
+
+    Given a SearchReindexCheckpoint, the ranges left to post are saved after every batch posted, up to the last id
+    of a shard all of whose batches until then have been posted, and a reindex with the saved checkpoint resumes
+    after it. Given progress, it is called with the number of objects posted and the objects posted per second.
+    """
+
+    def __init__(self, model, queryset, shards=None, workers=4, batch_size=1000, checkpoint=None, progress=None):
+        self.model = model
+        self.queryset = queryset
+        self.workers = workers
+        self.shards = shards or workers
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.progress = progress
+        default_connection = haystack_connections['default']
+        self.index = default_connection.get_unified_index().get_index(model)
+        self.backend = default_connection.get_backend()
+        self.lock = threading.Lock()
+        self.error = None
+        self.ranges = []
+        # Last id and whether it has been posted of every batch fetched and not yet committed, by shard
+        self.pending = []
+        self.done = 0
+        self.resumed_done = 0
+        self.started_at = None
+
+    def run(self):
+        """ Returns the number of objects posted, including those posted before a resumed checkpoint """
+        self.started_at = time.time()
+        if self.checkpoint and self.checkpoint.ranges is not None:
+            self.ranges = list(self.checkpoint.ranges)
+            self.done = self.resumed_done = self.checkpoint.done
+        else:
+            self.ranges = split_id_range(self.queryset, self.shards)
+        self.pending = [collections.OrderedDict() for _ in self.ranges]
+
+        batches = Queue.Queue(maxsize=2 * self.workers)
+        fetchers = [threading.Thread(target=self.fetch_shard, args=(shard, batches))
+                    for shard in range(len(self.ranges))]
+        posters = [threading.Thread(target=self.post_batches, args=(batches,)) for _ in range(self.workers)]
+        for thread in fetchers + posters:
+            thread.daemon = True
+            thread.start()
+        for fetcher in fetchers:
+            fetcher.join()
+        for _ in posters:
+            batches.put(None)
+        for poster in posters:
+            poster.join()
+
+        if self.error:
+            raise self.error
+        if self.checkpoint:
+            self.checkpoint.delete()
+        return self.done
+
+    def fail(self, exc):
+        with self.lock:
+            self.error = self.error or exc
+
+    def fetch_shard(self, shard, batches):
+        after, upto = self.ranges[shard]
+        queryset = self.queryset if upto is None else self.queryset.filter(id__lte=upto)
+        try:
+            for sequence, batch in enumerate(keyset_batches(queryset, self.batch_size, after=after)):
+                if self.error:
+                    return
+                with self.lock:
+                    self.pending[shard][sequence] = [batch[-1].id, False]
+                batches.put((shard, sequence, batch))
+        except Exception as exc:
+            self.fail(exc)
+        finally:
+            close_db_connections()
+
+    def post_batches(self, batches):
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    return
+                if self.error:
+                    continue
+                shard, sequence, batch = item
+                try:
+                    self.post(batch)
+                except Exception as exc:
+                    self.fail(exc)
+                    continue
+                self.commit(shard, sequence, len(batch))
+        finally:
+            close_db_connections()
+
+    def post(self, batch):
+        self.backend.update(self.index, batch)
+
+    def commit(self, shard, sequence, count):
+        with self.lock:
+            self.done += count
+            pending = self.pending[shard]
+            pending[sequence][1] = True
+            last_id = None
+            while pending and pending[next(iter(pending))][1]:
+                last_id = pending.popitem(last=False)[1][0]
+            if last_id is not None:
+                self.ranges[shard] = (last_id, self.ranges[shard][1])
+                if self.checkpoint:
+                    self.checkpoint.save(self.ranges, self.done)
+            if self.progress:
+                self.progress(self.done, self.get_items_per_second())
+
+    def get_items_per_second(self):
+        seconds = time.time() - self.started_at
+        done = self.done - self.resumed_done
+        return round(done / seconds, 1) if done and seconds > 0 else None
+
+
+def update_batch_in_index(model_and_ids):
+    """ Reindexes a batch of objects of a model with a single backend update """
+    model, ids = model_and_ids
+    default_connection = haystack_connections['default']
+    index = default_connection.get_unified_index().get_index(model)
+    backend = default_connection.get_backend()
+    backend.update(index, model.objects.filter(id__in=ids))
+
+
+def update_ids_in_index(model, ids, batch_size=100, workers=4):
+    """ Reindexes only the objects of a model with the given ids, batch_size objects per update, in worker processes """
+    ids = list(ids)
+    batches = [(model, ids[start:start + batch_size]) for start in range(0, len(ids), batch_size)]
+    if not workers or workers < 2 or len(batches) < 2:
+        for batch in batches:
+            update_batch_in_index(batch)
+        return
+
+    close_db_connections()
+    pool = multiprocessing.Pool(min(workers, len(batches)), initializer=close_db_connections)
+    try:
+        pool.map(update_batch_in_index, batches)
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+
+class SearchIndexRecorder(object):
+    """
+    Records the ids of the indexed objects saved while it is set up, so that an import reindexes exactly the objects
+    it touched instead of everything updated since it started. Bulk writes, which send no signals, call record.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.indexed_models = None
+
+    def setup(self):
+        self.indexed_models = set(haystack_connections['default'].get_unified_index().get_indexed_models())
+        post_save.connect(self.handle_save, weak=False, dispatch_uid=self.get_dispatch_uid())
+
+    def teardown(self):
+        post_save.disconnect(dispatch_uid=self.get_dispatch_uid())
+
+    def get_dispatch_uid(self):
+        return 'search_index_recorder_%s' % id(self)
+
+    def handle_save(self, sender, instance, **kwargs):
+        if sender in self.indexed_models:
+            self.record(sender, [instance.id])
+
+    def record(self, model, ids):
+        self.ids.setdefault(model, set()).update(ids)
+
+    def merge(self, ids):
+        """ Adds the ids recorded by another recorder, e.g. in an import worker """
+        for model, model_ids in ids.items():
+            self.record(model, model_ids)
+
+    def count(self):
+        return sum(len(model_ids) for model_ids in self.ids.values())
+
+    def update_index(self, batch_size=100, workers=4):
+        for model, model_ids in self.ids.items():
+            update_ids_in_index(model, model_ids, batch_size, workers)
+
+
+class SearchIndexQueue(object):
+    """
+    Objects to reindex or remove from the index, kept in a Redis hash by identifier until a Celery task flushes them.
+    Changes to an object queued before the flush collapse into one index operation, the last one queued.
+    """
+    KEY = 'search_index_queue'
+    FLUSH_KEY = 'search_index_queue:flush'
+    UPDATE = 'update'
+    REMOVE = 'remove'
+
+    @classmethod
+    def enqueue(cls, model, ids, operation=UPDATE):
+        """ Queues the objects, returns whether a flush has to be scheduled for them """
+        ids = list(ids)
+        if not ids or not isinstance(haystack.signal_processor, QueuedSignalProcessor):
+            return False
+        connection = RedisConnectionFactory.get_redis_connection()
+        connection.hmset(cls.KEY, dict((get_search_index_identifier(model, id), operation) for id in ids))
+        return bool(connection.set(cls.FLUSH_KEY, 1, nx=True, ex=SEARCH_INDEX_FLUSH_EXPIRES))
+
+    @classmethod
+    def take(cls):
+        """ Empties the queue, returns the queued ids by model and operation """
+        connection = RedisConnectionFactory.get_redis_connection()
+        # Objects queued from now on need another flush
+        connection.delete(cls.FLUSH_KEY)
+        pipeline = connection.pipeline()
+        pipeline.hgetall(cls.KEY)
+        pipeline.delete(cls.KEY)
+        queued = pipeline.execute()[0]
+
+        operations = {}
+        for identifier, operation in queued.items():
+            app_label, module_name, id = identifier.split('.', 2)
+            operations.setdefault((models.get_model(app_label, module_name), operation), []).append(id)
+        return operations
+
+    @classmethod
+    def flush(cls, batch_size=100):
+        """ Applies the queued operations, batch_size objects per backend request. Returns how many were applied. """
+        operations = cls.take()
+        backend = haystack_connections['default'].get_backend()
+        for (model, operation), ids in operations.items():
+            if operation == cls.REMOVE:
+                for start in range(0, len(ids), batch_size):
+                    backend.remove_identifiers([get_search_index_identifier(model, id)
+                                                for id in ids[start:start + batch_size]])
+            else:
+                update_ids_in_index(model, ids, batch_size, workers=None)
+        return sum(len(ids) for ids in operations.values())
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    """
+    Queues the indexed objects saved or deleted in the SearchIndexQueue rather than updating the index while they
+    are written, so that writes do not wait for the search backend. Importers replace it with BaseSignalProcessor
+    while they run, which also stops the explicit queueing of SearchIndexQueue.enqueue.
+    """
+
+    def setup(self):
+        post_save.connect(self.handle_save)
+        post_delete.connect(self.handle_delete)
+
+    def teardown(self):
+        post_save.disconnect(self.handle_save)
+        post_delete.disconnect(self.handle_delete)
+
+    def handle_save(self, sender, instance, **kwargs):
+        self.queue(sender, instance, SearchIndexQueue.UPDATE)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        self.queue(sender, instance, SearchIndexQueue.REMOVE)
+
+    def queue(self, sender, instance, operation):
+        if sender not in self.connections['default'].get_unified_index().get_indexed_models():
+            return
+        # The tasks module imports the models, which are not loaded yet when haystack sets up its signal processor
+        from tasks import queue_search_index_update
+        queue_search_index_update(sender, [instance.id], operation)
@@ -262,10 +262,10 @@ class Common(Configuration):
     CORS_REPLACE_HTTPS_REFERER = True
 
     # Haystack processor determines when/how updates to mongo are indexed by Solr
-    # RealtimeSignalProcessor will update the index for every mongo update, sometimes at
-    # the cost of performance. BaseSignalProcessor does not update the index at all, which
-    # means the index must be updated manually (e.g. using the haystack update_index command).
-    HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
+    # QueuedSignalProcessor queues every mongo update in Redis, for the search_index queue worker
+    # to update the index in batches. BaseSignalProcessor does not update the index at all, which
+    # means the index must be updated manually (e.g. using the reindex command).
+    HAYSTACK_SIGNAL_PROCESSOR = 'oclapi.search_indexing.QueuedSignalProcessor'
     HAYSTACK_ITERATOR_LOAD_PER_QUERY = 25
     HAYSTACK_SEARCH_RESULTS_PER_PAGE = 25
     # Override to properly support Mongo identifiers with alphanumerics
@@ -273,6 +273,27 @@ class Common(Configuration):
 
     # Celery settings
     CELERY_RESULT_BACKEND = 'redis://redis.openconceptlab.org:6379/0'
+
+    # Bulk imports save a checkpoint in Redis every N lines, so that a restarted import resumes where it stopped
+    BULK_IMPORT_CHECKPOINT_INTERVAL = 1000
+    # CSV downloads of up to this many rows are streamed in the response, larger ones are uploaded to S3
+    CSV_STREAMING_MAX_ROWS = 1000
+    # Changes to indexed objects are queued this many seconds before the search index queue worker flushes them
+    SEARCH_INDEX_QUEUE_WINDOW = 2
+    # Reindexing posts batches to the search backend from this many threads, while as many threads fetch them
+    SEARCH_REINDEX_WORKERS = 4
+    # Exports serialize concepts and mappings in this many worker processes
+    EXPORT_WORKERS = 4
+    # Exports are uploaded to S3 in parts of this many bytes, at least 5 MB as required by multipart uploads
+    EXPORT_PART_SIZE = 8 * 1024 * 1024
+    # Exports are written under this directory instead of uploaded to S3 if it is set
+    EXPORT_LOCAL_DIRECTORY = None
+    # Exports are cached under this directory, which may be shared by the web and worker hosts, if it is set
+    EXPORT_CACHE_DIRECTORY = None
+    # The least recently downloaded exports are evicted from the cache beyond this many bytes
+    EXPORT_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+    # Exports in the cache are downloaded from this URL, serving EXPORT_CACHE_DIRECTORY, rather than S3 if it is set
+    EXPORT_CACHE_URL = None
     # Set these in your postactivate hook if you use virtualenvwrapper
     AWS_ACCESS_KEY_ID=os.environ.get('AWS_ACCESS_KEY_ID', '')
     AWS_SECRET_ACCESS_KEY=os.environ.get('AWS_SECRET_ACCESS_KEY', '')
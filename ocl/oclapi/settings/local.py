@@ -38,6 +38,29 @@ class Test(Local):
     HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.BaseSignalProcessor'
 
 
+class Benchmark(Local):
+    """
+    Settings for the import benchmark, see the benchmark_imports command. Its database is wiped by every run.
+    """
+    IMPORT_BENCHMARK = True
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django_mongodb_engine',
+            'HOST': 'localhost',
+            'NAME': 'ocl_benchmark',
+        }
+    }
+
+    HAYSTACK_CONNECTIONS = {
+        'default': {
+            'ENGINE': 'oclapi.search_backends.InMemoryEngine',
+        },
+    }
+    HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.BaseSignalProcessor'
+    DEBUG = False
+    TEMPLATE_DEBUG = DEBUG
+
+
 class IntegrationTest(Common):
     """
     Settings for unit testing
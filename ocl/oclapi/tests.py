@@ -1,14 +1,31 @@
-from datetime import timedelta
+import json
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+import zlib
+from StringIO import StringIO
+from datetime import datetime, timedelta
 
+import haystack
 from django.contrib.auth.models import User
 from django.core.signing import BadSignature
+from django.http import QueryDict
+from mock import patch, Mock
 
 from oclapi.models import ACCESS_TYPE_EDIT
 from orgs.models import Organization
 from sources.models import Source, SourceVersion
 from users.models import UserProfile
 from test_helper.base import OclApiBaseTestCase
-from oclapi.utils import compact, extract_values, timestamp_sign, timestamp_unsign
+from oclapi.management.commands.benchmark_imports import PhaseTimer
+from oclapi.export import keyset_batches, write_export_batches, StreamingZipFile, LocalDirectoryUpload, \
+    diff_sorted_ids, EXPORT_FORMATS, LocalDirectoryExportStorage, CachedExportStorage, ExportProgress, ExportCancelled, \
+    iter_csv, iter_chunks, gzip_chunks, get_csv_download_key, evict_csv_downloads
+from oclapi.search_indexing import SearchIndexQueue, split_id_range, SearchReindex, SearchReindexCheckpoint, \
+    QueuedSignalProcessor
+from oclapi.utils import compact, extract_values, timestamp_sign, timestamp_unsign, RedisConnectionFactory
 
 
 class ResourceVersionModelBaseTest(OclApiBaseTestCase):
@@ -111,3 +128,343 @@ class UtilsTest(OclApiBaseTestCase):
     def test_timestamp_sign_unsign(self):
         self.assertEquals(timestamp_unsign(timestamp_sign("test_string"), timedelta(hours=1)), "test_string")
         self.assertRaises(BadSignature, lambda: timestamp_unsign(timestamp_sign("test_string"), timedelta(hours=-1)))
+
+    def test_keyset_batches(self):
+        for i in range(5):
+            Organization.objects.create(name='keyset%d' % i, mnemonic='keyset%d' % i)
+        queryset = Organization.objects.filter(name__startswith='keyset')
+        ids = sorted(queryset.values_list('id', flat=True))
+
+        batches = list(keyset_batches(queryset, 2))
+        self.assertListEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertListEqual([org.id for batch in batches for org in batch], ids)
+
+        batches = list(keyset_batches(queryset.values_list('id', flat=True), 5))
+        self.assertListEqual(batches, [ids])
+
+    def test_write_export_batches_in_order(self):
+        for i in range(5):
+            Organization.objects.create(name='export%d' % i, mnemonic='export%d' % i)
+        ids = sorted(Organization.objects.filter(name__startswith='export').values_list('id', flat=True))
+        out = StringIO()
+        write_export_batches(out, [ids[0:2], ids[2:4], ids[4:]], 'orgs.models.Organization',
+                             'orgs.serializers.OrganizationListSerializer', 'organizations',
+                             logging.getLogger('oclapi'), workers=2)
+        exported = json.loads('[%s]' % out.getvalue())
+        self.assertListEqual([org['id'] for org in exported], ['export%d' % i for i in range(5)])
+
+    def test_streaming_zip_entry_uploaded_in_parts(self):
+        directory = tempfile.mkdtemp()
+        try:
+            upload = LocalDirectoryUpload(directory, 'exports/export.zip', 100)
+            out = StreamingZipFile(upload)
+            out.start_entry('export.json')
+            content = ''.join('{"id": "%s"}, ' % os.urandom(8).encode('hex') for _ in range(1000))
+            for start in range(0, len(content), 500):
+                out.write(content[start:start + 500])
+            out.start_entry('manifest.json')
+            out.write('{}')
+            out.close()
+            upload.complete()
+
+            self.assertTrue(upload.part_number > 1)
+            with zipfile.ZipFile(os.path.join(directory, 'exports/export.zip')) as archive:
+                self.assertIsNone(archive.testzip())
+                self.assertEquals(archive.read('export.json'), content)
+                self.assertEquals(archive.read('manifest.json'), '{}')
+        finally:
+            shutil.rmtree(directory)
+
+    def test_streaming_zip_stops_before_the_zip64_limit(self):
+        out = StringIO()
+        with patch.object(zipfile, 'ZIP64_LIMIT', 1000):
+            archive = StreamingZipFile(out)
+            archive.start_entry('export.json')
+            with self.assertRaises(zipfile.LargeZipFile):
+                for _ in range(100):
+                    archive.write(os.urandom(50).encode('hex'))
+        self.assertTrue(len(out.getvalue()) <= 1000)
+
+    def test_ndjson_export_batches(self):
+        for i in range(3):
+            Organization.objects.create(name='ndjson%d' % i, mnemonic='ndjson%d' % i)
+        ids = sorted(Organization.objects.filter(name__startswith='ndjson').values_list('id', flat=True))
+        out = StringIO()
+        out.write(EXPORT_FORMATS['ndjson'].get_header({'type': 'Source'}))
+        write_export_batches(out, [ids[0:2], ids[2:]], 'orgs.models.Organization',
+                             'orgs.serializers.OrganizationListSerializer', 'organizations',
+                             logging.getLogger('oclapi'), export_format='ndjson', workers=1)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEquals(lines[0], {'type': 'Source'})
+        self.assertListEqual([org['id'] for org in lines[1:]], ['ndjson0', 'ndjson1', 'ndjson2'])
+
+    def test_msgpack_export_format(self):
+        import msgpack
+        export_format = EXPORT_FORMATS['msgpack']
+        packed = export_format.get_header({'type': 'Source'}) + export_format.serialize([{'id': '1'}, {'id': '2'}])
+        self.assertListEqual(list(msgpack.Unpacker(StringIO(packed))), [{'type': 'Source'}, {'id': '1'}, {'id': '2'}])
+
+    def test_diff_sorted_ids(self):
+        self.assertEquals(diff_sorted_ids(['a', 'c', 'd', 'f'], ['b', 'c', 'e', 'f', 'g']), (['b', 'e', 'g'], ['a', 'd']))
+        self.assertEquals(diff_sorted_ids([], ['a']), (['a'], []))
+        self.assertEquals(diff_sorted_ids(['a'], []), ([], ['a']))
+
+    def test_cancelled_upload_leaves_no_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            upload = LocalDirectoryUpload(directory, 'export.zip', 100)
+            upload.write('x' * 1000)
+            upload.cancel()
+            self.assertListEqual(os.listdir(directory), [])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_export_cache_remembers_exports_and_evicts_least_recently_used(self):
+        directory, cache_directory = tempfile.mkdtemp(), tempfile.mkdtemp()
+        try:
+            storage = CachedExportStorage(LocalDirectoryExportStorage(directory), cache_directory, 250, '/exports/')
+            for key_name in ['org/source_v1.zip', 'org/source_v2.zip']:
+                upload = storage.get_upload(key_name)
+                upload.write('x' * 100)
+                upload.complete()
+
+            # Exports in the cache are checked and downloaded without the storage behind it
+            shutil.rmtree(os.path.join(directory, 'org'))
+            self.assertTrue(storage.exists('org/source_v1.zip'))
+            self.assertEquals(storage.get_url('org/source_v1.zip', 60), '/exports/org/source_v1.zip')
+            self.assertFalse(storage.exists('org/source_v3.zip'))
+
+            upload = storage.get_upload('org/source_v3.zip')
+            upload.write('x' * 100)
+            upload.complete()
+            self.assertListEqual(sorted(os.listdir(os.path.join(cache_directory, 'org'))),
+                                 ['source_v1.zip', 'source_v3.zip'])
+            # The marker of an evicted export goes with it, so the storage behind the cache is checked again
+            self.assertListEqual(sorted(os.listdir(os.path.join(cache_directory, '.exists', 'org'))),
+                                 ['source_v1.zip', 'source_v3.zip'])
+            self.assertFalse(storage.exists('org/source_v2.zip'))
+            self.assertTrue(storage.get_url('org/source_v2.zip', 60).startswith('file://'))
+
+            storage.delete('org/source_v3.zip')
+            self.assertFalse(storage.exists('org/source_v3.zip'))
+            self.assertListEqual(os.listdir(os.path.join(cache_directory, '.exists', 'org')), ['source_v1.zip'])
+        finally:
+            shutil.rmtree(directory)
+            shutil.rmtree(cache_directory)
+
+    def test_csv_streamed_in_gzip_chunks(self):
+        rows = [{'Name': u'caf\xe9', 'Updated': datetime(2017, 1, 2, 3, 4, 5), 'Retired': False, 'Other': 1}]
+        lines = list(iter_csv(rows + [{}], ['Name', 'Updated', 'Retired']))
+        self.assertListEqual(lines, ['Name,Updated,Retired\r\n', 'caf\xc3\xa9,2017-01-02T03:04:05,False\r\n', ',,\r\n'])
+
+        content = ''.join(lines)
+        chunks = list(gzip_chunks(iter_chunks(lines, 10)))
+        self.assertEquals(zlib.decompress(''.join(chunks), zlib.MAX_WBITS | 16), content)
+
+    def test_csv_downloads_keyed_by_params_and_last_child_update(self):
+        last_update = datetime(2017, 1, 2, 3, 4, 5)
+        key_name = get_csv_download_key('orgs_org_sources_source_concepts', True,
+                                        QueryDict('csv=true&q=a&user=user&verbose='), last_update)
+        self.assertTrue(key_name.startswith('downloads/creator/orgs_org_sources_source_concepts/20170102030405/'))
+        self.assertEquals(key_name, get_csv_download_key('orgs_org_sources_source_concepts', True,
+                                                         QueryDict('q=a&csv=true'), last_update))
+        self.assertNotEquals(key_name, get_csv_download_key('orgs_org_sources_source_concepts', True,
+                                                            QueryDict('q=b&csv=true'), last_update))
+        self.assertNotEquals(key_name, get_csv_download_key('orgs_org_sources_source_concepts', False,
+                                                            QueryDict('q=a&csv=true'), last_update))
+
+        directory = tempfile.mkdtemp()
+        try:
+            storage = LocalDirectoryExportStorage(directory)
+            stale_key_name = get_csv_download_key('orgs_org_sources_source_concepts', True, QueryDict('q=b&csv=true'),
+                                                  datetime(2017, 1, 1))
+            for name in [key_name, stale_key_name]:
+                upload = storage.get_upload(name)
+                upload.write('x')
+                upload.complete()
+
+            evict_csv_downloads(storage, 'downloads/creator/orgs_org_sources_source_concepts/', key_name)
+            self.assertListEqual(storage.key_names('downloads/creator/'), [key_name])
+        finally:
+            shutil.rmtree(directory)
+
+
+
+class InMemoryRedis(object):
+    """ The Redis commands that ExportProgress, SearchIndexQueue and SearchReindexCheckpoint use """
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.values:
+            return None
+        self.values[key] = str(value)
+        return True
+
+    def setex(self, key, expires, value):
+        self.values[key] = str(value)
+
+    def hmset(self, key, mapping):
+        self.values.setdefault(key, {}).update(mapping)
+
+    def hgetall(self, key):
+        return dict(self.values.get(key, {}))
+
+    def pipeline(self):
+        return InMemoryPipeline(self)
+
+    def exists(self, key):
+        return key in self.values
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+
+class InMemoryPipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((name, args))
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args) for name, args in self.commands]
+
+
+class ExportProgressTest(OclApiBaseTestCase):
+    def test_progress_is_published_until_cancelled(self):
+        now = [0.0]
+        with patch.object(RedisConnectionFactory, 'redis_connection', InMemoryRedis()), \
+                patch('oclapi.export.time.time', lambda: now[0]):
+            progress = ExportProgress('org/source_v1.zip')
+            progress.start_phase('concepts', 400)
+            now[0] = 10.0
+            progress.advance(100)
+            self.assertEquals(ExportProgress.load('org/source_v1.zip'), {
+                'phase': 'concepts', 'done': 100, 'total': 400, 'items_per_second': 10.0, 'eta_seconds': 30.0,
+                'elapsed_seconds': 10.0})
+
+            ExportProgress.cancel('org/source_v1.zip')
+            self.assertRaises(ExportCancelled, progress.advance, 100)
+            progress.end(ExportProgress.CANCELLED)
+            self.assertEquals(ExportProgress.load('org/source_v1.zip')['phase'], ExportProgress.CANCELLED)
+
+            # A new export of the same path is not cancelled once requested
+            ExportProgress.clear_cancel('org/source_v1.zip')
+            ExportProgress('org/source_v1.zip').start_phase('preparing')
+
+    def test_export_cancelled_before_the_worker_starts_stays_cancelled(self):
+        with patch.object(RedisConnectionFactory, 'redis_connection', InMemoryRedis()):
+            ExportProgress('org/source_v1.zip').start_phase('preparing')
+            ExportProgress.clear_cancel('org/source_v1.zip')
+            ExportProgress.cancel('org/source_v1.zip')
+
+            progress = ExportProgress('org/source_v1.zip')
+            self.assertRaises(ExportCancelled, progress.start_phase, 'preparing')
+
+
+class SearchIndexQueueTest(OclApiBaseTestCase):
+    def test_changes_to_an_object_collapse_into_the_last_one(self):
+        with patch.object(RedisConnectionFactory, 'redis_connection', InMemoryRedis()), \
+                patch('oclapi.search_indexing.haystack.signal_processor', Mock(spec=QueuedSignalProcessor)):
+            self.assertTrue(SearchIndexQueue.enqueue(Source, ['1', '2']))
+            self.assertFalse(SearchIndexQueue.enqueue(Source, ['2']))
+            self.assertFalse(SearchIndexQueue.enqueue(Source, ['1'], SearchIndexQueue.REMOVE))
+            self.assertFalse(SearchIndexQueue.enqueue(Source, []))
+
+            self.assertEquals(SearchIndexQueue.take(), {
+                (Source, SearchIndexQueue.UPDATE): ['2'], (Source, SearchIndexQueue.REMOVE): ['1']})
+            self.assertEquals(SearchIndexQueue.take(), {})
+            # The flush has been taken, so the next change schedules another one
+            self.assertTrue(SearchIndexQueue.enqueue(Source, ['3']))
+
+    def test_signal_processor_queues_saved_and_deleted_objects(self):
+        processor = QueuedSignalProcessor(haystack.connections, haystack.connection_router)
+        try:
+            with patch.object(RedisConnectionFactory, 'redis_connection', InMemoryRedis()), \
+                    patch('oclapi.search_indexing.haystack.signal_processor', processor), \
+                    patch('tasks.flush_search_index_queue.apply_async') as apply_async:
+                org = Organization.objects.create(name='queued', mnemonic='queued')
+                self.assertEquals(apply_async.call_count, 1)
+                self.assertEquals(SearchIndexQueue.take(), {(Organization, SearchIndexQueue.UPDATE): [org.id]})
+
+                org_id = org.id
+                org.delete()
+                self.assertEquals(SearchIndexQueue.take(), {(Organization, SearchIndexQueue.REMOVE): [org_id]})
+        finally:
+            processor.teardown()
+
+    def test_nothing_is_queued_without_queued_indexing(self):
+        with patch.object(RedisConnectionFactory, 'redis_connection', InMemoryRedis()):
+            self.assertFalse(SearchIndexQueue.enqueue(Source, ['1']))
+            self.assertEquals(SearchIndexQueue.take(), {})
+
+
+class SearchReindexTest(OclApiBaseTestCase):
+    def setUp(self):
+        super(SearchReindexTest, self).setUp()
+        for i in range(7):
+            Organization.objects.create(name='reindex%d' % i, mnemonic='reindex%d' % i)
+        self.queryset = Organization.objects.filter(name__startswith='reindex')
+        self.ids = sorted(self.queryset.values_list('id', flat=True))
+
+    def test_split_id_range_covers_every_id_once(self):
+        ranges = split_id_range(self.queryset, 3)
+        self.assertTrue(1 <= len(ranges) <= 3)
+        ids = [id for after, upto in ranges
+               for id in self.queryset.filter(id__gt=after, id__lte=upto).values_list('id', flat=True)]
+        self.assertListEqual(sorted(ids), self.ids)
+        self.assertListEqual(split_id_range(Organization.objects.filter(name='none'), 3), [])
+
+    def test_failed_reindex_resumes_after_checkpoint(self):
+        posted = []
+        failing_id = self.ids[4]
+
+        class RecordingReindex(SearchReindex):
+            def post(self, batch):
+                if failing_id in [org.id for org in batch]:
+                    raise ValueError('Backend unavailable')
+                posted.extend(org.id for org in batch)
+
+        with patch.object(RedisConnectionFactory, 'redis_connection', InMemoryRedis()):
+            reindex = RecordingReindex(Organization, self.queryset, shards=2, workers=2, batch_size=1,
+                                       checkpoint=SearchReindexCheckpoint('orgs.Organization'))
+            self.assertRaises(ValueError, reindex.run)
+            self.assertFalse(failing_id in posted)
+            checkpoint = SearchReindexCheckpoint.load('orgs.Organization')
+            self.assertTrue(checkpoint.done <= len(posted))
+
+            failing_id = None
+            done = RecordingReindex(Organization, self.queryset, shards=2, workers=2, batch_size=1,
+                                    checkpoint=checkpoint).run()
+            self.assertEquals(sorted(set(posted)), self.ids)
+            self.assertTrue(done >= len(self.ids))
+            self.assertEquals(SearchReindexCheckpoint.load('orgs.Organization').ranges, None)
+
+
+class PhaseTimerTest(OclApiBaseTestCase):
+    def test_nested_phases_are_not_counted_twice(self):
+        timer = PhaseTimer()
+        clock = iter([0.0, 1.0, 3.0, 4.0])
+        with patch('oclapi.management.commands.benchmark_imports.time.time', lambda: next(clock)):
+            timer.wrap('write', timer.wrap('validate', lambda: None))()
+        self.assertEquals(dict(timer.seconds), {'write': 2.0, 'validate': 2.0})
+
+    def test_restore_removes_instrumentation(self):
+        class Importer(object):
+            def parse(self):
+                return 'parsed'
+
+        importer = Importer()
+        timer = PhaseTimer()
+        timer.instrument('parse', importer, 'parse')
+        self.assertEquals(importer.parse(), 'parsed')
+        self.assertTrue('parse' in importer.__dict__)
+        timer.restore()
+        self.assertFalse('parse' in importer.__dict__)
+        self.assertTrue('parse' in timer.seconds)
@@ -1,3 +1,4 @@
+from collections import defaultdict
 from datetime import datetime
 
 from bson import ObjectId
@@ -14,7 +15,9 @@ from djangotoolbox.fields import DictField
 
 from oclapi.models import ConceptContainerModel, ConceptContainerVersionModel, ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW
 from oclapi.rawqueries import RawQueries
-from oclapi.utils import S3ConnectionFactory, update_search_index, reverse_resource
+from oclapi.export import get_export_storage, keyset_batches
+from oclapi.utils import reverse_resource
+from tasks import queue_search_index_update
 
 SOURCE_TYPE = 'Source'
 
@@ -111,6 +114,27 @@ class Source(ConceptContainerModel):
     def get_version_model(cls):
         return SourceVersion
 
+    @classmethod
+    def get_sources_with_owners(cls, source_ids):
+        """
+        Looks up the sources and their owners with a query per model, and caches the owners on the sources.
+        Returns the sources by id.
+        """
+        sources = dict((source.id, source) for source in cls.objects.filter(id__in=list(source_ids)))
+
+        owner_ids = defaultdict(set)
+        for source in sources.values():
+            owner_ids[source.parent_type_id].add(source.parent_id)
+        owners = {}
+        for parent_type_id, ids in owner_ids.items():
+            owner_model = ContentType.objects.get_for_id(parent_type_id).model_class()
+            owners.update(((parent_type_id, owner.id), owner) for owner in owner_model.objects.filter(id__in=list(ids)))
+
+        for source in sources.values():
+            if (source.parent_type_id, source.parent_id) in owners:
+                source.parent = owners[(source.parent_type_id, source.parent_id)]
+        return sources
+
     @staticmethod
     def get_url_kwarg():
         return 'source'
@@ -175,7 +199,7 @@ class SourceVersion(ConceptContainerVersionModel):
             ConceptVersion.objects.raw_update({'_id': ObjectId(concept_previous_version.id)},
                                               {'$pull': {'source_version_ids': self.id}})
             ConceptVersion.objects.filter(id=concept_previous_version.id).update(updated_at=datetime.now())
-            update_search_index(concept_previous_version)
+            queue_search_index_update(ConceptVersion, [concept_previous_version.id])
 
         self.add_concept_version(concept_version)
 
@@ -191,7 +215,7 @@ class SourceVersion(ConceptContainerVersionModel):
         SourceVersion.objects.filter(id=self.id).update(active_concepts=F('active_concepts')+1, last_concept_update=updated_at,
                                                         last_child_update=updated_at, updated_at=updated_at)
 
-        update_search_index(concept_version)
+        queue_search_index_update(ConceptVersion, [concept_version.id])
 
     def has_concept_version(self, concept_version):
         return self.id in concept_version.source_version_ids
@@ -204,7 +228,7 @@ class SourceVersion(ConceptContainerVersionModel):
             #Using raw query to atomically remove item from the list
             MappingVersion.objects.raw_update({'_id': ObjectId(mapping_previous_version.id)},{'$pull': {'source_version_ids': self.id}})
             MappingVersion.objects.filter(id=mapping_previous_version.id).update(updated_at=datetime.now())
-            update_search_index(mapping_previous_version)
+            queue_search_index_update(MappingVersion, [mapping_previous_version.id])
 
         self.add_mapping_version(mapping_version)
 
@@ -218,7 +242,7 @@ class SourceVersion(ConceptContainerVersionModel):
 
         SourceVersion.objects.filter(id=self.id).update(active_mappings=F('active_mappings')+1, last_mapping_update=updated_at, last_child_update=updated_at, updated_at=updated_at)
 
-        update_search_index(mapping_version)
+        queue_search_index_update(MappingVersion, [mapping_version.id])
 
     def has_mapping_version(self, mapping_version):
         return self.id in mapping_version.source_version_ids
@@ -239,6 +263,22 @@ class SourceVersion(ConceptContainerVersionModel):
         from mappings.models import MappingVersion
         return MappingVersion.objects.filter(source_version_ids__contains=self.id).values_list('id', flat=True)
 
+    def get_concept_id_batches(self, batch_size, active_only=True):
+        """ Yields the ids of the active concept versions, or of all of them, in batches, in ascending order,
+        paginated by id """
+        concepts = self.get_concepts()
+        if active_only:
+            concepts = concepts.filter(is_active=True)
+        return keyset_batches(concepts.values_list('id', flat=True), batch_size)
+
+    def get_mapping_id_batches(self, batch_size, active_only=True):
+        """ Yields the ids of the active mapping versions, or of all of them, in batches, in ascending order,
+        paginated by id """
+        mappings = self.get_mappings()
+        if active_only:
+            mappings = mappings.filter(is_active=True)
+        return keyset_batches(mappings.values_list('id', flat=True), batch_size)
+
     def seed_concepts(self):
         seed_concepts_from = self.head_sibling()
         if seed_concepts_from:
@@ -278,12 +318,17 @@ class SourceVersion(ConceptContainerVersionModel):
             self.external_id = obj.external_id
 
 
-    def get_export_key(self):
-        bucket = S3ConnectionFactory.get_export_bucket()
-        return bucket.get_key(self.export_path)
+    def has_export(self, base_version=None, export_format=None):
+        return get_export_storage().exists(self.get_export_path(base_version, export_format))
 
-    def has_export(self):
-        return bool(self.get_export_key())
+    def get_export_url(self, base_version=None, export_format=None, expires_in=60):
+        """ Returns the URL to download the export from, or None if the version has not been exported """
+        storage = get_export_storage()
+        export_path = self.get_export_path(base_version, export_format)
+        return storage.get_url(export_path, expires_in) if storage.exists(export_path) else None
+
+    def delete_export(self, base_version=None, export_format=None):
+        get_export_storage().delete(self.get_export_path(base_version, export_format))
 
     @property
     def export_path(self):
@@ -291,6 +336,18 @@ class SourceVersion(ConceptContainerVersionModel):
         source = self.versioned_object
         return "%s/%s_%s.%s.zip" % (source.owner_name, source.mnemonic, self.mnemonic, last_update)
 
+    def get_delta_export_path(self, base_version):
+        """ Path of the export of the changes since base_version """
+        base_last_update = base_version.last_child_update.strftime('%Y%m%d%H%M%S')
+        return "%s.since_%s.%s.zip" % (self.export_path[:-len('.zip')], base_version.mnemonic, base_last_update)
+
+    def get_export_path(self, base_version=None, export_format=None):
+        """ Path of the full or delta export, with the format before the extension unless it is JSON """
+        path = self.get_delta_export_path(base_version) if base_version else self.export_path
+        if export_format and export_format != 'json':
+            path = "%s.%s.zip" % (path[:-len('.zip')], export_format)
+        return path
+
     def __get_last_child_update(self):
         last_concept_update = self.last_concept_update
         last_mapping_update = self.last_mapping_update
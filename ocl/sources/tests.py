@@ -12,10 +12,11 @@ from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
 from mock import mock
 
-from concepts.models import Concept, LocalizedText
+from concepts.models import Concept, ConceptVersion, LocalizedText
 from concepts.validation_messages import OPENMRS_SHORT_NAME_CANNOT_BE_PREFERRED
 from concepts.validators import message_with_name_details
 from mappings.models import MappingVersion
+from oclapi.export import get_export_delta
 from oclapi.models import ACCESS_TYPE_EDIT, ACCESS_TYPE_VIEW, LOOKUP_SOURCES
 from oclapi.models import CUSTOM_VALIDATION_SCHEMA_OPENMRS
 from orgs.models import Organization
@@ -883,6 +884,34 @@ class SourceVersionTest(SourceBaseTest):
 
         self.assertItemsEqual(source_version2.get_concept_ids(), self.source1.get_head().get_concept_ids())
 
+    def test_export_delta_reports_deactivated_concepts_as_removed(self):
+        head = SourceVersion(name='head', mnemonic='HEAD', versioned_object=self.source1, released=True,
+                             created_by=self.user1, updated_by=self.user1)
+        head.full_clean()
+        head.save()
+
+        create_concept(mnemonic='concept1', user=self.user1, source=self.source1)
+        concept2, _ = create_concept(mnemonic='concept2', user=self.user1, source=self.source1)
+
+        version1 = SourceVersion(name='version1', mnemonic='v1', versioned_object=self.source1, released=True, created_by=self.user1, updated_by=self.user1)
+        SourceVersion.persist_new(version1)
+
+        concept3, _ = create_concept(mnemonic='concept3', user=self.user1, source=self.source1)
+        concept4, _ = create_concept(mnemonic='concept4', user=self.user1, source=self.source1)
+        deactivated = ConceptVersion.objects.filter(versioned_object_id__in=[concept2.id, concept4.id])
+        deactivated.update(is_active=False)
+
+        head = SourceVersion.objects.get(id=head.id)
+        delta = get_export_delta(
+            'concepts.models.ConceptVersion', version1.get_concept_id_batches(1, active_only=False),
+            head.get_concept_id_batches(1, active_only=False), head.get_concept_id_batches(1))
+
+        concept2_version = ConceptVersion.objects.get(versioned_object_id=concept2.id)
+        concept3_version = ConceptVersion.objects.get(versioned_object_id=concept3.id)
+        self.assertEquals([version_id for version_id, url in delta.added], [concept3_version.id])
+        self.assertEquals(delta.changed, [])
+        self.assertEquals([version_id for version_id, url in delta.removed], [concept2_version.id])
+
     def test_head_sibling(self):
         source_version1 = SourceVersion(
             name='head',
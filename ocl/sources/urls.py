@@ -2,7 +2,8 @@ from django.conf.urls import patterns, url, include
 from sources.feeds import SourceFeed
 from sources.views import SourceListView, SourceRetrieveUpdateDestroyView, SourceVersionRetrieveUpdateView, \
     SourceVersionChildListView, SourceVersionListView, SourceVersionRetrieveUpdateDestroyView, SourceExtrasView, \
-    SourceExtraRetrieveUpdateDestroyView, SourceVersionExportView, SourceVersionProcessingView
+    SourceExtraRetrieveUpdateDestroyView, SourceVersionExportView, SourceVersionProcessingView, \
+    SourceVersionExportProgressView
 from oclapi.models import NAMESPACE_PATTERN
 
 __author__ = 'misternando'
@@ -20,6 +21,7 @@ urlpatterns = patterns('',
     url(r'^(?P<source>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/$', SourceVersionRetrieveUpdateDestroyView.as_view(), name='sourceversion-detail'),
     url(r'^(?P<source>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/children/$', SourceVersionChildListView.as_view(), {'list_children': True}, name='sourceversion-child-list'),
     url(r'^(?P<source>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/export/$', SourceVersionExportView.as_view(), name='sourceversion-export'),
+    url(r'^(?P<source>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/export/progress/$', SourceVersionExportProgressView.as_view(), name='sourceversion-export-progress'),
     url(r'^(?P<source>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/extras/$', SourceExtrasView.as_view(), name='sourceversion-extras'),
     url(r'^(?P<source>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/extras/(?P<extra>' + NAMESPACE_PATTERN + ')/$', SourceExtraRetrieveUpdateDestroyView.as_view(), name='sourceversion-extra'),
     url(r'^(?P<source>' + NAMESPACE_PATTERN + ')/(?P<version>' + NAMESPACE_PATTERN + ')/mappings/', include('mappings.urls')),
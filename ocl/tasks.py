@@ -25,7 +25,9 @@ importer.install()
 from celery import Celery
 from celery.utils.log import get_task_logger
 from celery_once import QueueOnce
-from oclapi.utils import update_all_in_index, write_export_file, timestamp_sign
+from oclapi.export import write_export_file, ExportCancelled
+from oclapi.search_indexing import update_all_in_index, SearchIndexQueue
+from oclapi.utils import timestamp_sign
 
 import json
 from rest_framework.test import APIRequestFactory
@@ -52,18 +54,23 @@ def find_broken_references(self):
     broken_references = Reference.find_broken_references()
     return broken_references
 
-def queue_bulk_import(to_import, import_queue, username, update_if_exists):
+def queue_bulk_import(to_import, import_queue, username, update_if_exists, resume_task_id=None):
     """
     Used to queue bulk imports. It assigns a bulk import task to a specified import queue or a random one.
     If requested by the root user, the bulk import goes to the priority queue.
+    If resume_task_id is given, the task reuses its uuid, so that the import resumes after its last checkpoint.
 
     :param to_import:
     :param import_queue:
     :param username:
     :param update_if_exists:
+    :param resume_task_id:
     :return: task
     """
-    task_id=str(uuid.uuid4()) + '-' + username
+    if resume_task_id:
+        task_id = parse_bulk_import_task_id(resume_task_id)['uuid'] + username
+    else:
+        task_id=str(uuid.uuid4()) + '-' + username
 
     if username == 'root':
         queue_id = 'bulk_import_root'
@@ -114,37 +121,47 @@ def task_exists(task_id):
     return flower_response and flower_response.status_code == 200 and flower_response.text
 
 
-@celery.task(base=QueueOnce, bind=True)
+@celery.task(base=QueueOnce, bind=True, acks_late=True)
 def bulk_import(self, to_import, username, update_if_exists):
+    # acks_late redelivers the task with the same id if the worker dies, so the import resumes from its checkpoint
     from manage.imports.bulk_import import BulkImport
-    return BulkImport().run_import(to_import, username, update_if_exists)
+    return BulkImport().run_import(to_import, username, update_if_exists,
+                                   parsed_task=parse_bulk_import_task_id(self.request.id))
 
 @celery.task(base=QueueOnce, bind=True)
-def export_source(self, version_id):
+def export_source(self, version_id, base_version_id=None, export_format='json'):
     from sources.models import SourceVersion
 
     logger.info('Finding source version...')
 
     version = SourceVersion.objects.get(id=version_id)
+    base_version = SourceVersion.objects.get(id=base_version_id) if base_version_id else None
     version.add_processing(self.request.id)
     try:
         logger.info('Found source version %s.  Beginning export...' % version.mnemonic)
-        write_export_file(version, 'source', 'sources.serializers.SourceVersionExportSerializer', logger)
+        write_export_file(version, 'source', 'sources.serializers.SourceVersionExportSerializer', logger,
+                          base_version=base_version, export_format=export_format)
         logger.info('Export complete!')
+    except ExportCancelled:
+        logger.info('Export cancelled.')
     finally:
         version.remove_processing(self.request.id)
 
 
 @celery.task(base=QueueOnce, bind=True)
-def export_collection(self, version_id):
+def export_collection(self, version_id, base_version_id=None, export_format='json'):
     from collection.models import CollectionVersion
     logger.info('Finding collection version...')
     version = CollectionVersion.objects.get(id=version_id)
+    base_version = CollectionVersion.objects.get(id=base_version_id) if base_version_id else None
     version.add_processing(self.request.id)
     try:
         logger.info('Found collection version %s.  Beginning export...' % version.mnemonic)
-        write_export_file(version, 'collection', 'collection.serializers.CollectionVersionExportSerializer', logger)
+        write_export_file(version, 'collection', 'collection.serializers.CollectionVersionExportSerializer', logger,
+                          base_version=base_version, export_format=export_format)
         logger.info('Export complete!')
+    except ExportCancelled:
+        logger.info('Export cancelled.')
     finally:
         version.remove_processing(self.request.id)
 
@@ -174,6 +191,27 @@ def update_search_index_task(self, model, query):
     logger.info('Updating search index for %s...' % model.__name__)
     update_all_in_index(model, query)
 
+@celery.task(bind = True)
+def update_mapping_display_fields(self, concept_id):
+    from concepts.models import Concept
+    from mappings.models import MappingVersion
+    concept = Concept.objects.get(id=concept_id)
+    version_ids = MappingVersion.refresh_display_fields_of(concept)
+    logger.info('Indexing %s mappings of concept %s...' % (len(version_ids), concept_id))
+    update_all_in_index(MappingVersion, MappingVersion.objects.filter(id__in=list(version_ids)))
+
+@celery.task(bind = True)
+def flush_search_index_queue(self):
+    logger.info('Flushed %s objects from the search index queue' % SearchIndexQueue.flush())
+
+def queue_search_index_update(model, ids, operation=SearchIndexQueue.UPDATE):
+    """
+    Queues the objects to be reindexed, or removed from the index, by the search_index queue worker. Objects queued
+    within SEARCH_INDEX_QUEUE_WINDOW seconds are flushed together.
+    """
+    if SearchIndexQueue.enqueue(model, ids, operation):
+        flush_search_index_queue.apply_async(countdown=settings.SEARCH_INDEX_QUEUE_WINDOW, queue='search_index')
+
 def resource(version_id, type):
     from sources.models import SourceVersion
     from collection.models import CollectionVersion